@@ -5,16 +5,96 @@
 import torch
 import numpy as np
 import random
+import os
+import json
+import bisect
+import hashlib
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from functools import lru_cache
 from grid_sampler import GridSampler, TimeWarpLayer
 
+
+CACHE_VERSION = 2
+
+
+def read_labels(gt_file, actions_dict):
+    '''
+    :return: integer labels of all the frames of a groundTruth text file
+    '''
+    file_ptr = open(gt_file, 'r')
+    content = file_ptr.read().split('\n')[:-1]
+    file_ptr.close()
+    return np.array([actions_dict[label] for label in content], dtype=np.int64)
+
+
+def read_example(feature_file, gt_file, actions_dict, sample_rate):
+    '''
+    load one video from the raw .npy features and the groundTruth text file.
+    :return: subsampled features of shape (C, T) and integer labels of shape (T,)
+    '''
+    features = np.load(feature_file)
+    classes = read_labels(gt_file, actions_dict)
+    classes = classes[:min(np.shape(features)[1], len(classes))]
+
+    feature = features[:, ::sample_rate]
+    target = classes[::sample_rate]
+    return feature, target
+
+
+def example_length(feature_file, gt_file, sample_rate):
+    '''
+    length of a video without loading it.
+    :return: feature dimension and number of frames after subsampling
+    '''
+    feature_dim, num_frames = np.load(feature_file, mmap_mode='r').shape
+    file_ptr = open(gt_file, 'r')
+    num_labels = len(file_ptr.read().split('\n')[:-1])
+    file_ptr.close()
+    return feature_dim, len(range(0, min(num_frames, num_labels), sample_rate))
+
+
+@lru_cache(maxsize=None)
+def open_shard(prefix):
+    '''
+    memory-map a preprocessed shard written by BatchGenerator.build_cache.
+    :return: features of shape (N, C) and labels of shape (N,), N = total number of (subsampled) frames
+    '''
+    features = np.load(prefix + '.features.npy', mmap_mode='r')
+    labels = np.load(prefix + '.labels.npy', mmap_mode='r')
+    return features, labels
+
+
+@lru_cache(maxsize=None)
+def open_ground_truth(prefix):
+    '''
+    :return: memory-mapped full frame rate labels of all the videos of a shard, see BatchGenerator.ground_truth
+    '''
+    return np.load(prefix + '.gt.npy', mmap_mode='r')
+
+
 class BatchGenerator(object):
-    def __init__(self, num_classes, actions_dict, gt_path, features_path, sample_rate):
+    def __init__(self, num_classes, actions_dict, gt_path, features_path, sample_rate, cache_dir=None, frame_budget=None, seed=None):
+        '''
+        :param seed: seed of the shuffles. None draws it from the random module, so a seeded script stays reproducible
+        '''
         self.index = 0
         self.num_classes = num_classes
         self.actions_dict = actions_dict
         self.gt_path = gt_path
         self.features_path = features_path
         self.sample_rate = sample_rate
+        self.cache_dir = cache_dir
+        self.cache = dict()  # feature file => (shard prefix, offset, length)
+        self.gt_cache = dict()  # groundTruth file => (shard prefix, offset, length) of the full frame rate labels
+        # if set, batches are built from videos of similar length with at most frame_budget (padded) frames
+        self.frame_budget = frame_budget
+        self.lengths = dict()  # feature file => number of frames
+        self.batch_ends = None
+        # a generator of its own: the test split is reset on the validation thread (see Trainer.train), which must
+        # not reseed the random module under the shuffles of the training split
+        self.random = random.Random(random.getrandbits(32) if seed is None else seed)
 
         self.timewarp_layer = TimeWarpLayer()
     
@@ -30,6 +110,12 @@ class BatchGenerator(object):
             return True
         return False
 
+    def num_batches(self, batch_size):
+        # number of batches left in the current epoch
+        if self.batch_ends is not None:
+            return len(self.batch_ends) - bisect.bisect_right(self.batch_ends, self.index)
+        return -(-(len(self.list_of_examples) - self.index) // batch_size)
+
     def read_data(self, vid_list_file):
         file_ptr = open(vid_list_file, 'r')
         self.list_of_examples = file_ptr.read().split('\n')[:-1]
@@ -37,17 +123,164 @@ class BatchGenerator(object):
 
         self.gts = [self.gt_path + vid for vid in self.list_of_examples]
         self.features = [self.features_path + vid.split('.')[0] + '.npy' for vid in self.list_of_examples]
+        if self.cache_dir is not None:
+            self.attach_cache(self.build_cache(vid_list_file))
         self.my_shuffle()
 
+    def cache_key(self):
+        '''
+        hash of what the content of a shard depends on besides the split: the feature and groundTruth
+        directories, the action mapping and CACHE_VERSION. Splits of the same name from different datasets
+        get different shards.
+        '''
+        key = json.dumps([CACHE_VERSION, os.path.abspath(self.features_path), os.path.abspath(self.gt_path),
+                          sorted(self.actions_dict.items())])
+        return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+    def cache_prefix(self, vid_list_file):
+        name = os.path.basename(vid_list_file)
+        return os.path.join(self.cache_dir, '{}.sr{}.{}'.format(name, self.sample_rate, self.cache_key()))
+
+    def source_stats(self):
+        '''
+        size and modification time of the feature and groundTruth files of the split, stored in the shard index:
+        files regenerated in place invalidate the shard.
+        '''
+        stats = {path: os.stat(path) for path in self.features + self.gts}
+        return {path: [stat.st_size, stat.st_mtime_ns] for path, stat in stats.items()}
+
+    def cache_is_valid(self, index):
+        return (index.get('version') == CACHE_VERSION and index.get('key') == self.cache_key()
+                and index.get('sources') == self.source_stats())
+
+    def _temp_path(self, prefix, suffix):
+        # unique name in the cache dir, so that jobs building the same shard at the same time do not write
+        # into each other's files. The last os.replace wins, with identical content.
+        fd, path = tempfile.mkstemp(suffix=suffix, prefix=os.path.basename(prefix) + '.', dir=os.path.dirname(prefix))
+        os.close(fd)
+        return path
+
+    def build_cache(self, vid_list_file):
+        '''
+        one-time preprocessing: write the subsampled features and integer labels of all videos in the split
+        into one memory-mapped shard, plus an index of offsets and lengths. The integer labels of the groundTruth
+        files at the full frame rate are stored too, for the evaluation. Skipped if the shard already exists
+        and is valid (see cache_is_valid), rebuilt otherwise.
+        :return: prefix of the shard files
+        '''
+        prefix = self.cache_prefix(vid_list_file)
+        if os.path.exists(prefix + '.index.json'):
+            with open(prefix + '.index.json', 'r') as f:
+                index = json.load(f)
+            if self.cache_is_valid(index):
+                return prefix
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # before reading the files: a file changed while the shard is built invalidates it
+        sources = self.source_stats()
+
+        # first pass: only shapes, so the shard can be allocated up front
+        lengths = []
+        feature_dim = None
+        for feature_file, gt_file in zip(self.features, self.gts):
+            feature_dim, length = example_length(feature_file, gt_file, self.sample_rate)
+            lengths.append(length)
+        offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(int).tolist()
+
+        # second pass: fill the shard. Written under temporary names, the index is written last.
+        tmp = {name: self._temp_path(prefix, '.{}.tmp.npy'.format(name)) for name in ('features', 'labels', 'gt')}
+        features = np.lib.format.open_memmap(tmp['features'], mode='w+', dtype=np.float32, shape=(sum(lengths), feature_dim))
+        labels = np.lib.format.open_memmap(tmp['labels'], mode='w+', dtype=np.int64, shape=(sum(lengths),))
+        for feature_file, gt_file, offset, length in zip(self.features, self.gts, offsets, lengths):
+            feature, target = read_example(feature_file, gt_file, self.actions_dict, self.sample_rate)
+            features[offset:offset + length] = feature[:, :length].T
+            labels[offset:offset + length] = target
+        features.flush()
+        labels.flush()
+        del features, labels
+        gt = [read_labels(gt_file, self.actions_dict) for gt_file in self.gts]
+        gt_lengths = [len(labels) for labels in gt]
+        gt_offsets = np.concatenate([[0], np.cumsum(gt_lengths)[:-1]]).astype(int).tolist()
+        np.save(tmp['gt'], np.concatenate(gt) if gt else np.zeros(0, dtype=np.int64))
+        for name, path in tmp.items():
+            os.replace(path, '{}.{}.npy'.format(prefix, name))
+        # the memory maps of a previous build of the shard in this process
+        open_shard.cache_clear()
+        open_ground_truth.cache_clear()
+
+        index = {'version': CACHE_VERSION, 'key': self.cache_key(), 'sources': sources, 'features': self.features, 'offsets': offsets, 'lengths': lengths, 'feature_dim': int(feature_dim),
+                 'gts': self.gts, 'gt_offsets': gt_offsets, 'gt_lengths': gt_lengths}
+        index_tmp = self._temp_path(prefix, '.index.json.tmp')
+        with open(index_tmp, 'w') as f:
+            json.dump(index, f)
+        os.replace(index_tmp, prefix + '.index.json')
+        return prefix
+
+    def attach_cache(self, prefix):
+        with open(prefix + '.index.json', 'r') as f:
+            index = json.load(f)
+        if not self.cache_is_valid(index):
+            raise ValueError('the shard {} is stale, or was built from other files or action mapping'.format(prefix))
+        for feature_file, offset, length in zip(index['features'], index['offsets'], index['lengths']):
+            self.cache[feature_file] = (prefix, offset, length)
+        for gt_file, offset, length in zip(index['gts'], index['gt_offsets'], index['gt_lengths']):
+            self.gt_cache[gt_file] = (prefix, offset, length)
+
+    def length_of(self, feature_file, gt_file):
+        if feature_file in self.cache:
+            return self.cache[feature_file][2]
+        if feature_file not in self.lengths:
+            self.lengths[feature_file] = example_length(feature_file, gt_file, self.sample_rate)[1]
+        return self.lengths[feature_file]
+
+    def load_example(self, feature_file, gt_file):
+        '''
+        :return: features of shape (C, T) and labels of shape (T,). Zero-copy views of the shard if the video is cached.
+        '''
+        if feature_file in self.cache:
+            prefix, offset, length = self.cache[feature_file]
+            features, labels = open_shard(prefix)
+            return features[offset:offset + length].T, labels[offset:offset + length]
+        return read_example(feature_file, gt_file, self.actions_dict, self.sample_rate)
+
+    def ground_truth(self, vid):
+        '''
+        :return: integer labels of the video at the full frame rate (not subsampled), of shape (T_full,)
+        '''
+        gt_file = self.gt_path + vid
+        if gt_file in self.gt_cache:
+            prefix, offset, length = self.gt_cache[gt_file]
+            return open_ground_truth(prefix)[offset:offset + length]
+        return read_labels(gt_file, self.actions_dict)
+
     def my_shuffle(self):
         # shuffle list_of_examples, gts, features with the same order
-        randnum = random.randint(0, 100)
-        random.seed(randnum)
-        random.shuffle(self.list_of_examples)
-        random.seed(randnum)
-        random.shuffle(self.gts)
-        random.seed(randnum)
-        random.shuffle(self.features)
+        randnum = self.random.randint(0, 100)
+        random.Random(randnum).shuffle(self.list_of_examples)
+        random.Random(randnum).shuffle(self.gts)
+        random.Random(randnum).shuffle(self.features)
+        if self.frame_budget is not None:
+            self.bucket()
+
+    def bucket(self):
+        '''
+        length bucketing: sort the videos by length (the shuffled order breaks ties), cut the sorted list
+        into batches of at most frame_budget padded frames and shuffle the order of the batches.
+        '''
+        lengths = [self.length_of(feature_file, gt_file) for feature_file, gt_file in zip(self.features, self.gts)]
+        batches = []
+        for i in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+            # ascending order, so video i is the longest of the batch it joins
+            if batches and (len(batches[-1]) + 1) * lengths[i] <= self.frame_budget:
+                batches[-1].append(i)
+            else:
+                batches.append([i])
+        self.random.shuffle(batches)
+
+        order = [i for batch in batches for i in batch]
+        self.list_of_examples = [self.list_of_examples[i] for i in order]
+        self.gts = [self.gts[i] for i in order]
+        self.features = [self.features[i] for i in order]
+        self.batch_ends = np.cumsum([len(batch) for batch in batches]).tolist()
 
 
     def warp_video(self, batch_input_tensor, batch_target_tensor):
@@ -82,29 +315,43 @@ class BatchGenerator(object):
         self.list_of_examples += [vid + suffix for vid in bg.list_of_examples]
         self.gts += bg.gts
         self.features += bg.features
+        self.cache.update(bg.cache)
+        self.gt_cache.update(bg.gt_cache)
+        self.lengths.update(bg.lengths)
+        if self.frame_budget is not None:
+            self.bucket()
 
         print('Merge! Dataset length:{}'.format(len(self.list_of_examples)))
 
 
     def next_batch(self, batch_size, if_warp=False): # if_warp=True is a strong data augmentation. See grid_sampler.py for details.
+        batch, batch_gts, batch_features = self.take(batch_size)
+        return self.load_batch(batch, batch_gts, batch_features, if_warp)
+
+    def take(self, batch_size):
+        '''
+        advance the generator by one batch without loading it. With a frame_budget, batch_size is ignored
+        and the next length bucket is returned.
+        :return: video names, groundTruth files and feature files of the batch
+        '''
+        if self.batch_ends is not None:
+            batch_size = self.batch_ends[bisect.bisect_right(self.batch_ends, self.index)] - self.index
         batch = self.list_of_examples[self.index:self.index + batch_size]
         batch_gts = self.gts[self.index:self.index + batch_size]
         batch_features = self.features[self.index:self.index + batch_size]
 
         self.index += batch_size
+        return batch, batch_gts, batch_features
 
+    def load_batch(self, batch, batch_gts, batch_features, if_warp=False):
+        '''
+        load and pad the videos returned by take(). Does not touch self.index, so it can run in a worker.
+        :return: (input, target, mask, vids) as next_batch
+        '''
         batch_input = []
         batch_target = []
         for idx, vid in enumerate(batch):
-            features = np.load(batch_features[idx])
-            file_ptr = open(batch_gts[idx], 'r')
-            content = file_ptr.read().split('\n')[:-1]
-            classes = np.zeros(min(np.shape(features)[1], len(content)))
-            for i in range(len(classes)):
-                classes[i] = self.actions_dict[content[i]]
-
-            feature = features[:, ::self.sample_rate]
-            target = classes[::self.sample_rate]
+            feature, target = self.load_example(batch_features[idx], batch_gts[idx])
             batch_input.append(feature)
             batch_target.append(target)
 
@@ -114,11 +361,12 @@ class BatchGenerator(object):
         mask = torch.zeros(len(batch_input), self.num_classes, max(length_of_sequences), dtype=torch.float)
         for i in range(len(batch_input)):
             if if_warp:
-                warped_input, warped_target = self.warp_video(torch.from_numpy(batch_input[i]).unsqueeze(0), torch.from_numpy(batch_target[i]).unsqueeze(0))
+                warped_input, warped_target = self.warp_video(torch.from_numpy(np.array(batch_input[i], dtype=np.float32)).unsqueeze(0), torch.from_numpy(np.array(batch_target[i])).unsqueeze(0))
                 batch_input_tensor[i, :, :np.shape(batch_input[i])[1]], batch_target_tensor[i, :np.shape(batch_target[i])[0]] = warped_input.squeeze(0), warped_target.squeeze(0)
             else:
-                batch_input_tensor[i, :, :np.shape(batch_input[i])[1]] = torch.from_numpy(batch_input[i])
-                batch_target_tensor[i, :np.shape(batch_target[i])[0]] = torch.from_numpy(batch_target[i])
+                # copy straight from the (possibly memory-mapped, read-only) arrays into the padded batch
+                batch_input_tensor.numpy()[i, :, :np.shape(batch_input[i])[1]] = batch_input[i]
+                batch_target_tensor.numpy()[i, :np.shape(batch_target[i])[0]] = batch_target[i]
             mask[i, :, :np.shape(batch_target[i])[0]] = torch.ones(self.num_classes, np.shape(batch_target[i])[0])
 
         return batch_input_tensor, batch_target_tensor, mask, batch
@@ -182,5 +430,81 @@ class BatchGenerator(object):
         return batch_input, batch_target, batch_parents, batch_children, batch'''
 
 
+class BatchPrefetcher(object):
+    '''
+    Iterates over the remaining batches of a BatchGenerator while up to max_prefetch batches are loaded
+    in the background, so batch N+1 is built while batch N trains. Yields (input, target, mask, vids) as
+    BatchGenerator.next_batch. num_workers=0 loads synchronously.
+    '''
+    def __init__(self, batch_gen, batch_size, if_warp=False, num_workers=2, worker_type='thread', max_prefetch=4, pin_memory=False):
+        assert worker_type in ['thread', 'process']
+        self.batch_gen = batch_gen
+        self.batch_size = batch_size
+        self.if_warp = if_warp
+        self.num_workers = num_workers
+        self.worker_type = worker_type
+        self.max_prefetch = max(max_prefetch, num_workers)
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.executor = None
+
+    def __len__(self):
+        return self.batch_gen.num_batches(self.batch_size)
+
+    def _start(self):
+        if self.executor is not None:
+            return
+        if self.worker_type == 'thread':
+            self.executor = ThreadPoolExecutor(self.num_workers)
+        else:
+            # every worker process gets its own copy of the generator once, tasks only carry file names
+            self.executor = ProcessPoolExecutor(self.num_workers, initializer=_init_worker, initargs=(self.batch_gen,))
+
+    def _load(self, *args):
+        out = self.batch_gen.load_batch(*args)
+        return self._pin(out) if self.worker_type == 'thread' else out
+
+    def _pin(self, out):
+        if not self.pin_memory:
+            return out
+        batch_input, batch_target, mask, vids = out
+        return batch_input.pin_memory(), batch_target.pin_memory(), mask.pin_memory(), vids
+
+    def __iter__(self):
+        if self.num_workers == 0:
+            while self.batch_gen.has_next():
+                yield self._pin(self.batch_gen.next_batch(self.batch_size, self.if_warp))
+            return
+
+        self._start()
+        load = self._load if self.worker_type == 'thread' else _load_batch_in_worker
+        pending = deque()
+        try:
+            while self.batch_gen.has_next() or pending:
+                while self.batch_gen.has_next() and len(pending) < self.max_prefetch:
+                    pending.append(self.executor.submit(load, *self.batch_gen.take(self.batch_size), self.if_warp))
+                out = pending.popleft().result()
+                yield out if self.worker_type == 'thread' else self._pin(out)
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+
+_worker_batch_gen = None
+
+
+def _init_worker(batch_gen):
+    global _worker_batch_gen
+    _worker_batch_gen = batch_gen
+
+
+def _load_batch_in_worker(batch, batch_gts, batch_features, if_warp):
+    return _worker_batch_gen.load_batch(batch, batch_gts, batch_features, if_warp)
+
+
 if __name__ == '__main__':
     pass
\ No newline at end of file
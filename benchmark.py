@@ -0,0 +1,360 @@
+'''
+    Microbenchmarks of the hot spots of the model, each compared against the implementation it replaced.
+    Usage: python benchmark.py {sliding_att,loss,hyp_linear,dist_matrix,hyp_mlr,imports}
+'''
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from hyptorch import pmath
+from model import AttLayer, MyTransformer, get_window_mask
+
+
+def _timeit(fn, repeat=10):
+    fn()  # warm up
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def sliding_att_reference(layer, q, k, v, mask):
+    '''
+    the original list-comprehension implementation of AttLayer._sliding_window_self_att
+    '''
+    m_batchsize, c1, L = q.size()
+    _, c2, _ = k.size()
+    _, c3, _ = v.size()
+    bl = layer.bl
+    device = q.device
+
+    nb = L // bl
+    if L % bl != 0:
+        q = torch.cat([q, torch.zeros((m_batchsize, c1, bl - L % bl)).to(device)], dim=-1)
+        k = torch.cat([k, torch.zeros((m_batchsize, c2, bl - L % bl)).to(device)], dim=-1)
+        v = torch.cat([v, torch.zeros((m_batchsize, c3, bl - L % bl)).to(device)], dim=-1)
+        nb += 1
+    padding_mask = torch.cat([torch.ones((m_batchsize, 1, L)).to(device) * mask[:, 0:1, :], torch.zeros((m_batchsize, 1, bl * nb - L)).to(device)], dim=-1)
+
+    q = q.reshape(m_batchsize, c1, nb, bl).permute(0, 2, 1, 3).reshape(m_batchsize * nb, c1, bl)
+    k = torch.cat([torch.zeros(m_batchsize, c2, bl // 2).to(device), k, torch.zeros(m_batchsize, c2, bl // 2).to(device)], dim=-1)
+    v = torch.cat([torch.zeros(m_batchsize, c3, bl // 2).to(device), v, torch.zeros(m_batchsize, c3, bl // 2).to(device)], dim=-1)
+    padding_mask = torch.cat([torch.zeros(m_batchsize, 1, bl // 2).to(device), padding_mask, torch.zeros(m_batchsize, 1, bl // 2).to(device)], dim=-1)
+
+    k = torch.stack([k[:, :, i * bl:(i + 1) * bl + (bl // 2) * 2] for i in range(nb)], dim=1).reshape(m_batchsize * nb, c2, -1)
+    v = torch.stack([v[:, :, i * bl:(i + 1) * bl + (bl // 2) * 2] for i in range(nb)], dim=1).reshape(m_batchsize * nb, c3, -1)
+    padding_mask = torch.stack([padding_mask[:, :, i * bl:(i + 1) * bl + (bl // 2) * 2] for i in range(nb)], dim=1).reshape(m_batchsize * nb, 1, -1)
+    final_mask = get_window_mask(bl, device, q.dtype).repeat(m_batchsize * nb, 1, 1) * padding_mask
+
+    output, attention = layer.att_helper.scalar_dot_att(q, k, v, final_mask)
+    output = layer.conv_out(F.relu(output))
+
+    output = output.reshape(m_batchsize, nb, -1, bl).permute(0, 2, 1, 3).reshape(m_batchsize, -1, nb * bl)
+    output = output[:, :, 0:L]
+    return output * mask[:, 0:1, :]
+
+
+def bench_sliding_att(args):
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    print('%6s %4s %12s %12s %10s' % ('T', 'bl', 'loop (ms)', 'unfold (ms)', 'max diff'))
+    for L in args.lengths:
+        for i in range(10):
+            bl = 2 ** i
+            layer = AttLayer(args.dim, args.dim, args.dim, 2, 2, 2, bl, 'encoder', 'sliding_att').to(device).eval()
+            q = torch.randn(args.batch_size, args.dim // 2, L, device=device)
+            k = torch.randn(args.batch_size, args.dim // 2, L, device=device)
+            v = torch.randn(args.batch_size, args.dim // 2, L, device=device)
+            mask = torch.ones(args.batch_size, 1, L, device=device)
+            mask[1:, :, L // 2:] = 0  # padded videos in the batch
+            with torch.no_grad():
+                diff = (sliding_att_reference(layer, q, k, v, mask) - layer._sliding_window_self_att(q, k, v, mask)).abs().max().item()
+                t_ref = _timeit(lambda: sliding_att_reference(layer, q, k, v, mask), args.repeat)
+                t_new = _timeit(lambda: layer._sliding_window_self_att(q, k, v, mask), args.repeat)
+            print('%6d %4d %12.2f %12.2f %10.2e' % (L, bl, t_ref, t_new, diff))
+
+
+def loss_reference(model, features, target, mask):
+    '''
+    the original per-segment implementation of MyTransformer.loss
+    '''
+    lengths = mask[:, 0, :].sum(dim=-1).long().tolist()
+    losses = []
+    for features, target, length in zip(features, target, lengths):
+        features, target = features[:length], target[:length]
+        parent = features[target == torch.cat((target[1:], target[[0]]))]
+        child = features[target == torch.cat((target[[-1]], target[:-1]))]
+        loss_cos = []
+        loss_norm = []
+        boarder = torch.argwhere(target != torch.cat([target[[-1]], target[:-1]]))
+        boarder = boarder.squeeze().cpu().tolist() + [len(target)]
+        for n in range(len(target) // (len(boarder)-1) + 1):
+            cross_idx_1 = []
+            cross_idx_2 = []
+            for n in range(len(boarder)-1):
+                cross_idx_1.append(np.random.choice(range(boarder[n], boarder[n+1])))
+                cross_idx_2.append(np.random.choice(range(boarder[n], boarder[n+1])))
+            score = torch.matmul(features[cross_idx_1], features[cross_idx_2].T)
+            loss_cos.append(model.loss_crossen(score))
+        loss_center = - features[boarder[:-1]].norm(dim=1).mean()
+        for n in range(len(boarder)-1):
+            parent_batch_norm = parent[boarder[n]: boarder[n+1]].norm(dim=1)
+            child_batch_norm = child[boarder[n]: boarder[n+1]].norm(dim=1)
+            score = - F.relu(child_batch_norm.repeat(len(child_batch_norm), 1) - parent_batch_norm.repeat(len(child_batch_norm), 1).T + 0.01)
+            batch_loss = model.loss_crossen(score)
+            if torch.isnan(batch_loss):
+                break
+            loss_norm.append(batch_loss)
+        losses.append((sum(loss_cos) / len(loss_cos)) + loss_center + (sum(loss_norm) / len(loss_norm)))
+    return sum(losses) / len(losses)
+
+
+def _random_target(L, num_segments, num_classes):
+    # num_segments actions, the first one different from the last (the cyclic border at frame 0)
+    cuts = np.sort(np.random.choice(np.arange(1, L), num_segments - 1, replace=False))
+    labels = np.arange(num_segments) % num_classes
+    target = np.repeat(labels, np.diff(np.concatenate(([0], cuts, [L]))))
+    return torch.from_numpy(target)
+
+
+def bench_loss(args):
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model = MyTransformer(3, 10, 2, 2, 64, 2048, args.dim, 48, 0.3).to(device)
+    print('%6s %4s %12s %12s %10s %10s' % ('T', 'segs', 'loop (ms)', 'batched (ms)', 'loop', 'batched'))
+    for L in args.lengths:
+        for num_segments in args.segments:
+            target = torch.stack([_random_target(L, num_segments, 48) for _ in range(args.batch_size)]).to(device)
+            mask = torch.ones(args.batch_size, 48, L, device=device)
+            features = (0.1 * torch.randn(args.batch_size, L, args.dim, device=device)).requires_grad_()
+
+            def step(loss_fn):
+                loss = loss_fn(features, target, mask)
+                loss.backward()
+                return loss.item()
+            t_ref = _timeit(lambda: step(lambda *a: loss_reference(model, *a)), args.repeat)
+            t_new = _timeit(lambda: step(model.loss), args.repeat)
+            # the losses are random (sampled frame pairs), compare their means
+            ref = np.mean([step(lambda *a: loss_reference(model, *a)) for _ in range(args.samples)])
+            new = np.mean([step(model.loss) for _ in range(args.samples)])
+            print('%6d %4d %12.2f %12.2f %10.4f %10.4f' % (L, num_segments, t_ref, t_new, ref, new))
+
+
+def hyp_linear_reference(x, weight, bias, c):
+    '''
+    the original chain of HypLinear.forward
+    '''
+    mv = pmath.mobius_matvec(weight, x, c=c)
+    return pmath.project(pmath.mobius_add(mv, pmath.expmap0(bias, c=c), c=c), c=c)
+
+
+def bench_hyp_linear(args):
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    print('%8s %5s %12s %12s %12s %12s %10s' % ('N', 'dim', 'chain (ms)', 'fused (ms)', 'chain (MB)', 'fused (MB)', 'max diff'))
+    for N in args.lengths:
+        x = pmath.expmap0_project(torch.randn(N, args.dim, device=device), c=1.0).requires_grad_()
+        weight = (torch.randn(args.dim, args.dim, device=device) / args.dim ** 0.5).requires_grad_()
+        bias = (0.1 * torch.randn(args.dim, device=device)).requires_grad_()
+
+        def step(fn):
+            out = fn(x, weight, bias, 1.0)
+            out.sum().backward()
+            return out
+
+        def peak_memory(fn):
+            if device.type != 'cuda':
+                return float('nan')
+            torch.cuda.reset_peak_memory_stats()
+            base = torch.cuda.memory_allocated()
+            step(fn)
+            return (torch.cuda.max_memory_allocated() - base) / 2 ** 20
+
+        fused = lambda x, weight, bias, c: pmath.hyp_linear(x, weight, bias, c=c)
+        diff = (step(hyp_linear_reference) - step(fused)).abs().max().item()
+        t_ref = _timeit(lambda: step(hyp_linear_reference), args.repeat)
+        t_new = _timeit(lambda: step(fused), args.repeat)
+        print('%8d %5d %12.2f %12.2f %12.1f %12.1f %10.2e' % (N, args.dim, t_ref, t_new, peak_memory(hyp_linear_reference), peak_memory(fused), diff))
+
+
+def dist_matrix_reference(x, y, c):
+    '''
+    the original dist_matrix, through the (B, C, D) batched mobius addition
+    '''
+    c = torch.as_tensor(c).type_as(x)
+    return 2 / c ** 0.5 * pmath.artanh(c ** 0.5 * torch.norm(pmath._mobius_addition_batch(-x, y, c=c), dim=-1))
+
+
+def bench_dist_matrix(args):
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    print('%8s %5s %10s %12s %12s %12s %12s %10s' % ('N', 'dim', 'block', 'batch (ms)', 'gram (ms)', 'batch (MB)', 'gram (MB)', 'max diff'))
+    for N in args.lengths:
+        x = pmath.expmap0_project(torch.randn(N, args.dim, device=device), c=1.0).requires_grad_()
+        y = pmath.expmap0_project(torch.randn(N, args.dim, device=device), c=1.0).requires_grad_()
+        gram = lambda x, y, c: pmath.dist_matrix(x, y, c, block_size=args.block_size)
+        # the batched mobius addition needs N * N * dim floats, skip it when it does not fit
+        run_ref = N * N * args.dim * 4 <= args.max_reference_mb * 2 ** 20
+
+        def step(fn):
+            out = fn(x, y, 1.0)
+            out.sum().backward()
+            return out
+
+        def peak_memory(fn):
+            if device.type != 'cuda':
+                return float('nan')
+            torch.cuda.reset_peak_memory_stats()
+            base = torch.cuda.memory_allocated()
+            step(fn)
+            return (torch.cuda.max_memory_allocated() - base) / 2 ** 20
+
+        nan = float('nan')
+        diff = (step(dist_matrix_reference) - step(gram)).abs().max().item() if run_ref else nan
+        t_ref = _timeit(lambda: step(dist_matrix_reference), args.repeat) if run_ref else nan
+        t_new = _timeit(lambda: step(gram), args.repeat)
+        print('%8d %5d %10s %12.2f %12.2f %12.1f %12.1f %10.2e' % (N, args.dim, args.block_size, t_ref, t_new,
+                                                                   peak_memory(dist_matrix_reference) if run_ref else nan, peak_memory(gram), diff))
+
+
+def hyperbolic_softmax_reference(X, A, P, c):
+    '''
+    the original _hyperbolic_softmax, through the (C, B, D) batched mobius addition
+    '''
+    lambda_pkc = 2 / (1 - c * P.pow(2).sum(dim=1))
+    k = lambda_pkc * torch.norm(A, dim=1) / torch.sqrt(c)
+    mob_add = pmath._mobius_addition_batch(-P, X, c)
+    num = 2 * torch.sqrt(c) * torch.sum(mob_add * A.unsqueeze(1), dim=-1)
+    denom = torch.norm(A, dim=1, keepdim=True) * (1 - c * mob_add.pow(2).sum(dim=2))
+    logit = k.unsqueeze(1) * pmath.arsinh(num / denom)
+    return logit.permute(1, 0)
+
+
+def bench_hyp_mlr(args):
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    print('%8s %8s %5s %10s %12s %12s %12s %12s %10s' % ('N', 'classes', 'dim', 'tile', 'batch (ms)', 'tiled (ms)', 'batch (MB)', 'tiled (MB)', 'max diff'))
+    c = torch.tensor(1.0, device=device)
+    for N in args.lengths:
+        # inside the ball, away from its boundary where the logits are ill-conditioned
+        x = pmath.expmap0_project(torch.randn(N, args.dim, device=device) / args.dim ** 0.5, c=1.0).requires_grad_()
+        P = pmath.expmap0_project(0.1 * torch.randn(args.classes, args.dim, device=device) / args.dim ** 0.5, c=1.0).requires_grad_()
+        A = torch.randn(args.classes, args.dim, device=device).requires_grad_()
+        tiled = lambda x, A, P, c: pmath._hyperbolic_softmax(x, A, P, c, args.tile_size)
+        run_ref = N * args.classes * args.dim * 4 <= args.max_reference_mb * 2 ** 20
+
+        def step(fn):
+            out = fn(x, A, P, c)
+            out.sum().backward()
+            return out
+
+        def peak_memory(fn):
+            if device.type != 'cuda':
+                return float('nan')
+            torch.cuda.reset_peak_memory_stats()
+            base = torch.cuda.memory_allocated()
+            step(fn)
+            return (torch.cuda.max_memory_allocated() - base) / 2 ** 20
+
+        nan = float('nan')
+        diff = (step(hyperbolic_softmax_reference) - step(tiled)).abs().max().item() if run_ref else nan
+        t_ref = _timeit(lambda: step(hyperbolic_softmax_reference), args.repeat) if run_ref else nan
+        t_new = _timeit(lambda: step(tiled), args.repeat)
+        print('%8d %8d %5d %10s %12.2f %12.2f %12.1f %12.1f %10.2e' % (N, args.classes, args.dim, args.tile_size, t_ref, t_new,
+                                                                       peak_memory(hyperbolic_softmax_reference) if run_ref else nan, peak_memory(tiled), diff))
+
+
+# the modules main.py imports before it parses its arguments, and the dependencies they only load when used
+STARTUP_MODULES = ['model', 'batch_gen', 'eval', 'visualize']
+ON_DEMAND_MODULES = ['matplotlib', 'seaborn', 'scipy', 'tqdm', 'torchvision']
+# seconds allowed on top of the import of torch, also checked by tests/test_imports.py
+IMPORT_BUDGET = 0.5
+
+
+def _import_time(modules):
+    # in a fresh interpreter, seconds to import torch and then modules, and the top level packages loaded by torch
+    # and by modules
+    code = ('import sys, time; start = time.perf_counter(); import torch; print(time.perf_counter() - start); '
+            'print(" ".join(sorted({{name.split(".")[0] for name in sys.modules}}))); '
+            'start = time.perf_counter(); import {}; print(time.perf_counter() - start); '
+            'print(" ".join(sorted({{name.split(".")[0] for name in sys.modules}})))'.format(', '.join(modules)))
+    out = subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                         capture_output=True, text=True, check=True).stdout.split('\n')
+    return float(out[0]), set(out[1].split()), float(out[2]), set(out[3].split())
+
+
+def bench_imports(args):
+    '''
+    startup imports of main.py after the import of torch, median of repeat fresh interpreters. The time is measured
+    on top of torch in the same interpreter, not as the difference of two runs, whose noise is as large as the
+    budget. Fails if they take more than budget seconds, or load a dependency that should only be loaded on demand
+    (unless torch itself loads it).
+    '''
+    runs = [_import_time(STARTUP_MODULES) for _ in range(args.repeat)]
+    t_torch = float(np.median([run[0] for run in runs]))
+    t_startup = float(np.median([run[2] for run in runs]))
+    eager = sorted(set(ON_DEMAND_MODULES) & set.union(*[run[3] - run[1] for run in runs]))
+    print('%-36s %10s' % ('imports', 'time (s)'))
+    print('%-36s %10.2f' % ('torch', t_torch))
+    print('%-36s %10.2f' % ('+ ' + ', '.join(STARTUP_MODULES), t_startup))
+    print('overhead over torch: %.2f s (budget %.2f s), loaded on demand only: %s' % (t_startup, args.budget, ', '.join(eager) or '-'))
+    if t_startup > args.budget or eager:
+        sys.exit('import budget exceeded')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='bench')
+
+    p = subparsers.add_parser('sliding_att')
+    p.add_argument('--lengths', default=[1000, 5000], type=int, nargs='+')
+    p.add_argument('--dim', default=64, type=int)
+    p.add_argument('--batch_size', default=1, type=int)
+    p.add_argument('--repeat', default=10, type=int)
+    p.set_defaults(func=bench_sliding_att)
+
+    p = subparsers.add_parser('loss')
+    p.add_argument('--lengths', default=[1000, 5000], type=int, nargs='+')
+    p.add_argument('--segments', default=[5, 20], type=int, nargs='+')
+    p.add_argument('--dim', default=64, type=int)
+    p.add_argument('--batch_size', default=1, type=int)
+    p.add_argument('--repeat', default=3, type=int)
+    p.add_argument('--samples', default=20, type=int)
+    p.set_defaults(func=bench_loss)
+
+    p = subparsers.add_parser('hyp_linear')
+    p.add_argument('--lengths', default=[10000, 100000], type=int, nargs='+')
+    p.add_argument('--dim', default=512, type=int)
+    p.add_argument('--repeat', default=10, type=int)
+    p.set_defaults(func=bench_hyp_linear)
+
+    p = subparsers.add_parser('dist_matrix')
+    p.add_argument('--lengths', default=[300, 3000], type=int, nargs='+')
+    p.add_argument('--dim', default=512, type=int)
+    p.add_argument('--block_size', default=None, type=int)
+    p.add_argument('--max_reference_mb', default=512, type=int, help='skip the batched reference above this size')
+    p.add_argument('--repeat', default=5, type=int)
+    p.set_defaults(func=bench_dist_matrix)
+
+    p = subparsers.add_parser('hyp_mlr')
+    p.add_argument('--lengths', default=[10000, 100000], type=int, nargs='+')
+    p.add_argument('--classes', default=48, type=int)
+    p.add_argument('--dim', default=512, type=int)
+    p.add_argument('--tile_size', default=4096, type=int)
+    p.add_argument('--max_reference_mb', default=512, type=int, help='skip the batched reference above this size')
+    p.add_argument('--repeat', default=5, type=int)
+    p.set_defaults(func=bench_hyp_mlr)
+
+    p = subparsers.add_parser('imports')
+    p.add_argument('--budget', default=IMPORT_BUDGET, type=float, help='seconds allowed on top of the import of torch')
+    p.add_argument('--repeat', default=5, type=int)
+    p.set_defaults(func=bench_imports)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -1,7 +1,5 @@
 import numpy as np
 import argparse
-import matplotlib.pyplot as plt
-import seaborn as sns
  
 
 def read_file(path):
@@ -11,84 +9,100 @@ def read_file(path):
     return content
  
  
+def write_recognition(path, predicted, labels, sample_rate, chunk_size=65536):
+    '''
+    write the frame-wise recognition file read by func_eval.
+
+    :param predicted: class index of every (subsampled) frame, numpy array
+    :param labels: numpy array of the label names, indexed by class
+    :param sample_rate: every prediction stands for sample_rate frames
+    '''
+    recognition = np.repeat(labels[predicted], sample_rate)
+    with open(path, 'w') as f:
+        f.write("### Frame level recognition: ###\n")
+        for start in range(0, len(recognition), chunk_size):
+            if start:
+                f.write(' ')
+            f.write(' '.join(recognition[start:start + chunk_size]))
+
+
+def _segments(frame_wise_labels, bg_class=["background"]):
+    '''
+    :return: numpy arrays of the labels, starts and ends of the segments that are not background. The end
+             of a segment is the start of the next one, and the last frame for the last segment.
+    '''
+    frame_wise_labels = np.asarray(frame_wise_labels)
+    starts = np.flatnonzero(frame_wise_labels[1:] != frame_wise_labels[:-1]) + 1
+    ends = np.append(starts, len(frame_wise_labels) - 1)
+    starts = np.insert(starts, 0, 0)
+    labels = frame_wise_labels[starts]
+    keep = ~np.isin(labels, bg_class)
+    return labels[keep], starts[keep], ends[keep]
+
+
 def get_labels_start_end_time(frame_wise_labels, bg_class=["background"]):
-    labels = []
-    starts = []
-    ends = []
-    last_label = frame_wise_labels[0]
-    if frame_wise_labels[0] not in bg_class:
-        labels.append(frame_wise_labels[0])
-        starts.append(0)
-    for i in range(len(frame_wise_labels)):
-        if frame_wise_labels[i] != last_label:
-            if frame_wise_labels[i] not in bg_class:
-                labels.append(frame_wise_labels[i])
-                starts.append(i)
-            if last_label not in bg_class:
-                ends.append(i)
-            last_label = frame_wise_labels[i]
-    if last_label not in bg_class:
-        ends.append(i)
-    return labels, starts, ends
+    labels, starts, ends = _segments(frame_wise_labels, bg_class)
+    return labels.tolist(), starts.tolist(), ends.tolist()
  
  
 def levenstein(p, y, norm=False):
     m_row = len(p)    
     n_col = len(y)
-    D = np.zeros([m_row+1, n_col+1], np.float)
-    for i in range(m_row+1):
-        D[i, 0] = i
-    for i in range(n_col+1):
-        D[0, i] = i
- 
-    for j in range(1, n_col+1):
-        for i in range(1, m_row+1):
-            if y[j-1] == p[i-1]:
-                D[i, j] = D[i-1, j-1]
-            else:
-                D[i, j] = min(D[i-1, j] + 1,
-                              D[i, j-1] + 1,
-                              D[i-1, j-1] + 1)
+    p, y = np.asarray(p), np.asarray(y)
+    # row by row: D[i, j] = min_k<=j (T[k] + j - k), with T the costs from the row above, which is a
+    # running minimum of T - j
+    cols = np.arange(n_col + 1, dtype=float)
+    row = cols
+    for i in range(1, m_row + 1):
+        T = np.empty(n_col + 1)
+        T[0] = i
+        T[1:] = np.minimum(row[1:] + 1, row[:-1] + (y != p[i-1]))
+        row = np.minimum.accumulate(T - cols) + cols
      
     if norm:
-        score = (1 - D[-1, -1]/max(m_row, n_col)) * 100
+        score = (1 - row[-1]/max(m_row, n_col)) * 100
     else:
-        score = D[-1, -1]
+        score = row[-1]
  
     return score
  
  
 def edit_score(recognized, ground_truth, norm=True, bg_class=["background"]):
-    P, _, _ = get_labels_start_end_time(recognized, bg_class)
-    Y, _, _ = get_labels_start_end_time(ground_truth, bg_class)
+    P, _, _ = _segments(recognized, bg_class)
+    Y, _, _ = _segments(ground_truth, bg_class)
     return levenstein(P, Y, norm)
  
  
 def f_score(recognized, ground_truth, overlap, bg_class=["background"]):
-    p_label, p_start, p_end = get_labels_start_end_time(recognized, bg_class)
-    y_label, y_start, y_end = get_labels_start_end_time(ground_truth, bg_class)
- 
-    tp = 0
-    fp = 0
- 
-    hits = np.zeros(len(y_label))
- 
-    for j in range(len(p_label)):
-        intersection = np.minimum(p_end[j], y_end) - np.maximum(p_start[j], y_start)
-        union = np.maximum(p_end[j], y_end) - np.minimum(p_start[j], y_start)
-        IoU = (1.0*intersection / union)*([p_label[j] == y_label[x] for x in range(len(y_label))])
-        # Get the best scoring segment
-        idx = np.array(IoU).argmax()
- 
-        if IoU[idx] >= overlap and not hits[idx]:
-            tp += 1
-            hits[idx] = 1
-        else:
-            fp += 1
-    fn = len(y_label) - sum(hits)
-    return float(tp), float(fp), float(fn)
+    p_label, p_start, p_end = _segments(recognized, bg_class)
+    y_label, y_start, y_end = _segments(ground_truth, bg_class)
+    tp, fp, fn = _match_segments(p_label, p_start, p_end, y_label, y_start, y_end, [overlap])
+    return float(tp[0]), float(fp[0]), float(fn[0])
+
+
+def _match_segments(p_label, p_start, p_end, y_label, y_start, y_end, overlaps):
+    '''
+    every predicted segment matches the ground truth segment of the same label with the highest IoU. It is a
+    true positive if the IoU is at least the overlap, for the first such prediction of a ground truth segment.
+
+    :return: arrays of tp, fp and fn, one per overlap
+    '''
+    overlaps = np.asarray(overlaps)
+    if len(y_label) == 0:
+        return np.zeros(len(overlaps)), np.full(len(overlaps), float(len(p_label))), np.zeros(len(overlaps))
+    intersection = np.minimum(p_end[:, None], y_end) - np.maximum(p_start[:, None], y_start)
+    union = np.maximum(p_end[:, None], y_end) - np.minimum(p_start[:, None], y_start)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        IoU = (1.0*intersection / union) * (p_label[:, None] == y_label)
+    # Get the best scoring segment
+    idx = IoU.argmax(axis=1)
+    best = IoU[np.arange(len(p_label)), idx]
+    tp = np.array([len(np.unique(idx[best >= overlap])) for overlap in overlaps], dtype=float)
+    return tp, len(p_label) - tp, len(y_label) - tp
  
 def segment_bars(save_path, *labels):
+    import matplotlib.pyplot as plt
+
     num_pics = len(labels)
     color_map = plt.get_cmap('seismic')
     # color_map =
@@ -112,6 +126,8 @@ def segment_bars(save_path, *labels):
  
  
 def segment_bars_with_confidence(save_path, confidence, *labels):
+    import matplotlib.pyplot as plt
+
     num_pics = len(labels) + 1
     color_map = plt.get_cmap('seismic')
  
@@ -140,74 +156,96 @@ def segment_bars_with_confidence(save_path, confidence, *labels):
     plt.close()
  
  
-def func_eval(dataset, recog_path, file_list):
+def read_ground_truth(dataset, list_of_videos):
+    '''
+    :return: dict of the frame-wise ground truth labels (numpy) of the videos
+    '''
     ground_truth_path = "./data/" + dataset + "/groundTruth/"
-    mapping_file = "./data/" + dataset + "/mapping.txt"
-    list_of_videos = read_file(file_list).split('\n')[:-1]
- 
-    file_ptr = open(mapping_file, 'r')
-    actions = file_ptr.read().split('\n')[:-1]
-    file_ptr.close()
-    actions_dict = dict()
-    for a in actions:
-        actions_dict[a.split()[1]] = int(a.split()[0])
- 
-    overlap = [.1, .25, .5]
-    tp, fp, fn = np.zeros(3), np.zeros(3), np.zeros(3)
- 
-    correct = 0
-    total = 0
-    edit = 0
+    return {vid: np.array(read_file(ground_truth_path + vid).split('\n')[0:-1]) for vid in list_of_videos}
 
+
+class SegmentationMetrics(object):
+    '''
+    accumulates Acc, Edit and F1@overlaps over videos, from the frame-wise labels (label names or class indices):
+
+        metrics = SegmentationMetrics()
+        for recognized, ground_truth in videos:
+            metrics.update(recognized, ground_truth)
+        acc, edit, f1s = metrics.result()
+
+    :param bg_class: the background labels, class indices if the labels are
+    '''
+    def __init__(self, overlaps=(.1, .25, .5), bg_class=["background"]):
+        self.overlaps = list(overlaps)
+        self.bg_class = bg_class
+        self.tp, self.fp, self.fn = np.zeros(len(overlaps)), np.zeros(len(overlaps)), np.zeros(len(overlaps))
+        self.correct = 0
+        self.total = 0
+        self.edit = 0
+        self.num_videos = 0
+
+    def update(self, recognized, ground_truth):
+        '''
+        :param recognized: frame-wise recognition, compared with the ground truth on its first len(ground_truth) frames
+        :param ground_truth: frame-wise ground truth
+        '''
+        recognized, ground_truth = np.asarray(recognized), np.asarray(ground_truth)
+        self.total += len(ground_truth)
+        self.correct += np.count_nonzero(ground_truth == recognized[:len(ground_truth)])
+
+        p_label, p_start, p_end = _segments(recognized, self.bg_class)
+        y_label, y_start, y_end = _segments(ground_truth, self.bg_class)
+        self.edit += levenstein(p_label, y_label, True)
+ 
+        tp, fp, fn = _match_segments(p_label, p_start, p_end, y_label, y_start, y_end, self.overlaps)
+        self.tp += tp
+        self.fp += fp
+        self.fn += fn
+        self.num_videos += 1
+
+    def result(self):
+        '''
+        :return: acc, edit and the array of F1 scores, in percent
+        '''
+        acc = 100 * float(self.correct) / self.total
+        edit = (1.0 * self.edit) / self.num_videos
+        f1s = np.array([0] * len(self.overlaps), dtype=float)
+        for s in range(len(self.overlaps)):
+            precision = self.tp[s] / float(self.tp[s] + self.fp[s])
+            recall = self.tp[s] / float(self.tp[s] + self.fn[s])
+ 
+            f1 = 2.0 * (precision * recall) / (precision + recall)
+ 
+            f1 = np.nan_to_num(f1) * 100
+            f1s[s] = f1
+ 
+        return acc, edit, f1s
+
+
+def func_eval(dataset, recog_path, file_list, ground_truth=None):
+    '''
+    :param ground_truth: the labels of the videos as returned by read_ground_truth, read from the dataset if None
+    '''
+    list_of_videos = read_file(file_list).split('\n')[:-1]
+    if ground_truth is None:
+        ground_truth = read_ground_truth(dataset, list_of_videos)
  
+    metrics = SegmentationMetrics()
     for vid in list_of_videos:
- 
-         
-        gt_file = ground_truth_path + vid
-        gt_content = read_file(gt_file).split('\n')[0:-1]
- 
         recog_file = recog_path + vid.split('.')[0]
         recog_content = read_file(recog_file).split('\n')[1].split()
+        metrics.update(recog_content, ground_truth[vid])
  
+    return metrics.result()
 
-        for i in range(len(gt_content)):
-            total += 1
-            if gt_content[i] == recog_content[i]:
-                correct += 1
+cnt_split_dict = {
+    '50salads':5,
+    'gtea':4,
+    'breakfast':4
+}
 
-        edit += edit_score(recog_content, gt_content)
- 
-        for s in range(len(overlap)):
-            tp1, fp1, fn1 = f_score(recog_content, gt_content, overlap[s])
-            tp[s] += tp1
-            fp[s] += fp1
-            fn[s] += fn1
-     
-     
-    acc = 100 * float(correct) / total
-    edit = (1.0 * edit) / len(list_of_videos)
-#     print("Acc: %.4f" % (acc))
-#     print('Edit: %.4f' % (edit))
-    f1s = np.array([0, 0 ,0], dtype=float)
-    for s in range(len(overlap)):
-        precision = tp[s] / float(tp[s] + fp[s])
-        recall = tp[s] / float(tp[s] + fn[s])
- 
-        f1 = 2.0 * (precision * recall) / (precision + recall)
- 
-        f1 = np.nan_to_num(f1) * 100
-#         print('F1@%0.2f: %.4f' % (overlap[s], f1))
-        f1s[s] = f1
- 
-    return acc, edit, f1s
 
 def main():
-    cnt_split_dict = {
-        '50salads':5,
-        'gtea':4,
-        'breakfast':4
-    }
-    
     parser = argparse.ArgumentParser()
  
     parser.add_argument('--dataset', default="gtea")
@@ -0,0 +1,106 @@
+'''
+    Evaluates many (dataset, split, result_dir) combinations in parallel, e.g. all checkpoints of a night:
+
+        python eval_runner.py --datasets breakfast gtea --splits 0 --result_dirs results_a results_b --csv out.csv
+
+    The ground truth of the datasets is read once, before the worker processes start, and the table of
+    Acc/Edit/F1@{10,25,50} is printed and optionally written as JSON and CSV. Split 0 evaluates all splits of a
+    dataset and adds their average (split 'avg'), as eval.py does.
+'''
+
+import argparse
+import csv
+import itertools
+import json
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from eval import cnt_split_dict, func_eval, read_file, read_ground_truth
+
+
+FIELDS = ['dataset', 'split', 'result_dir', 'acc', 'edit', 'f1@10', 'f1@25', 'f1@50']
+
+_ground_truth = {}  # dataset -> ground truth of the videos of its test splits, in the worker processes
+
+
+def _test_list(dataset, split):
+    return "./data/" + dataset + "/splits/test.split{}".format(split) + ".bundle"
+
+
+def load_ground_truth(dataset):
+    videos = set()
+    for split in range(1, cnt_split_dict[dataset] + 1):
+        videos.update(read_file(_test_list(dataset, split)).split('\n')[:-1])
+    return read_ground_truth(dataset, sorted(videos))
+
+
+def _init_worker(ground_truth):
+    global _ground_truth
+    _ground_truth = ground_truth
+
+
+def _evaluate(dataset, split, result_dir):
+    recog_path = "./{}/".format(result_dir) + dataset + "/split_{}".format(split) + "/"
+    acc, edit, f1s = func_eval(dataset, recog_path, _test_list(dataset, split), _ground_truth[dataset])
+    return dict(zip(FIELDS, [dataset, split, result_dir, acc, float(edit)] + [float(f1) for f1 in f1s]))
+
+
+def run(datasets, splits, result_dirs, num_workers=4):
+    '''
+    :param splits: split numbers, 0 for all splits of the dataset and their average
+    :return: a list of rows (dicts of FIELDS)
+    '''
+    ground_truth = {dataset: load_ground_truth(dataset) for dataset in datasets}
+    jobs = []
+    for dataset, result_dir in itertools.product(datasets, result_dirs):
+        for split in splits:
+            dataset_splits = range(1, cnt_split_dict[dataset] + 1) if split == 0 else [split]
+            jobs += [(dataset, s, result_dir) for s in dataset_splits if (dataset, s, result_dir) not in jobs]
+
+    if num_workers > 0:
+        with ProcessPoolExecutor(num_workers, initializer=_init_worker, initargs=(ground_truth,)) as pool:
+            results = list(pool.map(_evaluate, *zip(*jobs)))
+    else:
+        _init_worker(ground_truth)
+        results = [_evaluate(*job) for job in jobs]
+
+    rows = []
+    for dataset, result_dir in itertools.product(datasets, result_dirs):
+        dataset_rows = sorted([r for r in results if r['dataset'] == dataset and r['result_dir'] == result_dir],
+                              key=lambda r: r['split'])
+        rows += dataset_rows
+        if 0 in splits:
+            all_splits = [r for r in dataset_rows if r['split'] in range(1, cnt_split_dict[dataset] + 1)]
+            avg = {field: float(np.mean([r[field] for r in all_splits])) for field in FIELDS[3:]}
+            rows.append(dict(dataset=dataset, split='avg', result_dir=result_dir, **avg))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--datasets', default=['gtea'], nargs='+')
+    parser.add_argument('--splits', default=[0], type=int, nargs='+', help='0 for all splits and their average')
+    parser.add_argument('--result_dirs', default=['results'], nargs='+')
+    parser.add_argument('--num_workers', default=4, type=int, help='0 evaluates in this process')
+    parser.add_argument('--json', default=None, help='write the table to this JSON file')
+    parser.add_argument('--csv', default=None, help='write the table to this CSV file')
+    args = parser.parse_args()
+
+    rows = run(args.datasets, args.splits, args.result_dirs, args.num_workers)
+
+    print('%-10s %5s %-20s %8s %8s %8s %8s %8s' % tuple(FIELDS))
+    for row in rows:
+        print('%-10s %5s %-20s %8.4f %8.4f %8.4f %8.4f %8.4f' % tuple(row[field] for field in FIELDS))
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(rows, f, indent=2)
+    if args.csv is not None:
+        with open(args.csv, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+if __name__ == '__main__':
+    main()
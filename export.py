@@ -0,0 +1,70 @@
+'''
+    Export of a trained MyTransformer for inference (main.py --action export), run by serve.py with torch and
+    numpy only:
+
+        export(trainer.model, 'epoch-120.pt2', labels, sample_rate)
+
+    The torch.export program maps the features x of shape (1, input_dim, L) and the mask of shape
+    (1, num_classes, L) to the class scores of the frames (see MyTransformer.classify), in float32. L is a
+    multiple of the longest block of the attention layers (block_length), of at least min_blocks blocks: serve.py
+    pads the videos with masked frames, and the symbolic sizes stay products of L, which are fast to load. The
+    program is saved with its metadata (the label names, the sample rate, block_length, min_blocks), or compiled
+    ahead of time by AOTInductor, which takes minutes and a C++ compiler but loads several times faster.
+    The attention layers are exported with their chunk_size reset to None.
+'''
+
+import copy
+import json
+
+import torch
+import torch.nn as nn
+
+
+class _Inference(nn.Module):
+    def __init__(self, model):
+        super(_Inference, self).__init__()
+        self.model = model
+
+    def forward(self, x, mask):
+        return self.model.classify(self.model(x, mask))
+
+
+def _block_length(model):
+    # the longest block of the attention layers
+    return max(module.bl for module in model.modules() if hasattr(module, 'bl'))
+
+
+def _min_blocks(program):
+    # the sliding window of the longest block specializes on more than one block, the lower bound of the
+    # number of blocks (the only free symbol of the range constraints)
+    return max([int(r.lower) for size, r in program.range_constraints.items() if size.is_Symbol] + [1])
+
+
+def export(model, path, labels, sample_rate=1, compiled=False):
+    '''
+    :param labels: the label names, indexed by class
+    :param sample_rate: the temporal subsampling of the features the model was trained on
+    :param compiled: save an AOTInductor package instead of the program
+    :return: the ExportedProgram
+    '''
+    model = copy.deepcopy(model).eval()
+    model.set_amp(None)
+    model.set_chunk_size(None)
+    input_dim = model.encoder.conv_1x1.in_channels
+    num_classes = model.encoder.conv_out.out_channels
+    model_device = next(model.parameters()).device
+    block = _block_length(model)
+    x = torch.randn(1, input_dim, 2 * block, device=model_device)
+    mask = torch.ones(1, num_classes, 2 * block, device=model_device)
+    length = block * torch.export.Dim('blocks', min=1)
+    with torch.no_grad():
+        program = torch.export.export(_Inference(model), (x, mask), dynamic_shapes=({2: length}, {2: length}))
+    meta = json.dumps({'input_dim': input_dim, 'num_classes': num_classes, 'block_length': block,
+                       'min_blocks': _min_blocks(program), 'labels': list(labels), 'sample_rate': sample_rate,
+                       'device': str(model_device)})
+    if compiled:
+        torch._inductor.aoti_compile_and_package(program, package_path=path,
+                                                 inductor_configs={'aot_inductor.metadata': {'meta.json': meta}})
+    else:
+        torch.export.save(program, path, extra_files={'meta.json': meta})
+    return program
@@ -4,7 +4,6 @@
     It can serve as a strong data augmentation for action segnemtation task by setting the 'if_warp=True' in batch_gen.BatchGenerator.next_batch. We do not use this trick in our paper, but it does give better results :).
 '''
 import numpy as np
-from scipy.stats import truncnorm
 import torch.nn.functional as TF
 import torch.nn as nn
 
@@ -38,6 +37,8 @@ class GridSampler():
         self.high = high
 
     def sample(self, batchsize=1):
+        from scipy.stats import truncnorm
+
         num_centers = np.random.randint(low=self.low, high=self.high)
         lower, upper = 0, 1
         mu, sigma = np.random.rand(num_centers), 1 / (num_centers * 1.5)  # * 1.5
@@ -7,35 +7,97 @@ import torch.nn.init as init
 import hyptorch.pmath as pmath
 
 
-class HyperbolicMLR(nn.Module):
+class _WeightCache(object):
+    """
+    Mixin for modules whose forward derives tensors from their own weights only. In eval mode these tensors
+    are computed once and kept in non-persistent buffers, until a weight changes (optimizer steps and
+    load_state_dict update them in place, which bumps their version), moves to another dtype or device, the
+    module is switched with train() or the curvature differs. The cache is not used when gradients to the weights are needed,
+    nor while the module is traced by torch.compile or torch.export. Changes through ``weight.data`` are not tracked, call
+    clear_cache() after them.
+    """
+
+    def _init_cache(self, *names):
+        self._cache_names = names
+        self._cache_key = None
+        for name in names:
+            self.register_buffer(name, None, persistent=False)
+
+    def clear_cache(self):
+        for name in self._cache_names:
+            setattr(self, name, None)
+        self._cache_key = None
+
+    def train(self, mode=True):
+        self.clear_cache()
+        return super(_WeightCache, self).train(mode)
+
+    def _cache_weights(self):
+        # the weights the cached tensors derive from
+        return list(self.parameters(recurse=False))
+
+    def _use_cache(self):
+        weights = self._cache_weights()
+        if self.training or torch.compiler.is_compiling():
+            return False
+        return not (torch.is_grad_enabled() and any(p.requires_grad for p in weights))
+
+    def _cached(self, c, compute):
+        """
+        :param compute: function computing the tuple of tensors to cache, in the order of the names
+        :return: the cached tensors, recomputed if the weights or c changed since
+        """
+        key = (c.item() if torch.is_tensor(c) else c,) + tuple((id(p), p._version, p.dtype, p.device) for p in self._cache_weights())
+        if key != self._cache_key:
+            for name, value in zip(self._cache_names, compute()):
+                setattr(self, name, value.detach())
+            self._cache_key = key
+        return tuple(getattr(self, name) for name in self._cache_names)
+
+
+class HyperbolicMLR(_WeightCache, nn.Module):
     """
     Module which performs softmax classification
     in Hyperbolic space.
+
+    The logits are computed for tiles of tile_size points at a time (all at once if None), from the Gram
+    matrices with the class parameters, so that the memory is O(tile_size * n_classes).
     """
 
-    def __init__(self, ball_dim, n_classes, c):
+    def __init__(self, ball_dim, n_classes, c, tile_size=None):
         super(HyperbolicMLR, self).__init__()
         self.a_vals = nn.Parameter(torch.Tensor(n_classes, ball_dim))
         self.p_vals = nn.Parameter(torch.Tensor(n_classes, ball_dim))
         self.c = c
         self.n_classes = n_classes
         self.ball_dim = ball_dim
+        self.tile_size = tile_size
+        # eval mode cache of the class terms
+        self._init_cache("p_vals_poincare", "a_vals_poincare", "p2", "a_norm", "k", "pa")
         self.reset_parameters()
 
+    @pmath.upcast_inputs
     def forward(self, x, c=None):
         if c is None:
-            c = torch.as_tensor(self.c).type_as(x)
+            c = self.c
+        c_key = c
+        c = torch.as_tensor(c).type_as(x)
+        if self._use_cache():
+            terms = self._cached(c_key, lambda: self._class_terms(c))
         else:
-            c = torch.as_tensor(c).type_as(x)
+            terms = self._class_terms(c)
+        p_vals_poincare, a_vals_poincare, p2, a_norm, k, pa = terms
+        return pmath._hyperbolic_softmax_tiles(x, a_vals_poincare, p_vals_poincare, p2, a_norm, k, pa, c, self.tile_size)
+
+    def _class_terms(self, c):
         p_vals_poincare = pmath.expmap0(self.p_vals, c=c)
         conformal_factor = 1 - c * p_vals_poincare.pow(2).sum(dim=1, keepdim=True)
         a_vals_poincare = self.a_vals * conformal_factor
-        logits = pmath._hyperbolic_softmax(x, a_vals_poincare, p_vals_poincare, c)
-        return logits
+        return (p_vals_poincare, a_vals_poincare) + pmath._hyperbolic_softmax_class_terms(a_vals_poincare, p_vals_poincare, c)
 
     def extra_repr(self):
-        return "Poincare ball dim={}, n_classes={}, c={}".format(
-            self.ball_dim, self.n_classes, self.c
+        return "Poincare ball dim={}, n_classes={}, c={}, tile_size={}".format(
+            self.ball_dim, self.n_classes, self.c, self.tile_size
         )
 
     def reset_parameters(self):
@@ -43,7 +105,7 @@ class HyperbolicMLR(nn.Module):
         init.kaiming_uniform_(self.p_vals, a=math.sqrt(5))
 
 
-class HypLinear(nn.Module):
+class HypLinear(_WeightCache, nn.Module):
     def __init__(self, in_features, out_features, c, bias=True):
         super(HypLinear, self).__init__()
         self.in_features = in_features
@@ -54,6 +116,8 @@ class HypLinear(nn.Module):
             self.bias = nn.Parameter(torch.Tensor(out_features))
         else:
             self.register_parameter("bias", None)
+        # eval mode cache of expmap0(bias)
+        self._init_cache("bias_point")
         self.reset_parameters()
 
     def reset_parameters(self):
@@ -67,15 +131,14 @@ class HypLinear(nn.Module):
             bound = 1 / math.sqrt(fan_in)
             init.uniform_(self.bias, -bound, bound)
 
+    @pmath.upcast_inputs
     def forward(self, x, c=None):
         if c is None:
             c = self.c
-        mv = pmath.mobius_matvec(self.weight, x, c=c)
-        if self.bias is None:
-            return pmath.project(mv, c=c)
-        else:
-            bias = pmath.expmap0(self.bias, c=c)
-            return pmath.project(pmath.mobius_add(mv, bias), c=c)
+        if self.bias is not None and self._use_cache():
+            bias_point, = self._cached(c, lambda: (pmath.expmap0(self.bias, c=c),))
+            return pmath._hyp_linear_point(x, self.weight, bias_point, torch.as_tensor(c).type_as(x))
+        return pmath.hyp_linear(x, self.weight, self.bias, c=c)
 
     def extra_repr(self):
         return "in_features={}, out_features={}, bias={}, c={}".format(
@@ -94,6 +157,7 @@ class ConcatPoincareLayer(nn.Module):
         self.l2 = HypLinear(d2, d_out, bias=False, c=c)
         self.c = c
 
+    @pmath.upcast_inputs
     def forward(self, x1, x2, c=None):
         if c is None:
             c = self.c
@@ -108,6 +172,7 @@ class HyperbolicDistanceLayer(nn.Module):
         super(HyperbolicDistanceLayer, self).__init__()
         self.c = c
 
+    @pmath.upcast_inputs
     def forward(self, x1, x2, c=None):
         if c is None:
             c = self.c
@@ -142,21 +207,21 @@ class ToPoincare(nn.Module):
             self.c = c
 
         self.train_x = train_x
+        self.riemannian = riemannian
 
-        self.riemannian = pmath.RiemannianGradient
-        self.riemannian.c = c
-
-        if riemannian:
-            self.grad_fix = lambda x: self.riemannian.apply(x)
-        else:
-            self.grad_fix = lambda x: x
-
+    @pmath.upcast_inputs
     def forward(self, x):
 
         if self.train_x:
             xp = pmath.project(pmath.expmap0(self.xp, c=self.c), c=self.c)
             return self.grad_fix(pmath.project(pmath.expmap(xp, x, c=self.c), c=self.c))
-        return self.grad_fix(pmath.project(pmath.expmap0(x, c=self.c), c=self.c))
+        return self.grad_fix(pmath.expmap0_project(x, c=self.c))
+
+    def grad_fix(self, x):
+        # identity, which rescales the gradient to the Riemannian one if riemannian
+        if self.riemannian:
+            return pmath.RiemannianGradient.apply(x, self.c)
+        return x
 
     def extra_repr(self):
         return "c={}, train_x={}".format(self.c, self.train_x)
@@ -191,6 +256,7 @@ class FromPoincare(nn.Module):
         self.train_c = train_c
         self.train_x = train_x
 
+    @pmath.upcast_inputs
     def forward(self, x):
         if self.train_x:
             xp = pmath.project(pmath.expmap0(self.xp, c=self.c), c=self.c)
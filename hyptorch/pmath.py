@@ -3,12 +3,51 @@ Implementation of various mathematical operations in the Poincare ball model of
 functions are based on the implementation in https://github.com/geoopt/geoopt (copyright by Maxim Kochurov).
 """
 
+import contextlib
+import functools
+from typing import Optional
+
 import numpy as np
 import torch
-from scipy.special import gamma
 
 
-def tanh(x, clamp=15):
+# the ops clamp the points this close to the boundary of the ball (artanh, the mobius denominators)
+BOUNDARY_EPS = 1e-5
+
+
+def upcast(x):
+    """
+    x in float32 if its floating point type cannot resolve 1 - BOUNDARY_EPS (float16 and bfloat16, where the
+    clamps round to the boundary and artanh to inf), x itself otherwise.
+    """
+    if torch.is_tensor(x) and x.is_floating_point() and torch.finfo(x.dtype).eps > BOUNDARY_EPS:
+        return x.float()
+    return x
+
+
+def _autocast_disabled():
+    stack = contextlib.ExitStack()
+    for device_type in ("cpu", "cuda"):
+        if torch.is_autocast_enabled(device_type):
+            stack.enter_context(torch.autocast(device_type, enabled=False))
+    return stack
+
+
+def upcast_inputs(fn):
+    """
+    Decorator for the hyperbolic ops and modules: fn runs outside of autocast, with its half precision tensor
+    arguments upcast (see :func:`upcast`), so that its results are float32 under mixed precision.
+    """
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        args = [upcast(arg) for arg in args]
+        kwargs = {name: upcast(arg) for name, arg in kwargs.items()}
+        with _autocast_disabled():
+            return fn(*args, **kwargs)
+    return wrapper
+
+
+def tanh(x, clamp: float = 15):
     return x.clamp(-clamp, clamp).tanh()
 
 
@@ -29,11 +68,10 @@ class Artanh(torch.autograd.Function):
 
 class RiemannianGradient(torch.autograd.Function):
 
-    c = 1
-
     @staticmethod
-    def forward(ctx, x):
+    def forward(ctx, x, c=1.0):
         ctx.save_for_backward(x)
+        ctx.c = c
         return x
 
     @staticmethod
@@ -41,8 +79,8 @@ class RiemannianGradient(torch.autograd.Function):
         (x,) = ctx.saved_tensors
         # x: B x d
 
-        scale = (1 - RiemannianGradient.c * x.pow(2).sum(-1, keepdim=True)).pow(2) / 4
-        return grad_output * scale
+        scale = (1 - ctx.c * x.pow(2).sum(-1, keepdim=True)).pow(2) / 4
+        return grad_output * scale, None
 
 
 # -
@@ -73,6 +111,7 @@ def arcosh(x, eps=1e-5):  # pragma: no cover
     return torch.log(x + torch.sqrt(1 + x) * torch.sqrt(x - 1))
 
 
+@upcast_inputs
 def project(x, *, c=1.0):
     r"""
     Safe projection on the manifold for numerical stability. This was mentioned in [1]_
@@ -103,6 +142,7 @@ def _project(x, c):
     return torch.where(cond, projected, x)
 
 
+@upcast_inputs
 def lambda_x(x, *, c=1.0, keepdim=False):
     r"""
     Compute the conformal factor :math:`\lambda^c_x` for a point on the ball
@@ -129,6 +169,7 @@ def _lambda_x(x, c, keepdim: bool = False):
     return 2 / (1 - c * x.pow(2).sum(-1, keepdim=keepdim))
 
 
+@upcast_inputs
 def mobius_add(x, y, *, c=1.0):
     r"""
     Mobius addition is a special operation in a hyperbolic space.
@@ -177,6 +218,7 @@ def _mobius_add(x, y, c):
     return num / (denom + 1e-5)
 
 
+@upcast_inputs
 def dist(x, y, *, c=1.0, keepdim=False):
     r"""
     Distance on the Poincare ball
@@ -208,6 +250,7 @@ def _dist(x, y, c, keepdim: bool = False):
     return dist_c * 2 / sqrt_c
 
 
+@upcast_inputs
 def dist0(x, *, c=1.0, keepdim=False):
     r"""
     Distance on the Poincare ball to zero
@@ -234,6 +277,7 @@ def _dist0(x, c, keepdim: bool = False):
     return dist_c * 2 / sqrt_c
 
 
+@upcast_inputs
 def expmap(x, u, *, c=1.0):
     r"""
     Exponential map for Poincare ball model. This is tightly related with :func:`geodesic`.
@@ -277,6 +321,7 @@ def _expmap(x, u, c):  # pragma: no cover
     return gamma_1
 
 
+@upcast_inputs
 def expmap0(u, *, c=1.0):
     r"""
     Exponential map for Poincare ball model from :math:`0`.
@@ -306,6 +351,7 @@ def _expmap0(u, c):
     return gamma_1
 
 
+@upcast_inputs
 def logmap(x, y, *, c=1.0):
     r"""
     Logarithmic map for two points :math:`x` and :math:`y` on the manifold.
@@ -341,6 +387,7 @@ def _logmap(x, y, c):  # pragma: no cover
     return 2 / sqrt_c / lam * artanh(sqrt_c * sub_norm) * sub / sub_norm
 
 
+@upcast_inputs
 def logmap0(y, *, c=1.0):
     r"""
     Logarithmic map for :math:`y` from :math:`0` on the manifold.
@@ -370,6 +417,7 @@ def _logmap0(y, c):
     return y / y_norm / sqrt_c * artanh(sqrt_c * y_norm)
 
 
+@upcast_inputs
 def mobius_matvec(m, x, *, c=1.0):
     r"""
     Generalization for matrix-vector multiplication to hyperbolic space defined as
@@ -398,7 +446,7 @@ def _mobius_matvec(m, x, c):
     x_norm = torch.clamp_min(x.norm(dim=-1, keepdim=True, p=2), 1e-5)
     sqrt_c = c ** 0.5
     mx = x @ m.transpose(-1, -2)
-    mx_norm = mx.norm(dim=-1, keepdim=True, p=2)
+    mx_norm = torch.clamp_min(mx.norm(dim=-1, keepdim=True, p=2), 1e-5)
     res_c = tanh(mx_norm / x_norm * artanh(sqrt_c * x_norm)) * mx / (mx_norm * sqrt_c)
     cond = (mx == 0).prod(-1, keepdim=True, dtype=torch.uint8)
     res_0 = torch.zeros(1, dtype=res_c.dtype, device=res_c.device)
@@ -406,6 +454,120 @@ def _mobius_matvec(m, x, c):
     return _project(res, c)
 
 
+@upcast_inputs
+def expmap0_project(u, *, c=1.0):
+    r"""
+    Fused ``project(expmap0(u))``. The norm of :math:`\operatorname{Exp}^c_0(u)` is
+    :math:`\tanh(\sqrt{c}\|u\|_2)/\sqrt{c}`, so the map and the projection are one scaling of :math:`u`
+    computed from a single norm.
+    Parameters
+    ----------
+    u : tensor
+        speed vector on poincare ball
+    c : float|tensor
+        ball negative curvature
+    Returns
+    -------
+    tensor
+        projected :math:`\gamma_{0, u}(1)` end point
+    """
+    c = torch.as_tensor(c).type_as(u)
+    return _expmap0_project(u, c)
+
+
+def _expmap0_project(u, c):
+    sqrt_c = c ** 0.5
+    maxnorm = (1 - 1e-3) / sqrt_c
+    u_norm = torch.clamp_min(u.norm(dim=-1, p=2, keepdim=True), 1e-5)
+    gamma_norm = tanh(sqrt_c * u_norm) / sqrt_c
+    return u * (torch.minimum(gamma_norm, maxnorm) / u_norm)
+
+
+@upcast_inputs
+def hyp_linear(x, weight, bias=None, *, c=1.0):
+    r"""
+    Fused hyperbolic linear layer, ``project(mobius_add(mobius_matvec(weight, x), expmap0(bias)))``.
+    Every step is a combination of :math:`Mx` and the bias point with per-row coefficients, which are
+    computed from :math:`\|x\|_2`, :math:`\|Mx\|_2` and :math:`\langle Mx, b\rangle` only: there is a single
+    (B, out_features) intermediate and no norm is computed twice. In training the backward pass recomputes the
+    forward from the inputs (:class:`HypLinearFunction`), so no intermediate is kept for it.
+    Parameters
+    ----------
+    x : tensor
+        points on poincare ball, of shape (..., in_features)
+    weight : tensor
+        matrix of shape (out_features, in_features)
+    bias : tensor|None
+        euclidean bias of shape (out_features,), mapped to the ball with expmap0
+    c : float|tensor
+        negative ball curvature
+    Returns
+    -------
+    tensor
+        points on poincare ball, of shape (..., out_features)
+    """
+    c = torch.as_tensor(c).type_as(x)
+    if torch.is_grad_enabled() and any(t is not None and t.requires_grad for t in (x, weight, bias)):
+        return HypLinearFunction.apply(x, weight, bias, c)
+    return _hyp_linear(x, weight, bias, c)
+
+
+def _hyp_linear(x, weight, bias: Optional[torch.Tensor], c):
+    if bias is None:
+        return _hyp_linear_point(x, weight, None, c)
+    return _hyp_linear_point(x, weight, _expmap0(bias, c), c)
+
+
+def _hyp_linear_point(x, weight, b: Optional[torch.Tensor], c):
+    # _hyp_linear with the bias point b = expmap0(bias) on the ball
+    sqrt_c = c ** 0.5
+    maxnorm = (1 - 1e-3) / sqrt_c
+    x_norm = torch.clamp_min(x.norm(dim=-1, p=2, keepdim=True), 1e-5)
+    mx = x @ weight.transpose(-1, -2)
+    mx_norm = mx.norm(dim=-1, p=2, keepdim=True)
+    # mobius_matvec and its projection: mv = scale * mx, of norm scale * |mx|
+    t = mx_norm.clamp_min(1e-5) / x_norm * torch.atanh((sqrt_c * x_norm).clamp(-1 + 1e-5, 1 - 1e-5))
+    scale = torch.minimum(tanh(t) / sqrt_c, maxnorm) / mx_norm.clamp_min(1e-5)
+    if b is None:
+        return mx * scale
+
+    # mobius_add(mv, b) = alpha * mx + beta * b
+    mx2 = mx_norm.pow(2)
+    mxb = (mx @ b).unsqueeze(-1)
+    x2 = scale.pow(2) * mx2
+    y2 = b.pow(2).sum()
+    xy = scale * mxb
+    denom = 1 + 2 * c * xy + c ** 2 * x2 * y2 + 1e-5
+    alpha = (1 + 2 * c * xy + c * y2) * scale / denom
+    beta = (1 - c * x2) / denom
+    # and its projection
+    out_norm = torch.sqrt(torch.clamp_min(alpha.pow(2) * mx2 + 2 * alpha * beta * mxb + beta.pow(2) * y2, 1e-10))
+    shrink = torch.clamp_max(maxnorm / out_norm, 1)
+    return (alpha * shrink) * mx + (beta * shrink) * b
+
+
+class HypLinearFunction(torch.autograd.Function):
+    """
+    :func:`hyp_linear` that only saves its inputs, and recomputes the forward pass in the backward pass.
+    """
+    @staticmethod
+    def forward(ctx, x, weight, bias, c):
+        ctx.save_for_backward(x, weight, bias, c)
+        return _hyp_linear(x, weight, bias, c)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        x, weight, bias, c = ctx.saved_tensors
+        inputs = [x, weight, bias]
+        needs_grad = [t is not None and need for t, need in zip(inputs, ctx.needs_input_grad[:3])]
+        with torch.enable_grad():
+            inputs = [t.detach().requires_grad_(need) if t is not None else None for t, need in zip(inputs, needs_grad)]
+            out = _hyp_linear(inputs[0], inputs[1], inputs[2], c)
+            grads = torch.autograd.grad(out, [t for t, need in zip(inputs, needs_grad) if need], grad_output)
+        grads = iter(grads)
+        return tuple(next(grads) if need else None for need in needs_grad) + (None,)
+
+
 def _tensor_dot(x, y):
     res = torch.einsum("ij,kj->ik", (x, y))
     return res
@@ -425,13 +587,48 @@ def _mobius_addition_batch(x, y, c):
     return res
 
 
-def _hyperbolic_softmax(X, A, P, c):
-    lambda_pkc = 2 / (1 - c * P.pow(2).sum(dim=1))
-    k = lambda_pkc * torch.norm(A, dim=1) / torch.sqrt(c)
-    mob_add = _mobius_addition_batch(-P, X, c)
-    num = 2 * torch.sqrt(c) * torch.sum(mob_add * A.unsqueeze(1), dim=-1)
-    denom = torch.norm(A, dim=1, keepdim=True) * (1 - c * mob_add.pow(2).sum(dim=2))
-    logit = k.unsqueeze(1) * arsinh(num / denom)
+def _hyperbolic_softmax(X, A, P, c, tile_size: Optional[int] = None):
+    P2, A_norm, k, PA = _hyperbolic_softmax_class_terms(A, P, c)
+    return _hyperbolic_softmax_tiles(X, A, P, P2, A_norm, k, PA, c, tile_size)
+
+
+def _hyperbolic_softmax_class_terms(A, P, c):
+    # the class terms, once for all the tiles of frames
+    P2 = P.pow(2).sum(dim=1, keepdim=True)  # C x 1
+    A_norm = torch.norm(A, dim=1, keepdim=True)  # C x 1
+    lambda_pkc = 2 / (1 - c * P2)
+    k = lambda_pkc * A_norm / torch.sqrt(c)
+    PA = (P * A).sum(dim=1, keepdim=True)  # C x 1
+    return P2, A_norm, k, PA
+
+
+def _hyperbolic_softmax_tiles(X, A, P, P2, A_norm, k, PA, c, tile_size: Optional[int] = None):
+    if tile_size is None or torch.compiler.is_compiling():
+        # one tile. Traced by torch.export (see export.py), a loop over the symbolic number of frames would
+        # specialize it to the example
+        return _hyperbolic_softmax_tile(X, A, P, P2, A_norm, k, PA, c)
+    logits = [_hyperbolic_softmax_tile(X[i:i + tile_size], A, P, P2, A_norm, k, PA, c) for i in range(0, X.shape[0], tile_size)]
+    return torch.cat(logits) if len(logits) else X.new_zeros(0, A.shape[0])
+
+
+def _hyperbolic_softmax_tile(X, A, P, P2, A_norm, k, PA, c):
+    # <(-p) (+) x, a> and |(-p) (+) x|^2 from the Gram matrices, without the C x B x D mobius addition
+    X2 = X.pow(2).sum(dim=1)  # B
+    PX = P @ X.transpose(0, 1)  # C x B
+    AX = A @ X.transpose(0, 1)  # C x B
+    alpha = 1 - 2 * c * PX + c * X2
+    beta = 1 - c * P2
+    denom_add = 1 - 2 * c * PX + c ** 2 * P2 * X2 + 1e-5
+    mob_add_a = (beta * AX - alpha * PA) / denom_add
+    mob_add2 = (alpha.pow(2) * P2 - 2 * alpha * beta * PX + beta.pow(2) * X2) / denom_add.pow(2)
+    num = 2 * torch.sqrt(c) * mob_add_a
+    denom = A_norm * (1 - c * mob_add2)
+    if torch.jit.is_scripting():
+        # the forward of Arsinh, whose autograd Function cannot be scripted
+        z = num / denom
+        logit = k * torch.log(torch.clamp_min(z + torch.sqrt(1 + z.pow(2)), 1e-5))
+    else:
+        logit = k * arsinh(num / denom)
     return logit.permute(1, 0)
 
 
@@ -445,6 +642,7 @@ def k2p(x, c):
     return x / denom
 
 
+@upcast_inputs
 def lorenz_factor(x, *, c=1.0, dim=-1, keepdim=False):
     """
 
@@ -467,6 +665,7 @@ def lorenz_factor(x, *, c=1.0, dim=-1, keepdim=False):
     return 1 / torch.sqrt(1 - c * x.pow(2).sum(dim=dim, keepdim=keepdim))
 
 
+@upcast_inputs
 def poincare_mean(x, dim=0, c=1.0):
     x = p2k(x, c)
     lamb = lorenz_factor(x, c=c, keepdim=True)
@@ -477,18 +676,92 @@ def poincare_mean(x, dim=0, c=1.0):
     return mean.squeeze(dim)
 
 
-def _dist_matrix(x, y, c):
-    sqrt_c = c ** 0.5
-    return (
-        2
-        / sqrt_c
-        * artanh(sqrt_c * torch.norm(_mobius_addition_batch(-x, y, c=c), dim=-1))
-    )
+def _dist_matrix_block(x, y, x2, y2, c):
+    # |(-x) (+) y|^2 = |x - y|^2 * D0 / (D0 + eps)^2 with D0 = 1 - 2c<x, y> + c^2 |x|^2 |y|^2, from the Gram matrix
+    gram = x @ y.transpose(0, 1)
+    sq_norms = x2.unsqueeze(1) + y2.unsqueeze(0)
+    sq_dist = sq_norms - 2 * gram
+    # below the rounding error of the Gram form the points are taken as equal, with distance 0 and gradient 0
+    sq_dist = torch.where(sq_dist > 8 * torch.finfo(x.dtype).eps * sq_norms, sq_dist, torch.zeros_like(sq_dist))
+    denom = torch.clamp_min(1 - 2 * c * gram + c ** 2 * x2.unsqueeze(1) * y2.unsqueeze(0), 0)
+    norm = torch.sqrt(sq_dist * denom) / (denom + 1e-5)
+    z = torch.clamp(c ** 0.5 * norm, -1 + 1e-5, 1 - 1e-5)
+    return sq_dist, denom, z
 
 
-def dist_matrix(x, y, c=1.0):
+class DistMatrixFunction(torch.autograd.Function):
+    """
+    :func:`dist_matrix` in blocks of rows of x, with an analytic backward pass. Only x and y are saved, the
+    backward pass recomputes the (block_size, C) Gram terms.
+    """
+    @staticmethod
+    def forward(ctx, x, y, c, block_size):
+        ctx.save_for_backward(x, y, c)
+        ctx.block_size = block_size
+        x2, y2 = x.pow(2).sum(-1), y.pow(2).sum(-1)
+        out = []
+        for i in range(0, len(x), block_size):
+            _, _, z = _dist_matrix_block(x[i:i + block_size], y, x2[i:i + block_size], y2, c)
+            out.append(torch.atanh(z) * 2 / c ** 0.5)
+        return torch.cat(out) if out else x.new_zeros(0, len(y))
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        x, y, c = ctx.saved_tensors
+        block_size = ctx.block_size
+        x2, y2 = x.pow(2).sum(-1), y.pow(2).sum(-1)
+        grad_x = torch.zeros_like(x)
+        grad_y = torch.zeros_like(y)
+        grad_y2 = torch.zeros_like(y2)
+        for i in range(0, len(x), block_size):
+            xb, x2b = x[i:i + block_size], x2[i:i + block_size]
+            sq_dist, denom, z = _dist_matrix_block(xb, y, x2b, y2, c)
+            # d dist / d norm, as the backward pass of Artanh (on the clamped input)
+            grad_norm = grad_output[i:i + block_size] * 2 / (1 - z.pow(2))
+            dist_e = torch.sqrt(sq_dist)
+            sqrt_d = torch.sqrt(denom)
+            # norm = dist_e * sqrt_d / (denom + eps); the derivative in sq_dist is 0 for x == y, as for a zero norm
+            grad_sq = torch.where(dist_e > 0, grad_norm * sqrt_d / (2 * dist_e.clamp_min(1e-30) * (denom + 1e-5)), torch.zeros_like(dist_e))
+            grad_denom = grad_norm * dist_e * (1e-5 - denom) / (2 * sqrt_d.clamp_min(1e-30) * (denom + 1e-5).pow(2))
+            grad_gram = -2 * grad_sq - 2 * c * grad_denom
+            grad_x2 = (grad_sq + c ** 2 * y2.unsqueeze(0) * grad_denom).sum(1)
+            grad_y2 += (grad_sq + c ** 2 * x2b.unsqueeze(1) * grad_denom).sum(0)
+            grad_x[i:i + block_size] = grad_gram @ y + 2 * xb * grad_x2.unsqueeze(1)
+            grad_y += grad_gram.transpose(0, 1) @ xb
+        grad_y += 2 * y * grad_y2.unsqueeze(1)
+        return grad_x, grad_y, None, None
+
+
+def _dist_matrix(x, y, c, block_size: Optional[int] = None):
+    return DistMatrixFunction.apply(x, y, c, max(1, len(x)) if block_size is None else block_size)
+
+
+@upcast_inputs
+def dist_matrix(x, y, c=1.0, block_size=None):
+    r"""
+    Pairwise distances on the Poincare ball,
+    .. math::
+        d_c(x_i, y_j) = \frac{2}{\sqrt{c}}\tanh^{-1}(\sqrt{c}\|(-x_i)\oplus_c y_j\|_2)
+    computed from the Gram matrix and the squared norms, with
+    :math:`\|(-x)\oplus_c y\|_2^2 = \|x - y\|_2^2 / (1 - 2c\langle x, y\rangle + c^2\|x\|_2^2\|y\|_2^2)`:
+    the memory is O(B C) instead of the O(B C D) of the batched mobius addition.
+    Parameters
+    ----------
+    x : tensor
+        points on poincare ball, of shape (B, D)
+    y : tensor
+        points on poincare ball, of shape (C, D)
+    c : float|tensor
+        ball negative curvature
+    block_size : int|None
+        process x in blocks of this many rows, to bound the temporaries to (block_size, C)
+    Returns
+    -------
+    tensor
+        distances of shape (B, C)
+    """
     c = torch.as_tensor(c).type_as(x)
-    return _dist_matrix(x, y, c)
+    return _dist_matrix(x, y, c, block_size)
 
 
 def auto_select_c(d):
@@ -496,6 +769,8 @@ def auto_select_c(d):
     calculates the radius of the Poincare ball,
     such that the d-dimensional ball has constant volume equal to pi
     """
+    from scipy.special import gamma
+
     dim2 = d / 2.0
     R = gamma(dim2 + 1) / (np.pi ** (dim2 - 1))
     R = R ** (1 / float(d))
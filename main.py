@@ -2,11 +2,10 @@ import torch
  
 from model import *
 from batch_gen import BatchGenerator
-from eval import func_eval
+from visualize import NormPlotVisualizer, NullVisualizer
 
 import os
 import argparse
-import numpy as np
 import random
 
 
@@ -23,6 +22,30 @@ parser.add_argument('--dataset', default="50salads")
 parser.add_argument('--split', default='1')
 parser.add_argument('--model_dir', default='models')
 parser.add_argument('--result_dir', default='results')
+parser.add_argument('--run_dir', default='visualize', help='train: write the log and the embedding plots under this directory')
+parser.add_argument('--cache_dir', default=None, help='preprocess the splits into memory-mapped shards here')
+parser.add_argument('--num_workers', default=2, type=int, help='background batch loading workers, 0 loads synchronously')
+parser.add_argument('--worker_type', default='thread', choices=['thread', 'process'])
+parser.add_argument('--frame_budget', default=None, type=int, help='batch videos of similar length, up to this many padded frames per batch')
+parser.add_argument('--plot_every', default=3, type=int, help='train: plot the embedding norms every this many epochs, 0 disables the plots')
+parser.add_argument('--plot_videos', default=None, type=int, help='train: number of videos to plot in these epochs, all by default')
+parser.add_argument('--val_interval', default=10, type=int, help='train: validate on the test split every this many epochs and keep the best model, 0 disables')
+parser.add_argument('--val_batch_size', default=1, type=int)
+parser.add_argument('--val_metric', default='f1@50', choices=VAL_METRICS, help='train: metric that selects the best model')
+parser.add_argument('--overwrite', action='store_true', help='train: reuse the model and run directories of a previous or running training')
+parser.add_argument('--async_val', action='store_true', help='train: validate in the background while the training goes on')
+parser.add_argument('--use_best', action='store_true', help='predict: use the best validated model instead of the last epoch')
+parser.add_argument('--no_write', action='store_true', help='predict: only compute the metrics, without writing the result files')
+parser.add_argument('--amp', default='none', choices=['none', 'bf16', 'fp16'], help='run the encoder and decoders in mixed precision')
+parser.add_argument('--no_mlr_head', action='store_true', help='no hyperbolic MLR head on the embeddings: predict and the validation '
+                                                              'need hyp_dim == num_classes then, the label of a frame is the argmax of its embedding')
+parser.add_argument('--calib_videos', default=None, type=int, help='quantize: calibrate on this many training videos, all by default')
+parser.add_argument('--aot_compile', action='store_true', help='export: compile the model ahead of time with AOTInductor, slow but faster to load')
+parser.add_argument('--delta_tries', default=10, type=int, help='delta: number of random subsets')
+parser.add_argument('--delta_points', default=1500, type=int,
+                    help='delta: points per subset, a few thousand at most: every subset costs O(N^3) time and N x N matrices, '
+                         'about 2.5 s for 1500 points, 20 s for 3000 and 12 min for 10000 on one CPU thread')
+parser.add_argument('--chunk_size', default=None, type=int, help='predict: run the attention in chunks of this many frames to bound memory on long videos')
 
 args = parser.parse_args()
  
@@ -64,11 +87,12 @@ mapping_file = "./data/"+args.dataset+"/mapping.txt"
 model_dir = "./{}/".format(args.model_dir)+args.dataset+"/split_"+args.split
 
 results_dir = "./{}/".format(args.result_dir)+args.dataset+"/split_"+args.split
+
+run_dir = "./{}/".format(args.run_dir)+args.dataset+"/split_"+args.split
  
-if not os.path.exists(model_dir):
-    os.makedirs(model_dir)
-if not os.path.exists(results_dir):
-    os.makedirs(results_dir)
+# exist_ok: other jobs may create them at the same time
+os.makedirs(model_dir, exist_ok=True)
+os.makedirs(results_dir, exist_ok=True)
  
  
 file_ptr = open(mapping_file, 'r')
@@ -83,18 +107,59 @@ for k,v in actions_dict.items():
 num_classes = len(actions_dict)
 
 
-trainer = Trainer(num_layers, 2, 2, num_f_maps, features_dim, hyp_dim, num_classes, channel_mask_rate)
+amp = {'none': None, 'bf16': torch.bfloat16, 'fp16': torch.float16}[args.amp]
+trainer = Trainer(num_layers, 2, 2, num_f_maps, features_dim, hyp_dim, num_classes, channel_mask_rate, not args.no_mlr_head, amp, run_dir)
 if args.action == "train":
-    batch_gen = BatchGenerator(num_classes, actions_dict, gt_path, features_path, sample_rate)
+    batch_gen = BatchGenerator(num_classes, actions_dict, gt_path, features_path, sample_rate, args.cache_dir, args.frame_budget)
     batch_gen.read_data(vid_list_file)
 
-    batch_gen_tst = BatchGenerator(num_classes, actions_dict, gt_path, features_path, sample_rate)
+    batch_gen_tst = BatchGenerator(num_classes, actions_dict, gt_path, features_path, sample_rate, args.cache_dir)
     batch_gen_tst.read_data(vid_list_file_tst)
 
-    trainer.train(model_dir, batch_gen, num_epochs, bz, lr, batch_gen_tst)
+    if args.plot_every > 0:
+        visualizer = NormPlotVisualizer(run_dir, args.plot_every, args.plot_videos)
+    else:
+        visualizer = NullVisualizer()
+    trainer.train(model_dir, batch_gen, num_epochs, bz, lr, batch_gen_tst, args.num_workers, args.worker_type, visualizer,
+                  args.val_interval, args.val_batch_size, args.val_metric, args.async_val, args.overwrite)
 
 if args.action == "predict":
-    batch_gen_tst = BatchGenerator(num_classes, actions_dict, gt_path, features_path, sample_rate)
+    batch_gen_tst = BatchGenerator(num_classes, actions_dict, gt_path, features_path, sample_rate, args.cache_dir)
+    batch_gen_tst.read_data(vid_list_file_tst)
+    acc, edit, f1s = trainer.predict(model_dir, None if args.no_write else results_dir, batch_gen_tst, 'best' if args.use_best else num_epochs, index2label, sample_rate,
+                                     args.num_workers, args.worker_type, args.chunk_size)
+    print("Acc: %.4f  Edit: %4f  F1@10,25,50 " % (acc, edit), f1s)
+
+if args.action == "quantize":
+    # int8 copy of the trained model, calibrated on the training split, compared with the float model on the test split
+    import quantize
+    trainer.model.load_state_dict(torch.load(model_dir + "/epoch-" + str('best' if args.use_best else num_epochs) + ".model", map_location='cpu'))
+    batch_gen = BatchGenerator(num_classes, actions_dict, gt_path, features_path, sample_rate, args.cache_dir)
+    batch_gen.read_data(vid_list_file)
+    batch_gen_tst = BatchGenerator(num_classes, actions_dict, gt_path, features_path, sample_rate, args.cache_dir)
     batch_gen_tst.read_data(vid_list_file_tst)
-    trainer.predict(model_dir, results_dir, features_path, batch_gen_tst, num_epochs, actions_dict, sample_rate)
+    int8_model = quantize.quantize(trainer.model, batch_gen, args.calib_videos)
+    quantize.report(trainer, trainer.model, int8_model, batch_gen_tst, index2label, sample_rate)
+    torch.save(int8_model.state_dict(), model_dir + "/epoch-" + str('best' if args.use_best else num_epochs) + ".int8.model")
+
+if args.action == "export":
+    # inference program of the trained model for serve.py, next to the checkpoint
+    import export
+    epoch = str('best' if args.use_best else num_epochs)
+    trainer.model.load_state_dict(torch.load(model_dir + "/epoch-" + epoch + ".model", map_location='cpu'))
+    export.export(trainer.model, model_dir + "/epoch-" + epoch + ".pt2", [index2label[i] for i in range(num_classes)], sample_rate, args.aot_compile)
+    print("exported to " + model_dir + "/epoch-" + epoch + ".pt2")
+
+if args.action == "delta":
+    # relative delta hyperbolicity of the test features, and of the embeddings of the trained model if there is one
+    from hyptorch.delta import delta_from_features, delta_from_model
+    file_ptr = open(vid_list_file_tst, 'r')
+    feature_files = [features_path + vid.split('.')[0] + '.npy' for vid in file_ptr.read().split('\n')[:-1]]
+    file_ptr.close()
+    print("features delta_rel: %.4f +- %.4f" % delta_from_features(feature_files, args.delta_tries, args.delta_points, sample_rate))
+    checkpoint = model_dir + "/epoch-" + str('best' if args.use_best else num_epochs) + ".model"
+    if os.path.exists(checkpoint):
+        trainer.model.load_state_dict(torch.load(checkpoint, map_location=device))
+        trainer.model.to(device)
+        print("embeddings delta_rel: %.4f +- %.4f" % delta_from_model(trainer.model, feature_files, args.delta_tries, args.delta_points, sample_rate))
 
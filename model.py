@@ -3,23 +3,28 @@ import torch.nn as nn
 import torch.nn.functional as F
 from torch import optim
 
+import contextlib
 import copy
 import numpy as np
 import math
 
 import numpy as np
 import os
-import shutil
-from tqdm import tqdm
-from matplotlib import pyplot as plt
 from hyptorch.nn import *
+from hyptorch.nn import _WeightCache
 from hyptorch import pmath as pm
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
-from eval import segment_bars_with_confidence
+from eval import SegmentationMetrics, segment_bars_with_confidence, write_recognition
+from batch_gen import BatchPrefetcher
+from visualize import NormPlotVisualizer, NullVisualizer
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
+# metrics that can select the best model during training, see Trainer.train
+VAL_METRICS = ['acc', 'edit', 'f1@10', 'f1@25', 'f1@50']
+
 def exponential_descrease(idx_decoder, p=3):
     return math.exp(-p*idx_decoder)
 
@@ -52,7 +57,136 @@ class AttentionHelper(nn.Module):
         out = torch.bmm(proj_val, attention)
         return out, attention
 
-class AttLayer(nn.Module):
+    def sliding_window_att(self, proj_query, proj_key, proj_val, padding_mask, bl, window_mask, chunk_size=None):
+        '''
+        sliding window attention: the query block [i*bl, (i+1)*bl) attends to the keys in [i*bl - bl//2, (i+1)*bl + bl//2).
+        The key/value windows are strided views (unfold) of the padded inputs, no per-block copies.
+        :param proj_query: shape of (B, C1, L)
+        :param proj_key: shape of (B, C1, L)
+        :param proj_val: shape of (B, C3, L)
+        :param padding_mask: shape of (B, C, L)
+        :param window_mask: shape of (1, bl, bl + 2 * (bl // 2))
+        :param chunk_size: if set, the blocks are processed in chunks of about chunk_size frames (at least one block),
+                           which bounds the size of the attention matrices. The result is the same.
+        :return: attention value of shape (B, C3, nb * bl), nb = ceil(L / bl)
+        '''
+        m, c1, L = proj_query.shape
+        nb = -(-L // bl)
+        pad = bl // 2
+
+        # zero paddings for the last block, and bl//2 on both sides for the windows
+        q = F.pad(proj_query, (0, nb * bl - L))
+        k = F.pad(proj_key, (pad, pad + nb * bl - L))
+        v = F.pad(proj_val, (pad, pad + nb * bl - L))
+        padding_mask = F.pad(padding_mask[:, 0:1, :], (pad, pad + nb * bl - L))
+        if chunk_size is None or nb * bl <= chunk_size:
+            return self._sliding_window_blocks(q, k, v, padding_mask, bl, window_mask)
+
+        # a chunk of blocks [b0, b1) needs the keys of [b0*bl - bl//2, b1*bl + bl//2), i.e. [b0*bl, b1*bl + 2*pad) once padded
+        nc = max(1, chunk_size // bl)
+        return torch.cat([self._sliding_window_blocks(q[:, :, b0 * bl:(b0 + nc) * bl],
+                                                      k[:, :, b0 * bl:(b0 + nc) * bl + 2 * pad],
+                                                      v[:, :, b0 * bl:(b0 + nc) * bl + 2 * pad],
+                                                      padding_mask[:, :, b0 * bl:(b0 + nc) * bl + 2 * pad],
+                                                      bl, window_mask) for b0 in range(0, nb, nc)], dim=2)
+
+    def _sliding_window_blocks(self, q, k, v, padding_mask, bl, window_mask):
+        # q of shape (B, C1, nb * bl), k/v/padding_mask with the bl//2 paddings on both sides
+        m, c1, nbl = q.shape
+        c3 = v.shape[1]
+        nb = nbl // bl
+        window = bl + 2 * (bl // 2)
+
+        q = q.reshape(m, c1, nb, bl)
+        k = k.unfold(2, window, bl)  # (B, C1, nb, window)
+        v = v.unfold(2, window, bl)  # (B, C3, nb, window)
+        padding_mask = padding_mask.unfold(2, window, bl)  # (B, 1, nb, window)
+        final_mask = padding_mask.permute(0, 2, 1, 3) * window_mask  # (B, nb, bl, window)
+
+        energy = torch.einsum('bcnl,bcnw->bnlw', q, k)
+        attention = energy / np.sqrt(c1)
+        attention = attention + torch.log(final_mask + 1e-6)  # mask the zero paddings and the keys out of the window
+        attention = self.softmax(attention)
+        attention = attention * final_mask
+        out = torch.einsum('bcnw,bnlw->bcnl', v, attention)
+        return out.reshape(m, c3, nb * bl)
+
+    def block_wise_att(self, proj_query, proj_key, proj_val, padding_mask, bl):
+        '''
+        block-wise attention: the sequence is cut into blocks of length bl, each block attends to itself.
+        :param padding_mask: shape of (B, C, L)
+        :return: attention value of shape (B, C3, nb * bl), nb = ceil(L / bl)
+        '''
+        m, c1, L = proj_query.shape
+        c2 = proj_key.shape[1]
+        c3 = proj_val.shape[1]
+        nb = -(-L // bl)
+
+        q = F.pad(proj_query, (0, nb * bl - L)).reshape(m, c1, nb, bl).permute(0, 2, 1, 3).reshape(m * nb, c1, bl)
+        k = F.pad(proj_key, (0, nb * bl - L)).reshape(m, c2, nb, bl).permute(0, 2, 1, 3).reshape(m * nb, c2, bl)
+        v = F.pad(proj_val, (0, nb * bl - L)).reshape(m, c3, nb, bl).permute(0, 2, 1, 3).reshape(m * nb, c3, bl)
+        padding_mask = F.pad(padding_mask[:, 0:1, :], (0, nb * bl - L)).reshape(m, 1, nb, bl).permute(0, 2, 1, 3).reshape(m * nb, 1, bl)
+
+        out, attention = self.scalar_dot_att(q, k, v, padding_mask)
+        return out.reshape(m, nb, c3, bl).permute(0, 2, 1, 3).reshape(m, c3, nb * bl)
+
+    def attend(self, att_type, proj_query, proj_key, proj_val, mask, bl, window_mask, chunk_size=None):
+        '''
+        dispatch to the attention of AttLayer.att_type, before the output projection.
+        :param mask: shape of (B, C, L)
+        :param chunk_size: if set, the queries are processed in chunks of about chunk_size frames. Same result,
+                           but the attention matrices are bounded by the chunk size instead of the video length.
+        :return: attention value of shape (B, C3, L'), L' >= L
+        '''
+        L = proj_query.shape[2]
+        if att_type == 'sliding_att':
+            return self.sliding_window_att(proj_query, proj_key, proj_val, mask, bl, window_mask, chunk_size)
+        if chunk_size is not None and L > chunk_size:
+            if att_type == 'normal_att':
+                # every chunk of queries attends to all keys
+                return torch.cat([self.scalar_dot_att(proj_query[:, :, s:s + chunk_size], proj_key, proj_val, mask[:, 0:1, :])[0]
+                                  for s in range(0, L, chunk_size)], dim=2)
+            # blocks are independent, chunks of whole blocks
+            chunk_size = max(1, chunk_size // bl) * bl
+            return torch.cat([self.block_wise_att(proj_query[:, :, s:s + chunk_size], proj_key[:, :, s:s + chunk_size],
+                                                  proj_val[:, :, s:s + chunk_size], mask[:, :, s:s + chunk_size], bl)
+                              for s in range(0, L, chunk_size)], dim=2)
+
+        if att_type == 'normal_att':
+            return self.scalar_dot_att(proj_query, proj_key, proj_val, mask[:, 0:1, :])[0]
+        elif att_type == 'block_att':
+            return self.block_wise_att(proj_query, proj_key, proj_val, mask, bl)
+        elif att_type == 'sliding_att':
+            return self.sliding_window_att(proj_query, proj_key, proj_val, mask, bl, window_mask)
+
+def construct_window_mask(bl):
+    '''
+        construct window mask of shape (1, l, l + l//2 + l//2), used for sliding window self attention
+    '''
+    window_mask = torch.zeros((1, bl, bl + 2* (bl //2)))
+    # the union over i of the columns [i, i + bl), for every row, in one op (one constant when exported)
+    window_mask[:, :, :2 * bl - 1] = 1
+    return window_mask
+
+
+_window_masks = dict()
+
+
+def get_window_mask(bl, device, dtype):
+    '''
+        window mask of construct_window_mask(bl), built once per (bl, device, dtype) and shared by all layers.
+        Read-only: it is broadcast against the padding mask, never modified.
+    '''
+    if torch.compiler.is_compiling():
+        # traced by torch.export (see export.py), a constant of the graph rather than a cached fake tensor
+        return construct_window_mask(bl).to(device=device, dtype=dtype)
+    key = (bl, device, dtype)
+    if key not in _window_masks:
+        _window_masks[key] = construct_window_mask(bl).to(device=device, dtype=dtype)
+    return _window_masks[key]
+
+
+class AttLayer(_WeightCache, nn.Module):
     def __init__(self, q_dim, k_dim, v_dim, r1, r2, r3, bl, stage, att_type): # r1 = r2
         super(AttLayer, self).__init__()
         
@@ -69,31 +203,28 @@ class AttLayer(nn.Module):
         assert self.stage in ['encoder','decoder']
         
         self.att_helper = AttentionHelper()
-        self.window_mask = self.construct_window_mask()
+        self.chunk_size = None  # see AttentionHelper.attend, set by MyTransformer.set_chunk_size
+        # the stacked weights of the projections, in eval mode (see _stacked_conv)
+        self._init_cache('stacked_weight', 'stacked_bias')
         
     
     def construct_window_mask(self):
-        '''
-            construct window mask of shape (1, l, l + l//2 + l//2), used for sliding window self attention
-        '''
-        window_mask = torch.zeros((1, self.bl, self.bl + 2* (self.bl //2)))
-        for i in range(self.bl):
-            window_mask[:, :, i:i+self.bl] = 1
-        return window_mask.to(device)
+        return construct_window_mask(self.bl)
     
     def forward(self, x1, x2, mask):
         # x1 from the encoder
         # x2 from the decoder
         
-        query = self.query_conv(x1)
-        key = self.key_conv(x1)
-         
         if self.stage == 'decoder':
             assert x2 is not None
+            query, key = self._stacked_conv(x1, self.projections())
             value = self.value_conv(x2)
         else:
-            value = self.value_conv(x1)
-            
+            query, key, value = self._stacked_conv(x1, self.projections())
+        # the padded frames of a batch see the same keys and values as the zero paddings of a single video:
+        # the biases of the projections would otherwise leak into the softmax through log(mask + 1e-6)
+        key, value = key * mask[:, 0:1, :], value * mask[:, 0:1, :]
+
         if self.att_type == 'normal_att':
             return self._normal_self_att(query, key, value, mask)
         elif self.att_type == 'block_att':
@@ -102,97 +233,155 @@ class AttLayer(nn.Module):
             return self._sliding_window_self_att(query, key, value, mask)
 
     
+    def projections(self):
+        '''
+        the convs of the input x1: query and key, and value in the encoder stage.
+        '''
+        return [self.query_conv, self.key_conv] + ([] if self.stage == 'decoder' else [self.value_conv])
+
+    def _cache_weights(self):
+        return [p for conv in self.projections() for p in conv.parameters()]
+
+    def _stacked_conv(self, x, convs):
+        '''
+        the 1x1 convs of convs over the same input x, computed as one conv with the stacked weights. The
+        stacked weights of projections() are cached in eval mode (see _WeightCache).
+        '''
+        if not all(isinstance(conv, nn.Conv1d) for conv in convs):
+            # e.g. int8 convs (see quantize.py), which have no float weights to stack
+            return tuple(conv(x) for conv in convs)
+
+        def stack():
+            return torch.cat([conv.weight for conv in convs]), torch.cat([conv.bias for conv in convs])
+
+        if convs == self.projections() and self._use_cache():
+            weight, bias = self._cached(None, stack)
+        else:
+            weight, bias = stack()
+        return torch.split(F.conv1d(x, weight, bias), [conv.out_channels for conv in convs], dim=1)
+
     def _normal_self_att(self,q,k,v, mask):
-        m_batchsize, c1, L = q.size()
-        _,c2,L = k.size()
-        _,c3,L = v.size()
-        padding_mask = torch.ones((m_batchsize, 1, L)).to(device) * mask[:,0:1,:]
-        output, attentions = self.att_helper.scalar_dot_att(q, k, v, padding_mask)
+        L = q.shape[2]
+        output = self.att_helper.attend('normal_att', q, k, v, mask, self.bl, None, self.chunk_size)
         output = self.conv_out(F.relu(output))
         output = output[:, :, 0:L]
         return output * mask[:, 0:1, :]  
         
     def _block_wise_self_att(self, q,k,v, mask):
-        m_batchsize, c1, L = q.size()
-        _,c2,L = k.size()
-        _,c3,L = v.size()
-        
-        nb = L // self.bl
-        if L % self.bl != 0:
-            q = torch.cat([q, torch.zeros((m_batchsize, c1, self.bl - L % self.bl)).to(device)], dim=-1)
-            k = torch.cat([k, torch.zeros((m_batchsize, c2, self.bl - L % self.bl)).to(device)], dim=-1)
-            v = torch.cat([v, torch.zeros((m_batchsize, c3, self.bl - L % self.bl)).to(device)], dim=-1)
-            nb += 1
-
-        padding_mask = torch.cat([torch.ones((m_batchsize, 1, L)).to(device) * mask[:,0:1,:], torch.zeros((m_batchsize, 1, self.bl * nb - L)).to(device)],dim=-1)
-
-        q = q.reshape(m_batchsize, c1, nb, self.bl).permute(0, 2, 1, 3).reshape(m_batchsize * nb, c1, self.bl)
-        padding_mask = padding_mask.reshape(m_batchsize, 1, nb, self.bl).permute(0, 2, 1, 3).reshape(m_batchsize * nb,1, self.bl)
-        k = k.reshape(m_batchsize, c2, nb, self.bl).permute(0, 2, 1, 3).reshape(m_batchsize * nb, c2, self.bl)
-        v = v.reshape(m_batchsize, c3, nb, self.bl).permute(0, 2, 1, 3).reshape(m_batchsize * nb, c3, self.bl)
-        
-        output, attentions = self.att_helper.scalar_dot_att(q, k, v, padding_mask)
+        L = q.shape[2]
+        output = self.att_helper.attend('block_att', q, k, v, mask, self.bl, None, self.chunk_size)
         output = self.conv_out(F.relu(output))
-        
-        output = output.reshape(m_batchsize, nb, c3, self.bl).permute(0, 2, 1, 3).reshape(m_batchsize, c3, nb * self.bl)
         output = output[:, :, 0:L]
         return output * mask[:, 0:1, :]  
     
     def _sliding_window_self_att(self, q,k,v, mask):
-        m_batchsize, c1, L = q.size()
-        _, c2, _ = k.size()
-        _, c3, _ = v.size()
-        
-        
-        assert m_batchsize == 1  # currently, we only accept input with batch size 1
-        # padding zeros for the last segment
-        nb = L // self.bl 
-        if L % self.bl != 0:
-            q = torch.cat([q, torch.zeros((m_batchsize, c1, self.bl - L % self.bl)).to(device)], dim=-1)
-            k = torch.cat([k, torch.zeros((m_batchsize, c2, self.bl - L % self.bl)).to(device)], dim=-1)
-            v = torch.cat([v, torch.zeros((m_batchsize, c3, self.bl - L % self.bl)).to(device)], dim=-1)
-            nb += 1
-        padding_mask = torch.cat([torch.ones((m_batchsize, 1, L)).to(device) * mask[:,0:1,:], torch.zeros((m_batchsize, 1, self.bl * nb - L)).to(device)],dim=-1)
-        
-        # sliding window approach, by splitting query_proj and key_proj into shape (c1, l) x (c1, 2l)
-        # sliding window for query_proj: reshape
-        q = q.reshape(m_batchsize, c1, nb, self.bl).permute(0, 2, 1, 3).reshape(m_batchsize * nb, c1, self.bl)
-        
-        # sliding window approach for key_proj
-        # 1. add paddings at the start and end
-        k = torch.cat([torch.zeros(m_batchsize, c2, self.bl // 2).to(device), k, torch.zeros(m_batchsize, c2, self.bl // 2).to(device)], dim=-1)
-        v = torch.cat([torch.zeros(m_batchsize, c3, self.bl // 2).to(device), v, torch.zeros(m_batchsize, c3, self.bl // 2).to(device)], dim=-1)
-        padding_mask = torch.cat([torch.zeros(m_batchsize, 1, self.bl // 2).to(device), padding_mask, torch.zeros(m_batchsize, 1, self.bl // 2).to(device)], dim=-1)
-        
-        # 2. reshape key_proj of shape (m_batchsize*nb, c1, 2*self.bl)
-        k = torch.cat([k[:,:, i*self.bl:(i+1)*self.bl+(self.bl//2)*2] for i in range(nb)], dim=0) # special case when self.bl = 1
-        v = torch.cat([v[:,:, i*self.bl:(i+1)*self.bl+(self.bl//2)*2] for i in range(nb)], dim=0) 
-        # 3. construct window mask of shape (1, l, 2l), and use it to generate final mask
-        padding_mask = torch.cat([padding_mask[:,:, i*self.bl:(i+1)*self.bl+(self.bl//2)*2] for i in range(nb)], dim=0) # of shape (m*nb, 1, 2l)
-        final_mask = self.window_mask.repeat(m_batchsize * nb, 1, 1) * padding_mask 
-        
-        output, attention = self.att_helper.scalar_dot_att(q, k, v, final_mask)
-        output = self.conv_out(F.relu(output))
-
-        output = output.reshape(m_batchsize, nb, -1, self.bl).permute(0, 2, 1, 3).reshape(m_batchsize, -1, nb * self.bl)
+        L = q.shape[2]
+        output = self.att_helper.sliding_window_att(q, k, v, mask, self.bl, get_window_mask(self.bl, q.device, q.dtype), self.chunk_size)
+        output = self.conv_out(F.relu(output))  # 1x1 conv, so it can run on all blocks at once
         output = output[:, :, 0:L]
         return output * mask[:, 0:1, :]
 
 
 class MultiHeadAttLayer(nn.Module):
-    def __init__(self, q_dim, k_dim, v_dim, r1, r2, r3, bl, stage, att_type, num_head):
+    def __init__(self, q_dim, k_dim, v_dim, r1, r2, r3, bl, stage, att_type, num_head, fused=False):
         super(MultiHeadAttLayer, self).__init__()
 #         assert v_dim % num_head == 0
         self.conv_out = nn.Conv1d(v_dim * num_head, v_dim, 1)
-        self.layers = nn.ModuleList(
-            [copy.deepcopy(AttLayer(q_dim, k_dim, v_dim, r1, r2, r3, bl, stage, att_type)) for i in range(num_head)])
         self.dropout = nn.Dropout(p=0.5)
-        
+        self.num_head = num_head
+        self.stage = stage
+        self.fused = fused
+        if not fused:
+            self.layers = nn.ModuleList(
+                [copy.deepcopy(AttLayer(q_dim, k_dim, v_dim, r1, r2, r3, bl, stage, att_type)) for i in range(num_head)])
+            return
+
+        self._init_fused(q_dim, k_dim, v_dim, r1, r2, r3, bl, att_type)
+
+    def _init_fused(self, q_dim, k_dim, v_dim, r1, r2, r3, bl, att_type, device=None, dtype=None):
+        # fused mode: one 1x1 conv computes q/k (and v in encoder stage) of all heads, the attention runs with
+        # the heads folded into the batch, and a grouped 1x1 conv does the per-head output projections
+        num_head = self.num_head
+        self.bl = bl
+        self.att_type = att_type
+        self.split = [q_dim // r1 * num_head, k_dim // r2 * num_head]
+        if self.stage == 'encoder':
+            self.split.append(v_dim // r3 * num_head)
+        else:
+            self.value_conv = nn.Conv1d(v_dim, v_dim // r3 * num_head, 1, device=device, dtype=dtype)
+        self.qkv_conv = nn.Conv1d(q_dim, sum(self.split), 1, device=device, dtype=dtype)
+        self.head_out = nn.Conv1d(v_dim // r3 * num_head, v_dim * num_head, 1, groups=num_head, device=device, dtype=dtype)
+        self.att_helper = AttentionHelper()
+        self.chunk_size = None
+
     def forward(self, x1, x2, mask):
-        out = torch.cat([layer(x1, x2, mask) for layer in self.layers], dim=1)
+        if not self.fused:
+            out = torch.cat([layer(x1, x2, mask) for layer in self.layers], dim=1)
+            out = self.conv_out(self.dropout(out))
+            return out
+
+        m, _, L = x1.shape
+        h = self.num_head
+        qkv = torch.split(self.qkv_conv(x1), self.split, dim=1)
+        query, key = qkv[0], qkv[1]
+        value = qkv[2] if self.stage == 'encoder' else self.value_conv(x2)
+        key, value = key * mask[:, 0:1, :], value * mask[:, 0:1, :]  # see AttLayer.forward
+
+        # (B, H * C, L) => (B * H, C, L)
+        query, key, value = [t.reshape(m * h, -1, L) for t in (query, key, value)]
+        head_mask = mask[:, 0:1, :].repeat_interleave(h, dim=0)
+        out = self.att_helper.attend(self.att_type, query, key, value, head_mask, self.bl, get_window_mask(self.bl, query.device, query.dtype), self.chunk_size)
+        out = self.head_out(F.relu(out.reshape(m, -1, out.shape[2])))
+        out = out[:, :, 0:L] * mask[:, 0:1, :]
         out = self.conv_out(self.dropout(out))
         return out
-            
+
+    def fuse(self):
+        '''
+        convert an unfused layer (and its weights) to the fused mode in place. The fused convs get the device and
+        dtype of the per-head weights, conv_out and the hooks of the layer are kept.
+        '''
+        if self.fused:
+            return self
+        layer = self.layers[0]
+        weights = fuse_multi_head_state_dict({'layers.' + name: value for name, value in self.layers.state_dict().items()},
+                                             '', self.num_head, self.stage)
+        self._init_fused(layer.query_conv.in_channels, layer.key_conv.in_channels, layer.value_conv.in_channels,
+                         layer.query_conv.in_channels // layer.query_conv.out_channels,
+                         layer.key_conv.in_channels // layer.key_conv.out_channels,
+                         layer.value_conv.in_channels // layer.value_conv.out_channels,
+                         layer.bl, layer.att_type, layer.query_conv.weight.device, layer.query_conv.weight.dtype)
+        with torch.no_grad():
+            for name, value in weights.items():
+                self.get_parameter(name).copy_(value)
+        self.chunk_size = layer.chunk_size
+        del self.layers
+        self.fused = True
+        self.train(self.training)
+        return self
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints of unfused layers still load into a fused layer
+        if self.fused and prefix + 'layers.0.query_conv.weight' in state_dict:
+            fuse_multi_head_state_dict(state_dict, prefix, self.num_head, self.stage)
+        super(MultiHeadAttLayer, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+
+def fuse_multi_head_state_dict(state_dict, prefix, num_head, stage):
+    '''
+    rewrite, in place, the per-head AttLayer weights of an unfused MultiHeadAttLayer into the fused layout.
+    '''
+    def pop_heads(name):
+        return [state_dict.pop(prefix + 'layers.{}.{}'.format(i, name)) for i in range(num_head)]
+
+    qkv = ['query_conv', 'key_conv'] + (['value_conv'] if stage == 'encoder' else [])
+    for param in ['weight', 'bias']:
+        state_dict[prefix + 'qkv_conv.' + param] = torch.cat([t for name in qkv for t in pop_heads(name + '.' + param)])
+        if stage == 'decoder':
+            state_dict[prefix + 'value_conv.' + param] = torch.cat(pop_heads('value_conv.' + param))
+        state_dict[prefix + 'head_out.' + param] = torch.cat(pop_heads('conv_out.' + param))
+    return state_dict
+
 
 class ConvFeedForward(nn.Module):
     def __init__(self, dilation, in_channels, out_channels):
@@ -232,11 +421,20 @@ class AttModule(nn.Module):
         
     def forward(self, x, f, mask):
         out = self.feed_forward(x)
-        out = self.alpha * self.att_layer(self.instance_norm(out), f, mask) + out
+        out = self.alpha * self.att_layer(self._instance_norm(out, mask), f, mask) + out
         out = self.conv_1x1(out)
         out = self.dropout(out)
         return (x + out) * mask[:, 0:1, :]
 
+    def _instance_norm(self, x, mask):
+        # same as self.instance_norm, but the statistics only cover the unpadded frames,
+        # so a video gives the same result alone and in a padded batch
+        mask = mask[:, 0:1, :]
+        num_frames = mask.sum(dim=-1, keepdim=True).clamp_min(1)
+        mean = (x * mask).sum(dim=-1, keepdim=True) / num_frames
+        var = ((x - mean) * mask).pow(2).sum(dim=-1, keepdim=True) / num_frames
+        return (x - mean) / torch.sqrt(var + self.instance_norm.eps)
+
 
 class PositionalEncoding(nn.Module):
     "Implement the PE function."
@@ -281,7 +479,7 @@ class Encoder(nn.Module):
             x = self.dropout(x)
             x = x.squeeze(2)
 
-        feature = self.conv_1x1(x)
+        feature = self.conv_1x1(x) * mask[:, 0:1, :]  # zero paddings, as seen by the dilated convs of a single video
         for layer in self.layers:
             feature = layer(feature, None, mask)
         
@@ -301,7 +499,7 @@ class Decoder(nn.Module):
 
     def forward(self, x, fencoder, mask):
 
-        feature = self.conv_1x1(x)
+        feature = self.conv_1x1(x) * mask[:, 0:1, :]
         for layer in self.layers:
             feature = layer(feature, fencoder, mask)
 
@@ -310,28 +508,74 @@ class Decoder(nn.Module):
         return out, feature
     
 class MyTransformer(nn.Module):
-    def __init__(self, num_decoders, num_layers, r1, r2, num_f_maps, input_dim, output_dim, num_classes, channel_masking_rate):
+    def __init__(self, num_decoders, num_layers, r1, r2, num_f_maps, input_dim, output_dim, num_classes, channel_masking_rate, mlr_head=False, mlr_tile_size=4096):
         super(MyTransformer, self).__init__()
         self.encoder = Encoder(num_layers, r1, r2, num_f_maps, input_dim, num_classes, channel_masking_rate, att_type='sliding_att', alpha=1)
         self.decoders = nn.ModuleList([copy.deepcopy(Decoder(num_layers, r1, r2, num_f_maps, num_classes, num_classes, att_type='sliding_att', alpha=exponential_descrease(s))) for s in range(num_decoders)]) # num_decoders
         self.hypmlp = HypMlp(num_f_maps, output_dim)
+        # optional hyperbolic classification head on the embeddings, trained with a cross entropy term
+        self.mlr = HyperbolicMLR(output_dim, num_classes, c=1, tile_size=mlr_tile_size) if mlr_head else None
+        self.num_classes = num_classes
+        self.amp_dtype = None
 
         self.loss1 = BinaryTreeLoss()
         self.loss2 = NormLoss()
         self.loss_crossen = CrossEn()
         
     def forward(self, x, mask):
-        out, feature = self.encoder(x, mask)
-        outputs = out.unsqueeze(0)
-        
-        for decoder in self.decoders:
-            out, feature = decoder(F.softmax(out, dim=1) * mask[:, 0:1, :], feature* mask[:, 0:1, :], mask)
-            outputs = torch.cat((outputs, out.unsqueeze(0)), dim=0)
+        with torch.autocast(x.device.type, dtype=self.amp_dtype, enabled=self.amp_dtype is not None):
+            out, feature = self.encoder(x, mask)
+            outputs = out.unsqueeze(0)
+
+            for decoder in self.decoders:
+                out, feature = decoder(F.softmax(out, dim=1) * mask[:, 0:1, :], feature* mask[:, 0:1, :], mask)
+                outputs = torch.cat((outputs, out.unsqueeze(0)), dim=0)
         
-        # in the hyperbolic space
-        outputs = self.hypmlp(feature.transpose(2, 1)[0])
+        # in the hyperbolic space, of shape (B, L, output_dim)
+        outputs = self.hypmlp(feature.transpose(2, 1))
  
         return outputs
+
+    def classify(self, features):
+        '''
+        :param features: hyperbolic embeddings of shape (..., output_dim)
+        :return: the class scores of the frames, of shape (..., num_classes): the logits of the MLR head, or
+                 the embeddings themselves without a head (the label of a frame is the argmax of its embedding)
+        '''
+        if self.mlr is None:
+            self.check_classify()
+            return features
+        return self.mlr(features.reshape(-1, features.shape[-1])).reshape(features.shape[:-1] + (self.mlr.n_classes,))
+
+    def check_classify(self):
+        '''
+        raise a ValueError if classify cannot give class scores: without the MLR head the embeddings are the
+        scores, which takes output_dim == num_classes.
+        '''
+        if self.mlr is None and self.hypmlp.output_dim != self.num_classes:
+            raise ValueError('no class scores without the MLR head: the embeddings have {} dimensions for {} classes'
+                             .format(self.hypmlp.output_dim, self.num_classes))
+
+    def set_amp(self, dtype):
+        '''
+        mixed precision: the convolutions and attentions of the encoder and the decoders run in dtype
+        (torch.bfloat16 or torch.float16) under autocast, while HypMlp, the MLR head and the hyperbolic ops upcast
+        to float32 (see pmath.upcast_inputs), so the embeddings stay float32. None runs everything in float32.
+        '''
+        self.amp_dtype = dtype
+
+    def set_chunk_size(self, chunk_size):
+        '''
+        chunked inference for long videos: every attention layer processes its queries in chunks of about
+        chunk_size frames (aligned to its block length bl, with the bl//2 key halo on both sides of a chunk
+        for the sliding window). The output is the same as for the full sequence. Only the attention matrices
+        are bounded by the chunk size instead of growing with the video length (O(L^2) for normal_att): the
+        activations of the convolutions and feed-forward layers are still O(L). None processes the full
+        sequence at once.
+        '''
+        for module in self.modules():
+            if isinstance(module, (AttLayer, MultiHeadAttLayer)):
+                module.chunk_size = chunk_size
     
     '''def loss(self, parent, child, bz=4):
         loss = []
@@ -351,54 +595,85 @@ class MyTransformer(nn.Module):
         return sum(loss) / len(loss)
         # return self.loss1(parent[:bz], child[:bz]) + self.loss2(parent[:bz], child[:bz])'''
 
-    def loss(self, parent, child, features, target, bz=4):
-        loss_cos = []
-        loss_center = 0.
-        loss_norm = []
-        # print(parent.shape, child.shape, features.shape, target.shape)
-        # e.g. torch.Size([5537, 64]) torch.Size([5537, 64]) torch.Size([5558, 64]) torch.Size([5558])
-        
-        # cos
-        boarder = torch.argwhere(target != torch.cat([target[[-1]], target[:-1]]))
-        boarder = boarder.squeeze().cpu().tolist() + [len(target)]
-        for n in range(len(target) // (len(boarder)-1) + 1):
-            cross_idx_1 = []
-            cross_idx_2 = []
-            for n in range(len(boarder)-1):
-                cross_idx_1.append(np.random.choice(range(boarder[n], boarder[n+1])))
-                cross_idx_2.append(np.random.choice(range(boarder[n], boarder[n+1])))
-            score = torch.matmul(features[cross_idx_1], features[cross_idx_2].T)
-            batch_loss = self.loss_crossen(score)
-            loss_cos.append(batch_loss)
-        
-        # center
-        start_point_features_norm = features[boarder[:-1]].norm(dim=1)
-        loss_center = - start_point_features_norm.mean()
-
-        # norm
-        # for n in range(0, len(parent), bz):
-        #     parent_batch_norm = parent[bz*n: bz*(n+1)].norm(dim=1)
-        #     child_batch_norm = child[bz*n: bz*(n+1)].norm(dim=1)
-            # idx = np.random.choice(len(parent), bz)
-            # parent_batch_norm = parent[idx].norm(dim=1)
-            # child_batch_norm = child[idx].norm(dim=1)
-
-            # print(parent_batch_norm.shape, child_batch_norm.shape)
-            # torch.Size([4]) torch.Size([4])
-        for n in range(len(boarder)-1):
-            parent_batch_norm = parent[boarder[n]: boarder[n+1]].norm(dim=1)
-            child_batch_norm = child[boarder[n]: boarder[n+1]].norm(dim=1)
-            # print(len(parent_batch_norm))
-            score = - F.relu(child_batch_norm.repeat(len(child_batch_norm), 1) - parent_batch_norm.repeat(len(child_batch_norm), 1).T + 0.01)
-            batch_loss = self.loss_crossen(score)
-            if torch.isnan(batch_loss):
-                print('batch %d loss' % n, batch_loss)
-                break
-            loss_norm.append(batch_loss)
+    def loss(self, features, target, mask):
+        '''
+        :param features: hyperbolic embeddings of shape (B, L, D)
+        :param target: labels of shape (B, L), -100 for the paddings
+        :param mask: shape of (B, C, L)
+        :return: loss averaged over the videos in the batch
+        '''
+        lengths = mask[:, 0, :].sum(dim=-1).long()
+        # segment borders: frames whose label differs from the previous one (cyclic within the video)
+        prev = torch.cat((target.gather(1, (lengths - 1).unsqueeze(1)), target[:, :-1]), dim=1)
+        valid = torch.arange(target.shape[1], device=target.device) < lengths.unsqueeze(1)
+        borders = torch.nonzero((target != prev) & valid)
+        # the only host sync of the loss
+        host = torch.cat((lengths, borders.flatten())).tolist()
+        lengths, borders = host[:len(lengths)], np.array(host[len(lengths):], dtype=np.int64).reshape(-1, 2)
+        losses = []
+        for b, (feature, length) in enumerate(zip(features, lengths)):
+            losses.append(self._video_loss(feature[:length], borders[borders[:, 0] == b, 1]))
+        loss = sum(losses) / len(losses)
+        if self.mlr is not None:
+            logits = self.classify(features)
+            loss = loss + F.cross_entropy(logits.reshape(-1, logits.shape[-1]), target.reshape(-1), ignore_index=-100)
+        return loss
 
-        # print((sum(loss_cos) / len(loss_cos)), loss_center, (sum(loss_norm) / len(loss_norm)))
+    def _video_loss(self, features, boarder):
+        '''
+        :param features: embeddings of one video, of shape (L, D)
+        :param boarder: sorted segment borders (numpy), frames whose label differs from the previous one
+        '''
+        length = len(features)
+        device = features.device
+        # a video of a single action is one segment without border
+        starts = boarder if len(boarder) else np.zeros(1, dtype=np.int64)
+        ends = np.append(starts[1:], length)
+        num_segments = len(starts)
+
+        # cos: length // num_segments + 1 rounds of two random frames per segment, all rounds at once
+        seg_start = torch.as_tensor(starts, device=device)
+        seg_len = torch.as_tensor(ends - starts, device=device)
+        rounds = length // num_segments + 1
+        idx = seg_start + (torch.rand(2, rounds, num_segments, device=device) * seg_len).long()
+        idx = torch.minimum(idx, seg_start + seg_len - 1)
+        score = torch.bmm(features[idx[0]], features[idx[1]].transpose(1, 2))
+        loss_cos = -torch.diagonal(F.log_softmax(score, dim=-1), dim1=1, dim2=2).mean()
 
-        return (sum(loss_cos) / len(loss_cos)) + loss_center + (sum(loss_norm) / len(loss_norm))
+        # center
+        loss_center = - features[starts].norm(dim=1).mean()
+
+        # norm: parent (child) are the frames with the same label as the next (previous) frame, sliced by
+        # the segment borders. Slices past their end are empty and were dropped.
+        parent_frames = np.delete(np.arange(length), (boarder - 1) % length)
+        child_frames = np.delete(np.arange(length), boarder)
+        num_pairs = len(child_frames)
+        keep = starts < num_pairs
+        seg_start, seg_len = starts[keep], np.minimum(ends[keep], num_pairs) - starts[keep]
+        # the pairwise scores of segments of about the same length (up to a factor of 2) are padded together
+        buckets = np.ceil(np.log2(seg_len)).astype(np.int64)
+        loss_norm = 0.
+        for bucket in np.unique(buckets):
+            loss_norm = loss_norm + self._norm_loss(features, parent_frames, child_frames,
+                                                    seg_start[buckets == bucket], seg_len[buckets == bucket])
+        loss_norm = loss_norm / len(seg_len)
+
+        return loss_cos + loss_center + loss_norm
+
+    def _norm_loss(self, features, parent_frames, child_frames, seg_start, seg_len):
+        '''
+        sum over the segments of CrossEn(- relu(|child_j| - |parent_i| + 0.01)), as a masked log-softmax over
+        the (S, M, M) scores padded to the longest segment M.
+        '''
+        device = features.device
+        pos = np.minimum(seg_start[:, None] + np.arange(seg_len.max()), len(child_frames) - 1)
+        pair_idx = torch.as_tensor(np.stack((parent_frames[pos], child_frames[pos])), device=device)
+        valid = torch.as_tensor(np.arange(pos.shape[1]) < seg_len[:, None], device=device)
+        parent_norm, child_norm = features[pair_idx].norm(dim=-1)  # (S, M) each
+        score = - F.relu(child_norm.unsqueeze(1) - parent_norm.unsqueeze(2) + 0.01)
+        score = score.masked_fill(~valid.unsqueeze(1), float('-inf'))
+        logpt = torch.diagonal(F.log_softmax(score, dim=-1), dim1=1, dim2=2)
+        return (-logpt.masked_fill(~valid, 0).sum(dim=1) / torch.as_tensor(seg_len, device=device)).sum()
 
 
 class HypMlp(nn.Module):
@@ -413,6 +688,7 @@ class HypMlp(nn.Module):
         self.act = act_layer()
         self.drop = nn.Dropout(drop)
 
+    @pm.upcast_inputs
     def forward(self, x):
         x = self.topoincare(x)
         x = self.hypfc1(x)
@@ -466,34 +742,85 @@ class NormLoss(nn.Module):
         return loss
 
     
+def claim_dir(directory, overwrite=False):
+    '''
+    make directory (created if needed) the output directory of this training run: a train.pid file is created
+    atomically, so that of two runs started on the same directory only one gets it.
+    :param overwrite: take the directory even if another run claimed it or it holds files
+    :exception FileExistsError: if the directory is claimed or not empty, without overwrite
+    '''
+    os.makedirs(directory, exist_ok=True)
+    pid_file = os.path.join(directory, 'train.pid')
+    try:
+        fd = os.open(pid_file, os.O_CREAT | os.O_WRONLY | (os.O_TRUNC if overwrite else os.O_EXCL))
+    except FileExistsError:
+        raise FileExistsError('{} is used by another training run (see {}), pass overwrite to reuse it'.format(directory, pid_file))
+    with os.fdopen(fd, 'w') as f:
+        f.write(str(os.getpid()))
+    if not overwrite and os.listdir(directory) != ['train.pid']:
+        raise FileExistsError('{} holds the files of another run, pass overwrite to reuse it'.format(directory))
+
+
 class Trainer:
-    def __init__(self, num_layers, r1, r2, num_f_maps, input_dim, output_dim, num_classes, channel_masking_rate):
-        self.model = MyTransformer(3, num_layers, r1, r2, num_f_maps, input_dim, output_dim, num_classes, channel_masking_rate)
+    def __init__(self, num_layers, r1, r2, num_f_maps, input_dim, output_dim, num_classes, channel_masking_rate, mlr_head=False, amp=None, run_dir=None):
+        '''
+        :param amp: None, or the dtype of the mixed precision mode (see MyTransformer.set_amp)
+        :param run_dir: directory of the training log and the embedding plots, created by train, which refuses a
+                        directory used by another run (see claim_dir). None writes neither. Nothing is written before
+                        train.
+        '''
+        self.model = MyTransformer(3, num_layers, r1, r2, num_f_maps, input_dim, output_dim, num_classes, channel_masking_rate, mlr_head)
+        self.model.set_amp(amp)
         # self.model = HypMlp(input_dim, 2)
         self.ce = nn.CrossEntropyLoss(ignore_index=-100)
 
         print('Model Size: ', sum(p.numel() for p in self.model.parameters()))
         self.mse = nn.MSELoss(reduction='none')
         self.num_classes = num_classes
-        
-        # visualize dir
-        self.dir = './visualize/breakfast_base64-16_StartCloseToCenter+SeparateSegments+Shuffle'
-        if os.path.exists('./' + self.dir):
-            shutil.rmtree('./' + self.dir)
-            os.makedirs('./' + self.dir)
-        else:
-            os.makedirs('./' + self.dir)
-        with open('./' + self.dir + '/log.txt', mode='w') as f:
-            f.write(str(datetime.now()) + '\n')
+        self.run_dir = run_dir
 
-    def train(self, save_dir, batch_gen, num_epochs, batch_size, learning_rate, batch_gen_tst=None):
+    def _log(self, line):
+        if self.run_dir is not None:
+            with open(os.path.join(self.run_dir, 'log.txt'), mode='a') as f:
+                f.write(line + '\n')
+
+    def train(self, save_dir, batch_gen, num_epochs, batch_size, learning_rate, batch_gen_tst=None, num_workers=2, worker_type='thread', visualizer=None,
+              val_interval=10, val_batch_size=1, val_metric='f1@50', async_val=False, overwrite=False):
+        '''
+        :param save_dir: directory of the checkpoints. It and run_dir must not be in use by another run, see claim_dir
+        :param visualizer: plots of the embeddings (see visualize.py), by default the norms every 3 epochs in run_dir
+        :param val_interval: evaluate on batch_gen_tst every val_interval epochs and save the best model as epoch-best.model.
+                             The last epoch is saved as epoch-<num_epochs>.model
+        :param val_metric: the metric that selects the best model, one of VAL_METRICS
+        :param async_val: validate a copy of the model in a background thread (on a separate CUDA stream), while
+                          the training goes on
+        :param overwrite: reuse save_dir and run_dir even if they hold the files of another run
+        '''
+        from tqdm import tqdm
+
+        if batch_gen_tst is not None and val_interval:
+            # fail before the training, not at the first validation
+            self.model.check_classify()
+        claim_dir(save_dir, overwrite)
+        if self.run_dir is not None:
+            claim_dir(self.run_dir, overwrite)
+        self._log(str(datetime.now()))
+        if visualizer is None:
+            visualizer = NormPlotVisualizer(self.run_dir) if self.run_dir is not None else NullVisualizer()
         self.model.train()
         self.model.to(device)
         # self.model.load_state_dict(torch.load('/storage/rqshi/ASFormer/models_original/50salads/split_5/epoch-120.model'), strict=False)
         optimizer = optim.Adam(self.model.parameters(), lr=learning_rate, weight_decay=1e-5)
         print('LR:{}'.format(learning_rate))
         
-        scheduler = optim.lr_scheduler.ReduceLROnPlateau(optimizer, mode='min', factor=0.5, patience=3, verbose=True)
+        scheduler = optim.lr_scheduler.ReduceLROnPlateau(optimizer, mode='min', factor=0.5, patience=3)
+        # float16 gradients underflow without loss scaling
+        scaler = torch.amp.GradScaler(device.type, enabled=self.model.amp_dtype == torch.float16)
+        # batch N+1 is loaded in the background while batch N trains
+        prefetcher = BatchPrefetcher(batch_gen, batch_size, False, num_workers, worker_type, pin_memory=True)
+        validator = ThreadPoolExecutor(1) if async_val else None
+        pending = None  # (epoch, metrics or future) of the last validation
+        self.best = None
         for epoch in range(num_epochs):
             epoch_loss = 0
             # correct = 0
@@ -501,42 +828,26 @@ class Trainer:
             cnt = 0
 
             # while batch_gen.has_next():
-            for _ in tqdm(range(len(batch_gen))):
-            # for _ in tqdm(range(10)):
-                batch_input, batch_target, mask, vids = batch_gen.next_batch(batch_size, False)
-                batch_input, batch_target, mask = batch_input.to(device), batch_target.to(device), mask.to(device)
+            for batch_input, batch_target, mask, vids in tqdm(prefetcher, total=len(prefetcher)):
+                batch_input, batch_target, mask = batch_input.to(device, non_blocking=True), batch_target.to(device, non_blocking=True), mask.to(device, non_blocking=True)
                 optimizer.zero_grad()
                 fs = self.model(batch_input, mask)
-                # print(fs.shape, batch_target.T.shape)
-
-                target = batch_target.T
-                ps_idx = (target == torch.cat((target[1:], target[[0]]))).squeeze()
-                cs_idx = (target == torch.cat((target[[-1]], target[:-1]))).squeeze()
-                
-                # for p, c, t in zip(ps_idx, cs_idx, target):
-                #     print(p, c, t)
-                # print(ps_idx.shape, cs_idx.shape, target.shapes)
-                # torch.Size([5558]) torch.Size([5558]) torch.Size([5558, 1])
-
-                ps = fs[ps_idx]
-                cs = fs[cs_idx]
-                # print(ps.shape, cs.shape, ps_target.shape)
-                # torch.Size([5537, 64]) torch.Size([5537, 64]) torch.Size([5537])
-                
+                # print(fs.shape, batch_target.shape)
+                # e.g. torch.Size([1, 5558, 64]) torch.Size([1, 5558])
+
                 # plot
-                # if cnt < 7:
-                # if sum([(n in vids[0]) for n in ['04-1', '05-1', '11-2', '13-2', '17-2', '20-1', '21-1']]):
-                #     self._plot(epoch, vids[0], fs, target, dir=self.dir)
-                self._plot(epoch, vids[0], fs, target, dir=self.dir)
+                if visualizer.wants(epoch, cnt):
+                    length = int(mask[0, 0, :].sum().item())
+                    visualizer.add(epoch, vids[0], fs[0, :length].detach(), batch_target[0, :length])
                 cnt += 1
 
-                # print(ps.shape, cs.shape)
-                loss = self.model.loss(ps, cs, fs, target.squeeze())
+                loss = self.model.loss(fs, batch_target, mask)
                 # print('loss', loss)
 
-                epoch_loss += loss.item()
-                loss.backward()
-                optimizer.step()
+                epoch_loss += loss.item() * len(vids)
+                scaler.scale(loss).backward()
+                scaler.step(optimizer)
+                scaler.update()
 
                 # _, predicted = torch.max(ps.data[-1], 1)
                 # correct += ((predicted == batch_target).float() * mask[:, 0, :].squeeze(1)).sum().item()
@@ -546,177 +857,120 @@ class Trainer:
             scheduler.step(epoch_loss)
             batch_gen.reset()
             print("[epoch %d]: epoch loss = %f" % (epoch + 1, epoch_loss / len(batch_gen.list_of_examples)))
-            with open('./' + self.dir + '/log.txt', mode='a') as f:
-                f.write("[epoch %d]: epoch loss = %f\n" % (epoch + 1, epoch_loss / len(batch_gen.list_of_examples)))
-
-            if (epoch + 1) % 10 == 0 and batch_gen_tst is not None:
-                # self.test(batch_gen_tst, epoch)
-                torch.save(self.model.state_dict(), save_dir + "/epoch-" + str(epoch + 1) + ".model")
-                torch.save(optimizer.state_dict(), save_dir + "/epoch-" + str(epoch + 1) + ".opt")
-
-    def test(self, batch_gen_tst, epoch):
-        self.model.eval()
-        correct = 0
-        total = 0
-        if_warp = False  # When testing, always false
-        with torch.no_grad():
-            while batch_gen_tst.has_next():
-                batch_input, batch_target, mask, vids = batch_gen_tst.next_batch(1, if_warp)
-                batch_input, batch_target, mask = batch_input.to(device), batch_target.to(device), mask.to(device)
-                p = self.model(batch_input, mask)
-                _, predicted = torch.max(p.data[-1], 1)
-                correct += ((predicted == batch_target).float() * mask[:, 0, :].squeeze(1)).sum().item()
-                total += torch.sum(mask[:, 0, :]).item()
-
-        acc = float(correct) / total
-        print("---[epoch %d]---: tst acc = %f" % (epoch + 1, acc))
-
-        self.model.train()
-        batch_gen_tst.reset()
-
-    def predict(self, model_dir, results_dir, features_path, batch_gen_tst, epoch, actions_dict, sample_rate):
+            self._log("[epoch %d]: epoch loss = %f" % (epoch + 1, epoch_loss / len(batch_gen.list_of_examples)))
+
+            if batch_gen_tst is not None and val_interval and (epoch + 1) % val_interval == 0:
+                if pending is not None:
+                    self._record_validation(save_dir, *pending, val_metric)
+                pending = (epoch, self._validate(batch_gen_tst, epoch, val_batch_size, num_workers, worker_type, validator))
+                if validator is None:
+                    # validated self.model itself: record (and save) it before the next steps change its weights
+                    self._record_validation(save_dir, *pending, val_metric)
+                    pending = None
+        if pending is not None:
+            self._record_validation(save_dir, *pending, val_metric)
+        torch.save(self.model.state_dict(), save_dir + "/epoch-" + str(num_epochs) + ".model")
+        torch.save(optimizer.state_dict(), save_dir + "/epoch-" + str(num_epochs) + ".opt")
+        prefetcher.close()
+        visualizer.close()
+        if validator is not None:
+            validator.shutdown()
+
+    def _validate(self, batch_gen_tst, epoch, batch_size, num_workers, worker_type, validator=None):
+        '''
+        :return: the metrics, or their future if validator (an executor) is given. In that case the weights are
+                 copied to self.val_model, which is evaluated in the background.
+        '''
+        if validator is None:
+            self.val_model = self.model
+            return self.test(batch_gen_tst, epoch, batch_size=batch_size, num_workers=num_workers, worker_type=worker_type)
+        if getattr(self, 'val_model', self.model) is self.model:
+            self.val_model = copy.deepcopy(self.model)
+            self.val_stream = torch.cuda.Stream() if device.type == 'cuda' else None
+        if self.val_stream is not None:
+            # copy the weights on the validation stream, before the optimizer changes them
+            self.val_stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(self.val_stream):
+                self.val_model.load_state_dict(self.model.state_dict())
+            torch.cuda.current_stream().wait_stream(self.val_stream)
+        else:
+            self.val_model.load_state_dict(self.model.state_dict())
+        return validator.submit(self.test, batch_gen_tst, epoch, self.val_model, self.val_stream, batch_size, num_workers, worker_type)
+
+    def _record_validation(self, save_dir, epoch, metrics, val_metric):
+        if not isinstance(metrics, tuple):
+            metrics = metrics.result()
+        acc, edit, f1s = metrics
+        score = dict(zip(VAL_METRICS, [acc, edit] + list(f1s)))[val_metric]
+        line = "---[epoch %d]---: tst Acc: %.4f  Edit: %.4f  F1@10,25,50: %.4f %.4f %.4f" % ((epoch + 1, acc, edit) + tuple(f1s))
+        if self.best is None or score > self.best[1]:
+            self.best = (epoch + 1, score)
+            torch.save(self.val_model.state_dict(), save_dir + "/epoch-best.model")
+            line += "  (best %s)" % val_metric
+        print(line)
+        self._log(line)
+
+    def test(self, batch_gen_tst, epoch, model=None, stream=None, batch_size=1, num_workers=2, worker_type='thread'):
+        '''
+        segmentation metrics of model (self.model by default) on batch_gen_tst, decoded as in predict.
+        :param stream: CUDA stream to run on
+        :return: acc, edit and F1@{10,25,50}
+        '''
+        model = self.model if model is None else model
+        training = model.training
+        model.eval()
+        index2label = {v: k for k, v in batch_gen_tst.actions_dict.items()}
+        with (torch.cuda.stream(stream) if stream is not None else contextlib.nullcontext()):
+            metrics = self._evaluate(model, batch_gen_tst, index2label, batch_gen_tst.sample_rate, batch_size, num_workers, worker_type)
+        if stream is not None:
+            stream.synchronize()
+        model.train(training)
+        return metrics
+
+    def predict(self, model_dir, results_dir, batch_gen_tst, epoch, index2label, sample_rate, num_workers=2, worker_type='thread', chunk_size=None):
+        '''
+        :param results_dir: write the recognition files and plots here, None to only compute the metrics
+        :param epoch: the checkpoint epoch-<epoch>.model to load, e.g. 'best'
+        :return: acc, edit and F1@{10,25,50} of the predictions against the full frame rate ground truth,
+                 the same numbers as eval.func_eval on the written files
+        '''
+        self.model.check_classify()
         self.model.eval()
-        with torch.no_grad():
-            self.model.to(device)
-            self.model.load_state_dict(torch.load(model_dir + "/epoch-" + str(epoch) + ".model"))
+        self.model.to(device)
+        self.model.load_state_dict(torch.load(model_dir + "/epoch-" + str(epoch) + ".model"))
+        self.model.set_chunk_size(chunk_size)
+        return self._evaluate(self.model, batch_gen_tst, index2label, sample_rate, 1, num_workers, worker_type, results_dir)
 
-            batch_gen_tst.reset()
-            import time
-            
-            time_start = time.time()
-            while batch_gen_tst.has_next():
-                batch_input, batch_target, mask, vids = batch_gen_tst.next_batch(1)
-                vid = vids[0]
-#                 print(vid)
-                features = np.load(features_path + vid.split('.')[0] + '.npy')
-                features = features[:, ::sample_rate]
-
-                input_x = torch.tensor(features, dtype=torch.float)
-                input_x.unsqueeze_(0)
-                input_x = input_x.to(device)
-                predictions = self.model(input_x, torch.ones(input_x.size(), device=device))
-
-                for i in range(len(predictions)):
-                    confidence, predicted = torch.max(F.softmax(predictions[i], dim=1).data, 1)
-                    confidence, predicted = confidence.squeeze(), predicted.squeeze()
- 
-                    batch_target = batch_target.squeeze()
-                    confidence, predicted = confidence.squeeze(), predicted.squeeze()
- 
-                    segment_bars_with_confidence(results_dir + '/{}_stage{}.png'.format(vid, i),
-                                                 confidence.tolist(),
-                                                 batch_target.tolist(), predicted.tolist())
-
-                recognition = []
-                for i in range(len(predicted)):
-                    recognition = np.concatenate((recognition, [list(actions_dict.keys())[
-                                                                    list(actions_dict.values()).index(
-                                                                        predicted[i].item())]] * sample_rate))
-                f_name = vid.split('/')[-1].split('.')[0]
-                f_ptr = open(results_dir + "/" + f_name, "w")
-                f_ptr.write("### Frame level recognition: ###\n")
-                f_ptr.write(' '.join(recognition))
-                f_ptr.close()
-            time_end = time.time()
-    
-    def _plot(self, epoch, vid, features, target, clip_num=16, dir='visualize_base64-16'):
-        if epoch % 3 != 0:
-            return
-        vid = vid.split('.')[0]
-        segment_features = []
-        last_n = 0
-        for n in range(len(target[:-1])):
-            if target[n] != target[n+1]:
-                segment_features.append(features[last_n: n+1])
-                last_n = n + 1
-
-        colors = ['b', 'c', 'g', 'm', 'r', 'y', 'orange', 'darkgray']
-        # r = float(features.norm(dim=1).max() * 1.2)
-        r = 1
-        
-        max_length = 0
-        text_x = []
-        text_y = []
-        text_x_end = []
-        text_y_end = []
-        feature_norm_all = []
-        # single video features
-        for t, feature in enumerate(segment_features):
-            clip_num = 16
-            feature = feature[::max(1, len(feature)//clip_num)].cpu().detach()
-            feature_norm = feature.norm(dim=1)
-            text_x.append(max_length)
-            text_y.append(feature_norm[0])
-            max_length += len(feature_norm)
-            text_x_end.append(max_length-1)
-            text_y_end.append(feature_norm[-1])
-            feature_norm_all += [float(norm) for norm in feature_norm]
-
-            '''plt.figure(figsize=(18, 18))
-            # canvas
-            plt.title('Epoch %d: %s samples' % (epoch, vid))
-            plt.xlim(-r, r)
-            plt.ylim(-r, r)
-
-            # circle
-            circle = plt.Circle((0, 0), r, color="black", fill=False)
-            plt.gcf().gca().add_artist(circle)
-            plt.scatter(0, 0, color='black', marker = 'x')
-
-            for n in range(len(feature)-1):
-                plt.scatter(feature[n][0], feature[n][1], color=colors[t%len(colors)], marker='o')
-                plt.plot([feature[n][0], feature[n+1][0]], [feature[n][1], feature[n+1][1]], color='black')
-            plt.scatter(feature[-1][0], feature[-1][1], color=colors[t%len(colors)], marker='o')
-            # plt.text(feature[0][0], feature[0][1], vid)
-
-            plt.savefig(dir + '/%s_%d_epoch%d.png' % (vid, t, epoch))
-            plt.close()'''
-
-            # # norm
-            # plt.figure(figsize=(18, 4))
-            # plt.title('norm')
-            # plt.plot(feature_norm)
-            # plt.savefig(dir + '/%s_norm%d_epoch%d.png' % (vid, t, epoch))
-            # plt.close()
-        
-        # norm all
-        plt.figure(figsize=(64, 4))
-        plt.title('Norm of all segments')
-        plt.plot(feature_norm_all)
-        for (x, y, norm) in zip(text_x, text_y, range(len(feature_norm_all))):
-            plt.text(x, y, norm+1, fontsize=20)
-        for (x, y, norm) in zip(text_x_end, text_y_end, range(len(feature_norm_all))):
-            plt.text(x-1, y, norm+1, fontsize=20, color='red')
-            # plt.text(x, y, round(norm, 3))
-        plt.grid()
-        print(dir + '/%s_norm_epoch%d.png' % (vid, epoch))
-        plt.savefig(dir + '/%s_norm_epoch%d.png' % (vid, epoch))
-        plt.close()
-        
-        '''# whole
-        # canvas
-        plt.figure(figsize=(18, 18))
-        plt.title('Epoch %d: %s samples' % (epoch, vid))
-        plt.xlim(-r, r)
-        plt.ylim(-r, r)
-
-        # circle
-        circle = plt.Circle((0, 0), r, color="black", fill=False)
-        plt.gcf().gca().add_artist(circle)
-        plt.scatter(0, 0, color='black', marker = 'x')
-
-        for t, feature in enumerate(segment_features):
-            feature = feature[::len(feature)//clip_num].cpu().detach()
-            for n in range(len(feature)-1):
-                plt.scatter(feature[n][0], feature[n][1], color=colors[t%len(colors)], marker='o')
-                plt.plot([feature[n][0], feature[n+1][0]], [feature[n][1], feature[n+1][1]], color='black')
-            plt.scatter(feature[-1][0], feature[-1][1], color=colors[t%len(colors)], marker='o')
-            plt.text(feature[0][0], feature[0][1], str(t))
-        plt.savefig(dir + '/%s_whole_epoch%d.png' % (vid, epoch))
-        plt.close()'''
+    def _evaluate(self, model, batch_gen, index2label, sample_rate, batch_size=1, num_workers=2, worker_type='thread', results_dir=None):
+        '''
+        decode the videos of batch_gen with model (in eval mode): the label of a frame is the argmax of its
+        class scores (see MyTransformer.classify). Videos of a batch are cropped to their lengths.
+        :param results_dir: write the recognition files and plots here, None to only compute the metrics
+        :return: acc, edit and F1@{10,25,50} against the full frame rate ground truth
+        '''
+        labels = np.array([index2label[i] for i in range(len(index2label))])
+        model_device = next(model.parameters()).device
+        metrics = SegmentationMetrics(bg_class=[i for i, label in index2label.items() if label == 'background'])
+        batch_gen.reset()
+        prefetcher = BatchPrefetcher(batch_gen, batch_size, False, num_workers, worker_type, pin_memory=True)
+        with torch.inference_mode():
+            for batch_input, batch_target, mask, vids in prefetcher:
+                mask = mask.to(model_device, non_blocking=True)
+                predictions = model.classify(model(batch_input.to(model_device, non_blocking=True), mask))
+                confidences, predicted = torch.max(F.softmax(predictions, dim=2), 2)
+                lengths = mask[:, 0, :].sum(dim=-1).long().tolist()
+                confidences, predicted = confidences.cpu().numpy(), predicted.cpu().numpy()
+                for i, (vid, length) in enumerate(zip(vids, lengths)):
+                    metrics.update(np.repeat(predicted[i, :length], sample_rate), batch_gen.ground_truth(vid))
+                    if results_dir is not None:
+                        segment_bars_with_confidence(results_dir + '/{}_stage{}.png'.format(vid, i),
+                                                     confidences[i, :length].tolist(),
+                                                     batch_target[i, :length].tolist(), predicted[i, :length].tolist())
+                        f_name = vid.split('/')[-1].split('.')[0]
+                        write_recognition(results_dir + "/" + f_name, predicted[i, :length], labels, sample_rate)
+        prefetcher.close()
+        return metrics.result()
 
-            
-            
 
 if __name__ == '__main__':
     pass
@@ -0,0 +1,127 @@
+'''
+    Post-training static int8 quantization of MyTransformer for CPU inference (main.py --action quantize).
+
+    The Conv1d layers of the encoder and the decoders get int8 weights (per channel) and activations. Those
+    are the input and output 1x1 convs of the stages, the q/k/v and output convs of the attention layers, the
+    dilated convs of the feed forward layers and the 1x1 convs of the AttModules. The attention itself, the
+    instance norms and HypMlp stay in float. The activation ranges are calibrated on the videos of a
+    BatchGenerator:
+
+        qmodel = prepare(model)
+        calibrate(qmodel, batch_gen)
+        convert(qmodel)
+
+    report() compares the segmentation metrics and the throughput of the float and the int8 models. The int8
+    model runs on CPU only, and it does not support StreamingSegmenter, which reads the float conv weights.
+'''
+
+import copy
+import time
+
+import torch
+import torch.nn as nn
+import torch.ao.quantization as tq
+
+
+class QuantConv1d(nn.Sequential):
+    '''
+    a float Conv1d between the quantization of its input and the dequantization of its output.
+    '''
+    def __init__(self, conv):
+        super(QuantConv1d, self).__init__(tq.QuantStub(), conv, tq.DeQuantStub())
+
+
+def _wrap_convs(module, qconfig):
+    for name, child in module.named_children():
+        if isinstance(child, nn.Conv1d):
+            wrapped = QuantConv1d(child)
+            wrapped.qconfig = qconfig
+            setattr(module, name, wrapped)
+        else:
+            _wrap_convs(child, qconfig)
+
+
+def prepare(model, backend='x86'):
+    '''
+    :return: a copy of the float model, on CPU in eval mode, with observers on the convs of its encoder and
+             decoders
+    '''
+    torch.backends.quantized.engine = backend
+    model = copy.deepcopy(model).cpu().eval()
+    qconfig = tq.get_default_qconfig(backend)
+    for stage in [model.encoder] + list(model.decoders):
+        _wrap_convs(stage, qconfig)
+    return tq.prepare(model, inplace=True)
+
+
+def calibrate(model, batch_gen, num_videos=None):
+    '''
+    record the activation ranges of the prepared model on the videos of batch_gen (the first num_videos, all
+    by default).
+    '''
+    batch_gen.reset()
+    count = 0
+    with torch.no_grad():
+        while batch_gen.has_next() and (num_videos is None or count < num_videos):
+            batch_input, _, mask, _ = batch_gen.next_batch(1)
+            model(batch_input, mask)
+            count += 1
+    batch_gen.reset()
+
+
+def convert(model):
+    '''
+    replace the observed convs of the calibrated model by int8 convs, in place.
+    '''
+    return tq.convert(model, inplace=True)
+
+
+def quantize(model, batch_gen, num_videos=None, backend='x86'):
+    '''
+    :return: the int8 copy of model, calibrated on batch_gen
+    '''
+    qmodel = prepare(model, backend)
+    calibrate(qmodel, batch_gen, num_videos)
+    return convert(qmodel)
+
+
+def load(model, path, backend='x86'):
+    '''
+    :return: the int8 copy of model, with the state dict saved from a quantized model at path
+    '''
+    qmodel = convert(prepare(model, backend))
+    qmodel.load_state_dict(torch.load(path))
+    return qmodel
+
+
+def throughput(model, length=5000, repeat=5):
+    '''
+    :return: frames per second of model on CPU, for a random video of length frames
+    '''
+    input_dim = model.encoder.conv_1x1[1].in_channels if isinstance(model.encoder.conv_1x1, QuantConv1d) else model.encoder.conv_1x1.in_channels
+    num_classes = model.encoder.conv_out[1].out_channels if isinstance(model.encoder.conv_out, QuantConv1d) else model.encoder.conv_out.out_channels
+    x = torch.randn(1, input_dim, length)
+    mask = torch.ones(1, num_classes, length)
+    with torch.inference_mode():
+        model(x, mask)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            model(x, mask)
+    return length * repeat / (time.perf_counter() - start)
+
+
+def report(trainer, float_model, int8_model, batch_gen_tst, index2label, sample_rate, length=5000):
+    '''
+    print the Acc/Edit/F1 of both models on batch_gen_tst and their throughput.
+    :return: dict of the float and int8 (acc, edit, f1s, frames per second)
+    '''
+    float_model = copy.deepcopy(float_model).cpu().eval()
+    results = {}
+    for name, model in (('float', float_model), ('int8', int8_model)):
+        acc, edit, f1s = trainer._evaluate(model, batch_gen_tst, index2label, sample_rate, num_workers=0)
+        results[name] = (acc, edit, f1s, throughput(model, length))
+    print('%-6s %8s %8s %8s %8s %8s %12s' % ('model', 'acc', 'edit', 'f1@10', 'f1@25', 'f1@50', 'frames/s'))
+    for name, (acc, edit, f1s, fps) in results.items():
+        print('%-6s %8.4f %8.4f %8.4f %8.4f %8.4f %12.1f' % ((name, acc, edit) + tuple(f1s) + (fps,)))
+    print('speedup: %.2fx' % (results['int8'][3] / results['float'][3]))
+    return results
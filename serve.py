@@ -0,0 +1,84 @@
+'''
+    Standalone inference with a model exported by export.py (main.py --action export). Only torch and numpy
+    are imported, not the training code and its plotting and evaluation dependencies:
+
+        python serve.py models/50salads/split_1/epoch-120.pt2 data/50salads/features/*.npy --out results/
+
+    writes the frame-wise recognition file of every feature file, in the format of eval.write_recognition.
+'''
+
+import argparse
+import json
+import os
+import zipfile
+
+import numpy as np
+import torch
+
+
+def load(path):
+    '''
+    :param path: the .pt2 file written by export.export, a program or an AOTInductor package
+    :return: the callable model and its metadata
+    '''
+    if any('/data/aotinductor/' in name for name in zipfile.ZipFile(path).namelist()):
+        module = torch._inductor.aoti_load_package(path)
+        return module, json.loads(module.get_metadata()['meta.json'])
+    extra_files = {'meta.json': ''}
+    program = torch.export.load(path, extra_files=extra_files)
+    return program.module(), json.loads(extra_files['meta.json'])
+
+
+class Segmenter(object):
+    def __init__(self, path):
+        self.module, meta = load(path)
+        self.device = torch.device(meta['device'])
+        self.num_classes = meta['num_classes']
+        self.block_length = meta['block_length']
+        self.min_blocks = meta['min_blocks']
+        self.labels = np.array(meta['labels'])
+        self.sample_rate = meta['sample_rate']
+
+    def scores(self, features):
+        '''
+        :param features: the features of a video at the full frame rate, of shape (input_dim, T)
+        :return: the class scores of its subsampled frames, of shape (ceil(T / sample_rate), C)
+        '''
+        x = torch.as_tensor(np.ascontiguousarray(features[:, ::self.sample_rate]), dtype=torch.float32, device=self.device)
+        length = x.shape[1]
+        # the program takes whole blocks of the attention layers: the padded frames are masked, which leaves the
+        # frames of the video unchanged
+        padded = max(-(-length // self.block_length), self.min_blocks) * self.block_length
+        x = torch.nn.functional.pad(x, (0, padded - length)).unsqueeze(0)
+        mask = torch.zeros(1, self.num_classes, padded, device=self.device)
+        mask[:, :, :length] = 1
+        with torch.inference_mode():
+            return self.module(x, mask)[0, :length]
+
+    def predict(self, features):
+        '''
+        :return: the label of every frame of the video, every prediction repeated sample_rate times (as in
+                 eval.write_recognition)
+        '''
+        predicted = self.scores(features).argmax(dim=-1).cpu().numpy()
+        return np.repeat(self.labels[predicted], self.sample_rate)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='frame-wise action segmentation with an exported model')
+    parser.add_argument('model', help='.pt2 file written by main.py --action export')
+    parser.add_argument('features', help='.npy feature files of shape (input_dim, T)', nargs='+')
+    parser.add_argument('--out', default='.', help='directory of the recognition files')
+    args = parser.parse_args()
+
+    segmenter = Segmenter(args.model)
+    os.makedirs(args.out, exist_ok=True)
+    for feature_file in args.features:
+        recognition = segmenter.predict(np.load(feature_file))
+        with open(os.path.join(args.out, os.path.basename(feature_file).split('.')[0]), 'w') as f:
+            f.write("### Frame level recognition: ###\n")
+            f.write(' '.join(recognition))
+
+
+if __name__ == '__main__':
+    main()
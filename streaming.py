@@ -0,0 +1,223 @@
+'''
+    Online (incremental) inference of MyTransformer for live feeds: frames are pushed as they arrive, and the
+    embeddings of a frame are emitted as soon as every layer has seen the context it needs.
+
+    Every AttModule keeps ring buffers of its recent inputs, features and keys/values, sized to its dilation
+    d (= block length bl of the sliding window attention). A layer emits its outputs block by block, once the
+    keys of the block's window [i*bl - bl//2, (i+1)*bl + bl//2) are known, so the cost per frame does not grow
+    with the length of the video. The weights of the ConvFeedForward and AttLayer modules are used unchanged.
+
+    The instance norm of an AttModule normalises with statistics over the whole video, which are not known
+    online. Here each frame is normalised with the running statistics of the frames seen so far, so the
+    embeddings are an approximation of the offline ones, never exact: the error depends on how stationary the
+    statistics of the features are. It shrinks as the running statistics approach those of the whole video,
+    and stays large for videos whose first frames differ from the rest.
+    The look-ahead (latency) is bounded, see StreamingSegmenter.lookahead.
+'''
+
+import torch
+import torch.nn.functional as F
+
+from model import get_window_mask
+
+
+def conv_1x1(conv, x):
+    # nn.Conv1d with kernel size 1 on (C, n) frames, n may be 0
+    return torch.addmm(conv.bias.unsqueeze(1), conv.weight[:, :, 0], x)
+
+
+class FrameBuffer(object):
+    '''
+    frames [start, end) of a (C, T) sequence. Frames before 0 and, once the stream has ended, after the last
+    frame read as zeros (the zero paddings of the offline model).
+    '''
+    def __init__(self):
+        self.data = None
+        self.start = 0
+
+    @property
+    def end(self):
+        return self.start + (0 if self.data is None else self.data.shape[1])
+
+    def append(self, x):
+        self.data = x if self.data is None else torch.cat([self.data, x], dim=1)
+
+    def get(self, s, e):
+        assert max(s, 0) >= self.start
+        left, right = max(0, -s), max(0, e - self.end)
+        out = self.data[:, max(s, 0) - self.start:min(e, self.end) - self.start]
+        if left or right:
+            out = F.pad(out, (left, right))
+        return out
+
+    def drop_before(self, t):
+        t = min(t, self.end)
+        if t > self.start:
+            self.data = self.data[:, t - self.start:]
+            self.start = t
+
+
+class AttModuleStream(object):
+    def __init__(self, module):
+        att_layer = module.att_layer
+        assert att_layer.att_type == 'sliding_att'
+        self.module = module
+        self.d = module.feed_forward.layer[0].dilation[0]
+        self.bl = att_layer.bl
+        self.pad = self.bl // 2
+        self.decoder = att_layer.stage == 'decoder'
+
+        self.x = FrameBuffer()  # inputs
+        self.f = FrameBuffer()  # encoder features, decoder stage only
+        self.ff = FrameBuffer()  # feed forward outputs
+        self.q = FrameBuffer()
+        self.k = FrameBuffer()
+        self.v = FrameBuffer()
+        self.n_out = 0
+        self.ended = False
+        # running instance norm statistics
+        self.count = 0
+        self.sum = 0.
+        self.sum_sq = 0.
+
+    @property
+    def lookahead(self):
+        # frames an input has to wait for its output, in the worst case (first frame of a block)
+        return self.d + self.bl - 1 + self.pad
+
+    def _normalize(self, ff):
+        # instance norm with the running statistics up to each frame
+        ff64 = ff.double()
+        total = self.sum + torch.cumsum(ff64, dim=1)
+        total_sq = self.sum_sq + torch.cumsum(ff64.pow(2), dim=1)
+        count = self.count + torch.arange(1, ff.shape[1] + 1, device=ff.device, dtype=torch.float64)
+        self.count, self.sum, self.sum_sq = count[-1].item(), total[:, -1:], total_sq[:, -1:]
+        mean = total / count
+        var = (total_sq / count - mean.pow(2)).clamp_min(0)
+        return ((ff64 - mean) / torch.sqrt(var + self.module.instance_norm.eps)).to(ff.dtype)
+
+    def push(self, x, f=None, end=False):
+        '''
+        :param x: new input frames of shape (C, n), n may be 0
+        :param f: the encoder features of the same frames, decoder stage only
+        :param end: no more frames after these
+        :return: output frames of shape (C, m), following the previously returned ones
+        '''
+        module, att_layer = self.module, self.module.att_layer
+        self.x.append(x)
+        if self.decoder:
+            self.f.append(f)
+        self.ended = self.ended or end
+        n_in = self.x.end
+
+        # feed forward: frame t needs the inputs t-d and t+d
+        s, e = self.ff.end, (n_in if self.ended else n_in - self.d)
+        if e > s:
+            conv = module.feed_forward.layer[0]
+            ff = F.relu(F.conv1d(self.x.get(s - self.d, e + self.d).unsqueeze(0), conv.weight, conv.bias, dilation=self.d))[0]
+            self.ff.append(ff)
+            qkv = att_layer._stacked_conv(self._normalize(ff).unsqueeze(0), att_layer.projections())
+            self.q.append(qkv[0][0])
+            self.k.append(qkv[1][0])
+            self.v.append(att_layer.value_conv(self.f.get(s, e).unsqueeze(0))[0] if self.decoder else qkv[2][0])
+
+        # attention: whole blocks whose key window is complete, and the last partial block at the end
+        n_ff = self.ff.end
+        s = self.n_out
+        e = n_ff if self.ended and n_ff == n_in else (max(0, n_ff - self.pad) // self.bl) * self.bl
+        if e <= s:
+            return x.new_zeros(x.shape[0], 0)
+        nb = -(-(e - s) // self.bl)
+        q = self.q.get(s, s + nb * self.bl).unsqueeze(0)
+        k = self.k.get(s - self.pad, s + nb * self.bl + self.pad).unsqueeze(0)
+        v = self.v.get(s - self.pad, s + nb * self.bl + self.pad).unsqueeze(0)
+        # valid keys: [0, n_ff), which is the end of the video once the stream has ended
+        padding_mask = torch.zeros(1, 1, k.shape[2], device=x.device, dtype=x.dtype)
+        padding_mask[:, :, max(0, self.pad - s):n_ff - s + self.pad] = 1
+        att = att_layer.att_helper._sliding_window_blocks(q, k, v, padding_mask, self.bl, get_window_mask(self.bl, x.device, x.dtype))
+        att = att_layer.conv_out(F.relu(att))[0, :, :e - s]
+
+        out = module.conv_1x1(module.alpha * att + self.ff.get(s, e))
+        out = self.x.get(s, e) + out
+        self.n_out = e
+
+        # keep what the next frames still need
+        self.x.drop_before(min(e, self.ff.end - self.d))
+        self.ff.drop_before(e)
+        self.q.drop_before(e)
+        self.k.drop_before(e - self.pad)
+        self.v.drop_before(e - self.pad)
+        self.f.drop_before(self.ff.end)
+        return out
+
+
+class StageStream(object):
+    '''
+    an Encoder or a Decoder: input 1x1 conv, the stack of AttModules and the output 1x1 conv.
+    '''
+    def __init__(self, stage):
+        self.stage = stage
+        self.layers = [AttModuleStream(layer) for layer in stage.layers]
+        self.f = FrameBuffer()  # encoder features for the decoder layers, aligned with each layer's input
+        self.n_in = [0] * len(self.layers)
+
+    @property
+    def lookahead(self):
+        return sum(layer.lookahead for layer in self.layers)
+
+    def push(self, x, f=None, end=False):
+        '''
+        :return: (out, feature) of the new output frames, of shapes (num_classes, m) and (C, m)
+        '''
+        feature = conv_1x1(self.stage.conv_1x1, x)
+        if f is not None:
+            self.f.append(f)
+        for i, layer in enumerate(self.layers):
+            s = self.n_in[i]
+            self.n_in[i] += feature.shape[1]
+            layer_f = self.f.get(s, self.n_in[i]) if f is not None else None
+            feature = layer.push(feature, layer_f, end)
+        if f is not None:
+            self.f.drop_before(min(self.n_in))
+        out = conv_1x1(self.stage.conv_out, feature)
+        return out, feature
+
+
+class StreamingSegmenter(object):
+    '''
+    incremental inference with a trained MyTransformer (in eval mode):
+
+        segmenter = StreamingSegmenter(model)
+        for frames in camera:  # (input_dim, n) features of the new frames
+            embeddings, labels = segmenter.push(frames)
+        embeddings, labels = segmenter.flush()
+
+    Every call returns the embeddings (m, output_dim) and labels (m,) of the frames that became final,
+    in order. The labels are the argmax of MyTransformer.classify, as in Trainer.predict.
+    '''
+    def __init__(self, model):
+        assert not model.training
+        self.model = model
+        self.stages = [StageStream(model.encoder)] + [StageStream(decoder) for decoder in model.decoders]
+
+    @property
+    def lookahead(self):
+        '''
+        maximum number of frames between pushing a frame and getting its embedding.
+        '''
+        return sum(stage.lookahead for stage in self.stages)
+
+    @torch.no_grad()
+    def push(self, frames, end=False):
+        out, feature = self.stages[0].push(frames, end=end)
+        for stage in self.stages[1:]:
+            out, feature = stage.push(F.softmax(out, dim=0), feature, end)
+        embeddings = self.model.hypmlp(feature.t())
+        return embeddings, self.model.classify(embeddings).argmax(dim=-1)
+
+    def flush(self):
+        '''
+        end of the stream: emit the remaining frames.
+        '''
+        frames = next(self.model.parameters()).new_zeros(self.model.encoder.conv_1x1.in_channels, 0)
+        return self.push(frames, end=True)
@@ -0,0 +1,44 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+# the modules of the repository are top level modules
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+ACTIONS = ['background', 'a', 'b', 'c']
+
+
+def write_dataset(root, num_videos=4, input_dim=32, seed=0):
+    '''
+    a random dataset in the layout of ./data/<dataset>: features, groundTruth, splits and mapping.txt.
+    :return: the paths and the actions dict
+    '''
+    rng = np.random.RandomState(seed)
+    for sub in ('features', 'groundTruth', 'splits'):
+        os.makedirs(os.path.join(root, sub), exist_ok=True)
+    with open(os.path.join(root, 'mapping.txt'), 'w') as f:
+        f.write(''.join('%d %s\n' % (i, a) for i, a in enumerate(ACTIONS)))
+    vids = []
+    for v in range(num_videos):
+        length = rng.randint(40, 120)
+        labels = []
+        while len(labels) < length:
+            labels += [ACTIONS[rng.randint(len(ACTIONS))]] * rng.randint(5, 30)
+        vids.append('vid%d.txt' % v)
+        np.save(os.path.join(root, 'features', 'vid%d.npy' % v), rng.randn(input_dim, length).astype(np.float32))
+        with open(os.path.join(root, 'groundTruth', vids[-1]), 'w') as f:
+            f.write('\n'.join(labels[:length]) + '\n')
+    half = num_videos // 2
+    for name, split in (('train', vids[:half]), ('test', vids[half:])):
+        with open(os.path.join(root, 'splits', name + '.split1.bundle'), 'w') as f:
+            f.write('\n'.join(split) + '\n')
+    return {'features': os.path.join(root, 'features') + '/', 'gt': os.path.join(root, 'groundTruth') + '/',
+            'train': os.path.join(root, 'splits', 'train.split1.bundle'), 'test': os.path.join(root, 'splits', 'test.split1.bundle'),
+            'actions_dict': {a: i for i, a in enumerate(ACTIONS)}}
+
+
+@pytest.fixture
+def dataset(tmp_path):
+    return write_dataset(str(tmp_path / 'data'))
@@ -0,0 +1,78 @@
+import os
+import random
+
+import numpy as np
+import pytest
+
+from batch_gen import BatchGenerator
+from conftest import write_dataset
+
+
+def _check_cached(dataset, cache_dir):
+    # the cached examples are those read from the files
+    cached = BatchGenerator(4, dataset['actions_dict'], dataset['gt'], dataset['features'], 2, cache_dir)
+    cached.read_data(dataset['train'])
+    direct = BatchGenerator(4, dataset['actions_dict'], dataset['gt'], dataset['features'], 2)
+    assert len(cached.cache) == len(cached.features)
+    for feature_file, gt_file in zip(cached.features, cached.gts):
+        for a, b in zip(cached.load_example(feature_file, gt_file), direct.load_example(feature_file, gt_file)):
+            np.testing.assert_array_equal(a, b)
+    return cached
+
+
+def test_datasets_share_a_cache_dir(tmp_path):
+    # same split names and sample rate, other videos
+    first = write_dataset(str(tmp_path / 'first'), seed=0)
+    second = write_dataset(str(tmp_path / 'second'), seed=1)
+    cache_dir = str(tmp_path / 'cache')
+    for dataset in (first, second, first):
+        _check_cached(dataset, cache_dir)
+    assert len([name for name in os.listdir(cache_dir) if name.endswith('.index.json')]) == 2
+    assert not [name for name in os.listdir(cache_dir) if '.tmp' in name]
+
+
+def test_action_mapping_is_part_of_the_key(tmp_path):
+    dataset = write_dataset(str(tmp_path / 'data'))
+    cache_dir = str(tmp_path / 'cache')
+    first = _check_cached(dataset, cache_dir)
+    dataset['actions_dict'] = {a: (i + 1) % 4 for a, i in dataset['actions_dict'].items()}
+    second = _check_cached(dataset, cache_dir)
+    prefix = next(iter(first.cache.values()))[0]
+    assert prefix != next(iter(second.cache.values()))[0]
+    with pytest.raises(ValueError):
+        second.attach_cache(prefix)
+
+
+def test_files_rewritten_in_place(tmp_path):
+    dataset = write_dataset(str(tmp_path / 'data'))
+    cache_dir = str(tmp_path / 'cache')
+    first = _check_cached(dataset, cache_dir)
+    feature_file = first.features[0]
+    rewritten = np.load(feature_file) + 1
+    np.save(feature_file, rewritten)
+    second = _check_cached(dataset, cache_dir)
+    gt_file = first.gts[first.features.index(feature_file)]
+    np.testing.assert_array_equal(second.load_example(feature_file, gt_file)[0], rewritten[:, ::2])
+    # a shard that went stale after it was built is refused
+    prefix = next(iter(second.cache.values()))[0]
+    second.attach_cache(prefix)
+    np.save(feature_file, rewritten[:, :-1])
+    with pytest.raises(ValueError):
+        second.attach_cache(prefix)
+
+
+def test_shuffles_leave_the_random_module_alone(dataset):
+    orders = []
+    for _ in range(2):
+        random.seed(0)
+        batch_gen = BatchGenerator(4, dataset['actions_dict'], dataset['gt'], dataset['features'], 1, frame_budget=200)
+        batch_gen.read_data(dataset['train'])
+        state = random.getstate()
+        orders.append([])
+        for _ in range(3):
+            batch_gen.reset()
+            orders[-1].append((list(batch_gen.list_of_examples), list(batch_gen.batch_ends)))
+            assert [f.split('/')[-1].split('.')[0] for f in batch_gen.features] == [v.split('.')[0] for v in batch_gen.list_of_examples]
+        assert random.getstate() == state
+    # reproducible from the seed of the random module
+    assert orders[0] == orders[1]
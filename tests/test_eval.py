@@ -0,0 +1,189 @@
+import numpy as np
+import pytest
+
+import eval
+
+
+# the implementation eval.py replaced (np.float is float in current numpy)
+
+def reference_get_labels_start_end_time(frame_wise_labels, bg_class=["background"]):
+    labels = []
+    starts = []
+    ends = []
+    last_label = frame_wise_labels[0]
+    if frame_wise_labels[0] not in bg_class:
+        labels.append(frame_wise_labels[0])
+        starts.append(0)
+    for i in range(len(frame_wise_labels)):
+        if frame_wise_labels[i] != last_label:
+            if frame_wise_labels[i] not in bg_class:
+                labels.append(frame_wise_labels[i])
+                starts.append(i)
+            if last_label not in bg_class:
+                ends.append(i)
+            last_label = frame_wise_labels[i]
+    if last_label not in bg_class:
+        ends.append(i)
+    return labels, starts, ends
+
+
+def reference_levenstein(p, y, norm=False):
+    m_row = len(p)
+    n_col = len(y)
+    D = np.zeros([m_row+1, n_col+1], float)
+    for i in range(m_row+1):
+        D[i, 0] = i
+    for i in range(n_col+1):
+        D[0, i] = i
+
+    for j in range(1, n_col+1):
+        for i in range(1, m_row+1):
+            if y[j-1] == p[i-1]:
+                D[i, j] = D[i-1, j-1]
+            else:
+                D[i, j] = min(D[i-1, j] + 1,
+                              D[i, j-1] + 1,
+                              D[i-1, j-1] + 1)
+
+    if norm:
+        score = (1 - D[-1, -1]/max(m_row, n_col)) * 100
+    else:
+        score = D[-1, -1]
+
+    return score
+
+
+def reference_edit_score(recognized, ground_truth, norm=True, bg_class=["background"]):
+    P, _, _ = reference_get_labels_start_end_time(recognized, bg_class)
+    Y, _, _ = reference_get_labels_start_end_time(ground_truth, bg_class)
+    return reference_levenstein(P, Y, norm)
+
+
+def reference_f_score(recognized, ground_truth, overlap, bg_class=["background"]):
+    p_label, p_start, p_end = reference_get_labels_start_end_time(recognized, bg_class)
+    y_label, y_start, y_end = reference_get_labels_start_end_time(ground_truth, bg_class)
+
+    tp = 0
+    fp = 0
+
+    hits = np.zeros(len(y_label))
+
+    for j in range(len(p_label)):
+        intersection = np.minimum(p_end[j], y_end) - np.maximum(p_start[j], y_start)
+        union = np.maximum(p_end[j], y_end) - np.minimum(p_start[j], y_start)
+        IoU = (1.0*intersection / union)*([p_label[j] == y_label[x] for x in range(len(y_label))])
+        # Get the best scoring segment
+        idx = np.array(IoU).argmax()
+
+        if IoU[idx] >= overlap and not hits[idx]:
+            tp += 1
+            hits[idx] = 1
+        else:
+            fp += 1
+    fn = len(y_label) - sum(hits)
+    return float(tp), float(fp), float(fn)
+
+
+def reference_metrics(videos, overlap=(.1, .25, .5)):
+    # the accumulation of the old func_eval
+    tp, fp, fn = np.zeros(3), np.zeros(3), np.zeros(3)
+    correct = 0
+    total = 0
+    edit = 0
+    for recog_content, gt_content in videos:
+        for i in range(len(gt_content)):
+            total += 1
+            if gt_content[i] == recog_content[i]:
+                correct += 1
+        edit += reference_edit_score(recog_content, gt_content)
+        for s in range(len(overlap)):
+            tp1, fp1, fn1 = reference_f_score(recog_content, gt_content, overlap[s])
+            tp[s] += tp1
+            fp[s] += fp1
+            fn[s] += fn1
+    acc = 100 * float(correct) / total
+    edit = (1.0 * edit) / len(videos)
+    f1s = np.array([0, 0, 0], dtype=float)
+    for s in range(len(overlap)):
+        precision = tp[s] / float(tp[s] + fp[s])
+        recall = tp[s] / float(tp[s] + fn[s])
+        f1 = 2.0 * (precision * recall) / (precision + recall)
+        f1 = np.nan_to_num(f1) * 100
+        f1s[s] = f1
+    return acc, edit, f1s
+
+
+LABELS = ['background', 'a', 'b', 'c']
+
+
+def _random_labels(rng, length, num_labels=len(LABELS), max_segment=20):
+    labels = []
+    while len(labels) < length:
+        labels += [LABELS[rng.randint(num_labels)]] * rng.randint(1, max_segment)
+    return labels[:length]
+
+
+def _videos():
+    rng = np.random.RandomState(0)
+    videos = []
+    for _ in range(200):
+        length = rng.randint(1, 300)
+        ground_truth = _random_labels(rng, length)
+        # a noisy copy of the ground truth, or unrelated labels
+        recognized = list(ground_truth) if rng.rand() < 0.5 else _random_labels(rng, length)
+        for i in rng.randint(0, length, rng.randint(0, 10)):
+            recognized[i] = LABELS[rng.randint(len(LABELS))]
+        videos.append((recognized, ground_truth))
+    # a single frame, a single segment, all background (no segments), and one segment against none
+    videos += [(['a'], ['a']), (['b'], ['a']), (['a'] * 50, ['a'] * 50), (['a'] * 50, ['b'] * 20 + ['a'] * 30),
+               (['background'] * 30, ['background'] * 30), (['background'] * 30, ['a'] * 30)]
+    return videos
+
+
+def _reference_or_skip(fn, *args):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        try:
+            return fn(*args)
+        except ValueError:
+            # argmax of an empty sequence: predicted segments and only background in the ground truth
+            pytest.skip('the reference fails on this input')
+
+
+@pytest.mark.parametrize('video', range(len(_videos())))
+def test_matches_reference(video):
+    recognized, ground_truth = _videos()[video]
+    for frames in (recognized, ground_truth):
+        assert eval.get_labels_start_end_time(frames) == reference_get_labels_start_end_time(frames)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        np.testing.assert_equal(eval.edit_score(recognized, ground_truth), reference_edit_score(recognized, ground_truth))
+    for overlap in (.1, .25, .5):
+        assert eval.f_score(recognized, ground_truth, overlap) == _reference_or_skip(reference_f_score, recognized, ground_truth, overlap)
+
+
+@pytest.mark.parametrize('p, y', [([], []), ([], ['a', 'b']), (['a'], []), (['a', 'b', 'a'], ['b', 'a', 'c', 'a'])])
+def test_levenstein_matches_reference(p, y):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for norm in (False, True):
+            np.testing.assert_equal(eval.levenstein(p, y, norm), reference_levenstein(p, y, norm))
+
+
+def test_segmentation_metrics_match_reference():
+    # the videos the reference can score
+    videos = [video for video in _videos() if any(label != 'background' for label in video[1])]
+    metrics = eval.SegmentationMetrics()
+    for recognized, ground_truth in videos:
+        metrics.update(recognized, ground_truth)
+    acc, edit, f1s = metrics.result()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        expected_acc, expected_edit, expected_f1s = reference_metrics(videos)
+    assert acc == expected_acc
+    assert edit == expected_edit
+    np.testing.assert_array_equal(f1s, expected_f1s)
+
+    # class indices, as in Trainer.predict
+    index = {label: i for i, label in enumerate(LABELS)}
+    metrics = eval.SegmentationMetrics(bg_class=[0])
+    for recognized, ground_truth in videos:
+        metrics.update([index[label] for label in recognized], [index[label] for label in ground_truth])
+    assert metrics.result()[0] == expected_acc
+    np.testing.assert_array_equal(metrics.result()[2], expected_f1s)
@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+import torch
+
+import export
+import serve
+from model import MyTransformer
+
+
+@pytest.mark.parametrize('mlr_head', [False, True])
+def test_export_serve_round_trip(tmp_path, mlr_head):
+    torch.manual_seed(0)
+    # without a head, the label of a frame is the argmax of its embedding: as many dimensions as classes
+    model = MyTransformer(2, 3, 2, 2, 16, 24, 8 if mlr_head else 4, 4, 0.3, mlr_head=mlr_head).eval()
+    path = str(tmp_path / 'model.pt2')
+    export.export(model, path, ['background', 'a', 'b', 'c'], sample_rate=2)
+    segmenter = serve.Segmenter(path)
+    rng = np.random.RandomState(0)
+    # shorter than min_blocks blocks, not a multiple of the block, and long
+    for length in (5, 51, 400):
+        features = rng.randn(24, length).astype(np.float32)
+        x = torch.as_tensor(features[:, ::2]).unsqueeze(0)
+        with torch.no_grad():
+            expected = model.classify(model(x, torch.ones(1, 4, x.shape[2])))[0]
+        scores = segmenter.scores(features)
+        assert scores.shape == expected.shape
+        assert torch.allclose(scores, expected, atol=1e-5), (scores - expected).abs().max()
+        labels = np.array(['background', 'a', 'b', 'c'])[expected.argmax(-1).numpy()]
+        np.testing.assert_array_equal(segmenter.predict(features), np.repeat(labels, 2))
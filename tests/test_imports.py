@@ -0,0 +1,11 @@
+import numpy as np
+
+from benchmark import IMPORT_BUDGET, ON_DEMAND_MODULES, STARTUP_MODULES, _import_time
+
+
+def test_startup_imports_within_budget():
+    # fresh interpreters that import torch, then the modules main.py imports at startup
+    runs = [_import_time(STARTUP_MODULES) for _ in range(3)]
+    assert np.median([run[2] for run in runs]) < IMPORT_BUDGET
+    eager = set(ON_DEMAND_MODULES) & set.union(*[run[3] - run[1] for run in runs])
+    assert not eager, 'loaded at startup: %s' % ', '.join(sorted(eager))
@@ -0,0 +1,117 @@
+import numpy as np
+import pytest
+import torch
+
+from batch_gen import BatchGenerator
+from model import MultiHeadAttLayer, MyTransformer, Trainer
+
+
+@pytest.mark.parametrize('mlr_head', [False, True])
+def test_padded_batch_matches_videos_alone(mlr_head):
+    torch.manual_seed(0)
+    model = MyTransformer(2, 4, 2, 2, 16, 24, 8 if mlr_head else 4, 4, 0.3, mlr_head=mlr_head).double().eval()
+    lengths = [37, 100, 64]
+    videos = [torch.randn(1, 24, length, dtype=torch.float64) for length in lengths]
+    batch = torch.zeros(len(lengths), 24, max(lengths), dtype=torch.float64)
+    mask = torch.zeros(len(lengths), 4, max(lengths), dtype=torch.float64)
+    for i, (video, length) in enumerate(zip(videos, lengths)):
+        # random features in the padding, which the mask must hide
+        batch[i] = torch.randn(24, max(lengths), dtype=torch.float64)
+        batch[i, :, :length] = video[0]
+        mask[i, :, :length] = 1
+    with torch.no_grad():
+        batched = model.classify(model(batch, mask))
+        for i, (video, length) in enumerate(zip(videos, lengths)):
+            alone = model.classify(model(video, torch.ones(1, 4, length, dtype=torch.float64)))[0]
+            assert torch.allclose(batched[i, :length], alone, rtol=0, atol=1e-10), (batched[i, :length] - alone).abs().max()
+
+
+def _multi_head_inputs(dtype):
+    generator = torch.Generator().manual_seed(1)
+    x1 = torch.randn(2, 16, 70, generator=generator).to(dtype)
+    x2 = torch.randn(2, 12, 70, generator=generator).to(dtype)
+    mask = torch.ones(2, 4, 70, dtype=dtype)
+    mask[1, :, 50:] = 0
+    return x1, x2, mask
+
+
+@pytest.mark.parametrize('stage', ['encoder', 'decoder'])
+@pytest.mark.parametrize('dtype', [torch.float32, torch.float64])
+def test_fused_multi_head_matches_unfused(stage, dtype):
+    torch.manual_seed(0)
+    v_dim = 16 if stage == 'encoder' else 12
+    unfused = MultiHeadAttLayer(16, 16, v_dim, 2, 2, 2, 8, stage, 'sliding_att', 3).to(dtype).eval()
+    x1, x2, mask = _multi_head_inputs(dtype)
+    x2 = x1 if stage == 'encoder' else x2
+    tolerance = {'rtol': 1e-5, 'atol': 1e-6} if dtype == torch.float32 else {'rtol': 0, 'atol': 1e-12}
+    with torch.no_grad():
+        expected = unfused(x1, x2, mask)
+
+        # an unfused checkpoint loads into a fused layer
+        fused = MultiHeadAttLayer(16, 16, v_dim, 2, 2, 2, 8, stage, 'sliding_att', 3, fused=True).to(dtype).eval()
+        fused.load_state_dict(unfused.state_dict())
+        assert torch.allclose(fused(x1, x2, mask), expected, **tolerance)
+
+        # fused in place, with the dtype and the hooks of the layer
+        calls = []
+        unfused.register_forward_hook(lambda module, inputs, output: calls.append(output.dtype))
+        unfused.fuse()
+        assert unfused.fused and not hasattr(unfused, 'layers')
+        assert all(p.dtype == dtype for p in unfused.parameters())
+        assert torch.allclose(unfused(x1, x2, mask), expected, **tolerance)
+        assert calls == [dtype]
+
+
+def test_chunked_inference_matches_full(dataset, tmp_path):
+    torch.manual_seed(0)
+    trainer = Trainer(4, 2, 2, 16, 32, 8, 4, 0.3, mlr_head=True)
+    model_dir = str(tmp_path)
+    torch.save(trainer.model.state_dict(), model_dir + '/epoch-1.model')
+    batch_gen_tst = BatchGenerator(4, dataset['actions_dict'], dataset['gt'], dataset['features'], 1)
+    batch_gen_tst.read_data(dataset['test'])
+    index2label = {v: k for k, v in dataset['actions_dict'].items()}
+    model = trainer.model.eval()
+    x = torch.randn(1, 32, 250)
+    mask = torch.ones(1, 4, 250)
+    results = []
+    # chunks that divide neither the length nor the blocks, of one block, and longer than the video
+    for chunk_size in (None, 7, 8, 100, 1000):
+        model.set_chunk_size(chunk_size)
+        with torch.no_grad():
+            out = model(x, mask)
+        results_dir = tmp_path / str(chunk_size)
+        results_dir.mkdir()
+        metrics = trainer.predict(model_dir, str(results_dir), batch_gen_tst, 1, index2label, 1, num_workers=0, chunk_size=chunk_size)
+        recognition = {vid: (results_dir / vid.split('.')[0]).read_text() for vid in batch_gen_tst.list_of_examples}
+        results.append((out, metrics, recognition))
+    expected, expected_metrics, expected_recognition = results[0]
+    for out, metrics, recognition in results[1:]:
+        assert torch.allclose(out, expected, rtol=0, atol=1e-6), (out - expected).abs().max()
+        assert metrics[:2] == expected_metrics[:2]
+        np.testing.assert_array_equal(metrics[2], expected_metrics[2])
+        assert recognition == expected_recognition
+
+
+def test_stacked_projections_cache():
+    torch.manual_seed(0)
+    model = MyTransformer(2, 3, 2, 2, 16, 24, 4, 4, 0.3).eval()
+    layer = model.encoder.layers[0].att_layer
+    x = torch.randn(1, 24, 40)
+    mask = torch.ones(1, 4, 40)
+    with torch.no_grad():
+        out = model(x, mask)
+        weight = layer.stacked_weight
+        assert weight is not None
+        model(x, mask)
+        assert layer.stacked_weight is weight  # not stacked again
+        assert 'stacked_weight' not in model.state_dict()
+        # new weights, loaded in place, are stacked again
+        other = MyTransformer(2, 3, 2, 2, 16, 24, 4, 4, 0.3)
+        model.load_state_dict(other.state_dict())
+        assert torch.equal(model(x, mask), other.eval()(x, mask))
+        assert not torch.equal(model(x, mask), out)
+    # no cache in training, where the weights change at every step
+    model.train()
+    assert layer.stacked_weight is None
+    model(x, mask).sum().backward()
+    assert layer.stacked_weight is None and layer.query_conv.weight.grad is not None
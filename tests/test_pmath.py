@@ -0,0 +1,72 @@
+import pytest
+import torch
+
+from benchmark import dist_matrix_reference, hyp_linear_reference
+from hyptorch import pmath
+
+
+def _points(n, dim, scale, seed):
+    generator = torch.Generator().manual_seed(seed)
+    return pmath.expmap0_project(scale * torch.randn(n, dim, generator=generator, dtype=torch.float64), c=1.0)
+
+
+@pytest.mark.parametrize('c', [1.0, 0.5])
+@pytest.mark.parametrize('scale', [0.1, 3.0])  # inside the ball, and projected onto its border
+def test_hyp_linear_gradcheck(c, scale):
+    x = _points(6, 5, scale, 0).requires_grad_()
+    weight = (torch.randn(4, 5, dtype=torch.float64) / 5 ** 0.5).requires_grad_()
+    bias = (0.3 * torch.randn(4, dtype=torch.float64)).requires_grad_()
+    assert torch.autograd.gradcheck(lambda x, weight, bias: pmath.hyp_linear(x, weight, bias, c=c), (x, weight, bias))
+    assert torch.autograd.gradcheck(lambda x, weight: pmath.hyp_linear(x, weight, c=c), (x, weight))
+    assert torch.autograd.gradcheck(lambda x, weight, bias: pmath.HypLinearFunction.apply(x, weight, bias, torch.tensor(c, dtype=torch.float64)),
+                                    (x, weight, bias))
+
+
+@pytest.mark.parametrize('c', [1.0, 0.5])
+@pytest.mark.parametrize('scale', [0.1, 3.0])
+def test_hyp_linear_matches_reference(c, scale):
+    torch.manual_seed(0)
+    inputs = [_points(64, 16, scale, 1), torch.randn(12, 16, dtype=torch.float64) / 4, 0.3 * torch.randn(12, dtype=torch.float64)]
+    grad_output = torch.randn(64, 12, dtype=torch.float64)
+    results = []
+    for fn in (lambda x, weight, bias: pmath.hyp_linear(x, weight, bias, c=c), lambda x, weight, bias: hyp_linear_reference(x, weight, bias, c)):
+        leaves = [t.clone().requires_grad_() for t in inputs]
+        out = fn(*leaves)
+        out.backward(grad_output)
+        results.append([out] + [t.grad for t in leaves])
+    for fused, reference in zip(*results):
+        assert torch.allclose(fused, reference, rtol=1e-9, atol=1e-10), (fused - reference).abs().max()
+
+
+@pytest.mark.parametrize('c', [1.0, 0.5])
+@pytest.mark.parametrize('block_size', [None, 1, 3])  # one block, rows one by one, and a last partial block
+def test_dist_matrix_gradcheck(c, block_size):
+    x = _points(7, 5, 1.0, 4).requires_grad_()
+    y = _points(4, 5, 1.0, 5).requires_grad_()
+    assert torch.autograd.gradcheck(lambda x, y: pmath.dist_matrix(x, y, c, block_size=block_size), (x, y))
+    assert torch.autograd.gradcheck(lambda x, y: pmath.DistMatrixFunction.apply(x, y, torch.tensor(c, dtype=torch.float64), block_size or len(x)), (x, y))
+
+
+@pytest.mark.parametrize('c', [1.0, 0.5])
+@pytest.mark.parametrize('block_size', [None, 1, 7])
+def test_dist_matrix_matches_reference(c, block_size):
+    torch.manual_seed(0)
+    inputs = [_points(50, 16, 1.0, 6), _points(20, 16, 1.0, 7)]
+    grad_output = torch.randn(50, 20, dtype=torch.float64)
+    results = []
+    for fn in (lambda x, y: pmath.dist_matrix(x, y, c, block_size=block_size), lambda x, y: dist_matrix_reference(x, y, c)):
+        leaves = [t.clone().requires_grad_() for t in inputs]
+        out = fn(*leaves)
+        out.backward(grad_output)
+        results.append([out] + [t.grad for t in leaves])
+    for gram, reference in zip(*results):
+        assert torch.allclose(gram, reference, rtol=1e-8, atol=1e-10), (gram - reference).abs().max()
+
+
+def test_hyperbolic_softmax_scripted():
+    X = _points(50, 8, 1.0, 2)
+    P = _points(5, 8, 0.5, 3)
+    A = torch.randn(5, 8, dtype=torch.float64)
+    c = torch.tensor(1.0, dtype=torch.float64)
+    scripted = torch.jit.script(pmath._hyperbolic_softmax)
+    assert torch.allclose(scripted(X, A, P, c, 16), pmath._hyperbolic_softmax(X, A, P, c, 16), rtol=0, atol=1e-12)
@@ -0,0 +1,30 @@
+import torch
+
+from model import MyTransformer
+from streaming import StreamingSegmenter
+
+
+def test_streaming_approximates_the_offline_model():
+    torch.manual_seed(0)
+    model = MyTransformer(3, 10, 2, 2, 32, 64, 5, 5, 0.3).eval()
+    # a clip of the length of a subsampled 50salads video, with segments of different mean features
+    length = 5000
+    generator = torch.Generator().manual_seed(1)
+    x = torch.randn(64, length, generator=generator)
+    bounds = sorted(torch.randint(1, length, (20,), generator=generator).tolist())
+    for s, e in zip([0] + bounds, bounds + [length]):
+        x[:, s:e] += torch.randn(64, 1, generator=generator)
+    with torch.no_grad():
+        offline = model(x.unsqueeze(0), torch.ones(1, 5, length))[0]
+
+    segmenter = StreamingSegmenter(model)
+    outputs = [segmenter.push(x[:, s:s + 100]) for s in range(0, length, 100)] + [segmenter.flush()]
+    embeddings = torch.cat([embeddings for embeddings, _ in outputs])
+    labels = torch.cat([labels for _, labels in outputs])
+    assert embeddings.shape == offline.shape
+
+    # the running instance norm statistics: an error that shrinks as they settle
+    error = (embeddings - offline).norm(dim=-1) / offline.norm(dim=-1)
+    assert error.max() < 1e-2
+    assert error[-1000:].mean() < error[:1000].mean()
+    assert (labels == model.classify(offline).argmax(dim=-1)).float().mean() > 0.99
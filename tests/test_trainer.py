@@ -0,0 +1,102 @@
+import copy
+import math
+import os
+
+import pytest
+import torch
+
+from batch_gen import BatchGenerator
+from model import Trainer, claim_dir
+
+
+def test_best_model_is_the_validated_one(dataset, tmp_path):
+    torch.manual_seed(0)
+    trainer = Trainer(2, 2, 2, 8, 32, 8, 4, 0.3, mlr_head=True)
+    validated = []
+    scores = iter([0.9, 0.5, 0.1])  # the first validation is the best
+
+    def test(batch_gen_tst, epoch, model=None, *args, **kwargs):
+        model = trainer.model if model is None else model
+        validated.append(copy.deepcopy(model.state_dict()))
+        return 0., 0., [0., 0., next(scores)]
+
+    trainer.test = test
+    batch_gen = BatchGenerator(4, dataset['actions_dict'], dataset['gt'], dataset['features'], 1)
+    batch_gen.read_data(dataset['train'])
+    batch_gen_tst = BatchGenerator(4, dataset['actions_dict'], dataset['gt'], dataset['features'], 1)
+    batch_gen_tst.read_data(dataset['test'])
+    for async_val in (False, True):
+        validated.clear()
+        scores = iter([0.9, 0.5, 0.1])
+        save_dir = tmp_path / ('async' if async_val else 'sync')
+        save_dir.mkdir()
+        trainer.train(str(save_dir), batch_gen, 3, 1, 1e-2, batch_gen_tst, 0, val_interval=1, async_val=async_val)
+        assert trainer.best[0] == 1
+        best = torch.load(str(save_dir / 'epoch-best.model'))
+        for name, value in best.items():
+            assert torch.equal(value.cpu(), validated[0][name].cpu()), name
+        # the weights changed after the first validation, so the check above can fail
+        assert any(not torch.equal(validated[0][name], validated[1][name]) for name in best)
+
+
+def _batch_gens(dataset):
+    batch_gen = BatchGenerator(4, dataset['actions_dict'], dataset['gt'], dataset['features'], 1)
+    batch_gen.read_data(dataset['train'])
+    batch_gen_tst = BatchGenerator(4, dataset['actions_dict'], dataset['gt'], dataset['features'], 1)
+    batch_gen_tst.read_data(dataset['test'])
+    return batch_gen, batch_gen_tst
+
+
+def test_validation_and_predict_with_the_cli_defaults(dataset, tmp_path):
+    # as main.py: embeddings of more dimensions than classes, and the MLR head
+    torch.manual_seed(0)
+    trainer = Trainer(2, 2, 2, 8, 32, 16, 4, 0.3, mlr_head=True)
+    batch_gen, batch_gen_tst = _batch_gens(dataset)
+    model_dir, results_dir = str(tmp_path / 'models'), str(tmp_path / 'results')
+    os.makedirs(model_dir)
+    os.makedirs(results_dir)
+    trainer.train(model_dir, batch_gen, 2, 1, 1e-2, batch_gen_tst, 0, val_interval=1)
+    assert trainer.best is not None
+    index2label = {v: k for k, v in dataset['actions_dict'].items()}
+    acc, edit, f1s = trainer.predict(model_dir, results_dir, batch_gen_tst, 'best', index2label, 1, num_workers=0)
+    assert all(math.isfinite(value) for value in [acc, edit] + list(f1s))
+    for vid in batch_gen_tst.list_of_examples:
+        with open(os.path.join(results_dir, vid.split('.')[0])) as f:
+            recognition = f.read().split('\n')[1].split()
+        assert set(recognition) <= set(dataset['actions_dict'])
+        assert len(recognition) == len(batch_gen_tst.ground_truth(vid))
+
+
+def test_no_class_scores_without_a_head(dataset, tmp_path):
+    trainer = Trainer(2, 2, 2, 8, 32, 16, 4, 0.3)
+    batch_gen, batch_gen_tst = _batch_gens(dataset)
+    with pytest.raises(ValueError):
+        trainer.train(str(tmp_path), batch_gen, 1, 1, 1e-2, batch_gen_tst, 0, val_interval=1)
+    with pytest.raises(ValueError):
+        trainer.predict(str(tmp_path), None, batch_gen_tst, 1, {v: k for k, v in dataset['actions_dict'].items()}, 1, num_workers=0)
+
+
+def test_runs_do_not_share_directories(dataset, tmp_path):
+    torch.manual_seed(0)
+    model_dir, run_dir = str(tmp_path / 'models'), str(tmp_path / 'visualize')
+    trainer = Trainer(2, 2, 2, 8, 32, 16, 4, 0.3, mlr_head=True, run_dir=run_dir)
+    batch_gen, _ = _batch_gens(dataset)
+    trainer.train(model_dir, batch_gen, 1, 1, 1e-2, None, 0)
+    assert os.path.exists(os.path.join(model_dir, 'epoch-1.model'))
+    # a second run on the same split
+    other = Trainer(2, 2, 2, 8, 32, 16, 4, 0.3, mlr_head=True, run_dir=str(tmp_path / 'other'))
+    with pytest.raises(FileExistsError):
+        other.train(model_dir, batch_gen, 1, 1, 1e-2, None, 0)
+    with pytest.raises(FileExistsError):
+        Trainer(2, 2, 2, 8, 32, 16, 4, 0.3, mlr_head=True, run_dir=run_dir).train(str(tmp_path / 'new'), batch_gen, 1, 1, 1e-2, None, 0)
+    trainer.train(model_dir, batch_gen, 1, 1, 1e-2, None, 0, overwrite=True)
+
+
+def test_claim_is_exclusive(tmp_path):
+    # two runs started at the same time on an empty directory
+    claim_dir(str(tmp_path / 'models'))
+    with pytest.raises(FileExistsError):
+        claim_dir(str(tmp_path / 'models'))
+    claim_dir(str(tmp_path / 'models'), overwrite=True)
+    with open(str(tmp_path / 'models' / 'train.pid')) as f:
+        assert int(f.read()) == os.getpid()
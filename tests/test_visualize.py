@@ -0,0 +1,29 @@
+import os
+import subprocess
+import sys
+import textwrap
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_norm_plots_from_a_script(tmp_path):
+    # a training script in the style of main.py: all at the top level, no __main__ guard
+    script = tmp_path / 'train.py'
+    script.write_text(textwrap.dedent('''
+        import torch
+        from visualize import NormPlotVisualizer
+
+        print('started')
+        visualizer = NormPlotVisualizer({!r}, every_epochs=1)
+        target = torch.tensor([0] * 20 + [1] * 30 + [2] * 10)
+        for epoch in (1, 2):
+            visualizer.add(epoch, 'vid0.txt', torch.randn(60, 8), target)
+        visualizer.close()
+    ''').format(str(tmp_path)))
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    out = subprocess.run([sys.executable, str(script)], cwd=str(tmp_path), env=env, capture_output=True, text=True, timeout=300)
+    assert out.returncode == 0, out.stderr
+    # the script ran once, and both figures were rendered
+    assert out.stdout.count('started') == 1
+    for epoch in (1, 2):
+        assert os.path.getsize(str(tmp_path / ('vid0_norm_epoch%d.png' % epoch))) > 0
@@ -0,0 +1,121 @@
+'''
+    Visualisation of the embeddings during training, out of the training loop.
+
+    Trainer.train hands the first video of every batch to a visualizer. NormPlotVisualizer only snapshots the norms
+    it plots (one gather and one device to host copy per video) and renders the figures in a background
+    thread, so that matplotlib never stalls the training steps. NullVisualizer disables the plots.
+'''
+
+import collections
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+
+class NullVisualizer(object):
+    '''
+    the visualizer interface, which plots nothing.
+    '''
+    def wants(self, epoch, index):
+        '''
+        :param index: index of the video in the epoch
+        :return: whether add() would plot this video, to skip the work of preparing its inputs
+        '''
+        return False
+
+    def add(self, epoch, vid, features, target):
+        '''
+        :param features: embeddings of a video of shape (L, D), without paddings
+        :param target: labels of shape (L,)
+        '''
+        pass
+
+    def close(self):
+        '''
+        wait for the pending plots.
+        '''
+        pass
+
+
+def sample_segment_norms(features, target, clip_num=16):
+    '''
+    norms of about clip_num evenly spaced frames of every segment, except the last one.
+
+    :return: norms (numpy) of the sampled frames, and the number of samples of each segment
+    '''
+    # a segment ends at every label change
+    ends = (torch.nonzero(target[:-1] != target[1:])[:, 0] + 1).cpu().numpy()
+    starts = np.concatenate(([0], ends))[:-1].astype(np.int64)
+    steps = np.maximum(1, (ends - starts) // clip_num)
+    counts = -(-(ends - starts) // steps)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    idx = np.repeat(starts, counts) + offsets * np.repeat(steps, counts)
+    with torch.no_grad():
+        norms = features[torch.as_tensor(idx, device=features.device)].norm(dim=1)
+    return norms.float().cpu().numpy(), counts
+
+
+def plot_segment_norms(path, norms, counts):
+    '''
+    the norms of the sampled frames of all segments, in one row, with the segment numbers at their first
+    (black) and last (red) frame.
+    '''
+    # a Figure of its own on the Agg canvas, not pyplot and its global state: this runs off the main thread
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    ends = np.cumsum(counts)
+    starts = ends - counts
+    fig = Figure(figsize=(64, 4))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    ax.set_title('Norm of all segments')
+    ax.plot(norms)
+    for n, (start, end) in enumerate(zip(starts, ends)):
+        ax.text(start, norms[start], n + 1, fontsize=20)
+        ax.text(end - 2, norms[end - 1], n + 1, fontsize=20, color='red')
+    ax.grid()
+    print(path)
+    fig.savefig(path)
+
+
+class NormPlotVisualizer(NullVisualizer):
+    '''
+    plots the norms of the embeddings along the segments of a video (see plot_segment_norms) to
+    <dir>/<vid>_norm_epoch<epoch>.png.
+
+    :param every_epochs: plot on the epochs that are multiples of this
+    :param num_videos: plot the first num_videos videos of these epochs, None for all
+    :param max_pending: number of figures that may wait for rendering before add() blocks
+    '''
+    def __init__(self, dir, every_epochs=3, num_videos=None, clip_num=16, max_pending=8):
+        self.dir = dir
+        self.every_epochs = every_epochs
+        self.num_videos = num_videos
+        self.clip_num = clip_num
+        self.max_pending = max_pending
+        self.pool = None
+        self.pending = collections.deque()
+
+    def wants(self, epoch, index):
+        return epoch % self.every_epochs == 0 and (self.num_videos is None or index < self.num_videos)
+
+    def add(self, epoch, vid, features, target):
+        norms, counts = sample_segment_norms(features, target, self.clip_num)
+        if self.pool is None:
+            # a thread, not a process: a spawned process would import the __main__ module of the training
+            # script again, and main.py runs the training at import time
+            self.pool = ThreadPoolExecutor(1)
+        while len(self.pending) >= self.max_pending:
+            self.pending.popleft().result()
+        path = os.path.join(self.dir, '%s_norm_epoch%d.png' % (vid.split('.')[0], epoch))
+        self.pending.append(self.pool.submit(plot_segment_norms, path, norms, counts))
+
+    def close(self):
+        while self.pending:
+            self.pending.popleft().result()
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None